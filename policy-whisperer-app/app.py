@@ -1,44 +1,75 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, g, render_template, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import os
-import yaml
 import json
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # Import from the new modular Policy Whisperer package
-from policy_whisperer.generator import generate_policy_from_prompt, generate_policy_explanation
-from policy_whisperer.utils import analyze_policy_resources
-from policy_whisperer.templates import get_policy_types, POLICY_STRUCTURE
+from policy_whisperer.generator import (
+    generate_policy_explanation,
+    stream_policy_from_prompt,
+    GeneratedPolicy,
+    run_generation_pipeline,
+    POLICY_MODEL,
+    POLICY_TEMPERATURE,
+    EXPLANATION_MODEL,
+    EXPLANATION_TEMPERATURE
+)
+from policy_whisperer.fast_path import generate_fast_path_policy
+from policy_whisperer.policy_parser import analyze_policy_resources
+from policy_whisperer.utils import suggest_policy_path
+from policy_whisperer.response_cache import get_response_cache
+from policy_whisperer.llm_client import start_llm_client_warmup
+from policy_whisperer.jobs import get_job_manager, public_job, QueueFullError
+from policy_whisperer.batch import read_batch_items, run_batch, BATCH_CONCURRENCY, BATCH_MAX_ITEMS
+from policy_whisperer.permissions import build_permission_graph, get_permission_graph, set_permission_graph, POLICY_GRAPH_DIR
+from policy_whisperer.templates import get_policy_types, start_template_cache_warmup
+from policy_whisperer.metrics import METRICS_ENABLED, finish_request, render_prometheus, start_request
+from policy_whisperer.logging_setup import LOG_LEVEL, configure_logging
 
 # Get debug mode from environment variable or default to False
 debug_mode = os.getenv('DEBUG', 'False').lower() == 'true'
 
-# Configure app logging
-logging.basicConfig(
-    level=logging.DEBUG if debug_mode else logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('app.log')
-    ]
-)
+# Configure app logging: records are written by a background thread (see logging_setup)
+configure_logging()
 logger = logging.getLogger(__name__)
-
-# Configure module-specific loggers
-if debug_mode:
-    # Set specific loggers to DEBUG level
-    logging.getLogger('policy_whisperer').setLevel(logging.DEBUG)
-    logging.getLogger('langchain').setLevel(logging.DEBUG)
-    logger.debug("Debug logging enabled")
-else:
-    # Set specific loggers to INFO level
-    logging.getLogger('policy_whisperer').setLevel(logging.INFO)
-    logging.getLogger('langchain').setLevel(logging.INFO)
-    logger.info("Running with INFO level logging")
+logger.info(f"Running with {LOG_LEVEL} level logging")
 
 app = Flask(__name__)
 CORS(app)
 
+# Fill the persistent template cache in the background so the first requests don't have to
+start_template_cache_warmup()
+
+# Create the LLM clients and connect to the LLM endpoint before the first request
+start_llm_client_warmup([(POLICY_MODEL, POLICY_TEMPERATURE), (EXPLANATION_MODEL, EXPLANATION_TEMPERATURE)])
+
+if METRICS_ENABLED:
+    def request_endpoint():
+        """Label requests by route rather than path to keep the number of series bounded"""
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = start_request(request_endpoint())
+
+    @app.after_request
+    def record_response_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    # Runs after a streamed response has been sent
+    @app.teardown_request
+    def finish_request_metrics(exception=None):
+        if 'metrics_start' in g:
+            finish_request(request_endpoint(), request.method, g.get('metrics_status', 500), g.metrics_start)
+
+def format_sse_event(event, data):
+    """Format a server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -58,6 +89,7 @@ def generate_policy():
     policy_type = data.get('policy_type', 'general')
     target_path = data.get('target_path', '')
     repository = data.get('repository', '')
+    use_cache = not data.get('bypass_cache', False)
     
     # Log the incoming request
     logger.info(f"Received policy generation request")
@@ -67,43 +99,13 @@ def generate_policy():
     logger.info(f"Repository: {repository}")
     
     try:
-        # Generate the policy
-        policy_yaml = generate_policy_from_prompt(user_prompt, policy_type)
-        logger.info(f"Policy generated successfully")
-        
-        # Generate explanation
-        explanation = generate_policy_explanation(policy_yaml, user_prompt)
-        logger.info(f"Policy explanation generated successfully")
-        
-        # Analyze resources
-        resources = analyze_policy_resources(policy_yaml)
-        logger.info(f"Policy resources analyzed: {resources}")
-        
-        # Suggest a file path if not provided
-        suggested_path = target_path
-        if not suggested_path:
-            # Determine a suitable path based on policy content and type
-            if 'github' in user_prompt.lower() or 'actions' in user_prompt.lower():
-                suggested_path = 'policies/ci/github-actions.yml'
-            elif 'aws' in user_prompt.lower():
-                suggested_path = 'policies/cloud/aws.yml'
-            elif 'azure' in user_prompt.lower():
-                suggested_path = 'policies/cloud/azure.yml'
-            elif 'authn' in user_prompt.lower() or 'authentication' in user_prompt.lower():
-                suggested_path = 'policies/authn/authn.yml'
-            elif 'jwt' in user_prompt.lower():
-                suggested_path = 'policies/authn/authn-jwt.yml'
-            else:
-                suggested_path = 'policies/general/policy.yml'
-        
-        return jsonify({
-            'success': True,
-            'policy': policy_yaml,
-            'explanation': explanation,
-            'resources': resources,
-            'suggested_path': suggested_path,
-            'repository': repository
-        })
+        return jsonify(run_generation_pipeline(
+            user_prompt,
+            policy_type,
+            target_path=target_path,
+            repository=repository,
+            use_cache=use_cache
+        ))
     except Exception as e:
         error_msg = f"Error in policy generation: {str(e)}"
         logger.error(error_msg)
@@ -113,6 +115,195 @@ def generate_policy():
             'error': str(e)
         }), 500
 
+@app.route('/api/generate-policy/stream', methods=['POST'])
+def generate_policy_stream():
+    """
+    Stream a policy generation as server-sent events.
+    
+    Events, in order:
+    - policy_chunk: {"text": ...} for every piece of YAML produced by the LLM
+    - policy: {"policy": ..., "suggested_path": ..., "repository": ..., "generation_path": ...} once generation finishes
+    - resources: the analyze_policy_resources counts
+    - explanation: {"explanation": ...}
+    - done: {"success": true}
+    - error: {"error": ...} if anything fails, after which the stream ends
+    """
+    data = request.json
+    user_prompt = data.get('prompt', '')
+    policy_type = data.get('policy_type', 'general')
+    target_path = data.get('target_path', '')
+    repository = data.get('repository', '')
+    use_cache = not data.get('bypass_cache', False)
+    
+    logger.info(f"Received streaming policy generation request")
+    logger.info(f"User prompt: {user_prompt}")
+    logger.info(f"Policy type: {policy_type}")
+    
+    def generate_events():
+        try:
+            # Common requests are answered by the rule-based generator in a single chunk
+            fast_path = generate_fast_path_policy(user_prompt)
+            if fast_path is not None:
+                policy_yaml = fast_path['policy']
+                yield format_sse_event('policy_chunk', {'text': policy_yaml})
+            else:
+                # Send the policy to the client as it is generated, the stream ends with the cleaned policy
+                for chunk in stream_policy_from_prompt(user_prompt, policy_type, use_cache=use_cache):
+                    if isinstance(chunk, GeneratedPolicy):
+                        policy_yaml = chunk.policy
+                    else:
+                        yield format_sse_event('policy_chunk', {'text': chunk})
+            
+            logger.info(f"Policy streamed successfully")
+            yield format_sse_event('policy', {
+                'policy': policy_yaml,
+                'suggested_path': suggest_policy_path(user_prompt, target_path),
+                'repository': repository,
+                'generation_path': 'fast' if fast_path is not None else 'llm',
+                'fast_path_rule': fast_path['rule'] if fast_path is not None else None
+            })
+            
+            if fast_path is not None:
+                yield format_sse_event('resources', analyze_policy_resources(policy_yaml))
+                yield format_sse_event('explanation', {'explanation': fast_path['explanation']})
+                yield format_sse_event('done', {'success': True})
+                return
+            
+            # Start the explanation in the background while the resources are analyzed
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                explanation_future = executor.submit(generate_policy_explanation, policy_yaml, user_prompt, use_cache)
+                
+                resources = analyze_policy_resources(policy_yaml)
+                logger.info(f"Policy resources analyzed: {resources}")
+                yield format_sse_event('resources', resources)
+                
+                explanation = explanation_future.result()
+                logger.info(f"Policy explanation generated successfully")
+                yield format_sse_event('explanation', {'explanation': explanation})
+            
+            yield format_sse_event('done', {'success': True})
+        except Exception as e:
+            logger.error(f"Error in streaming policy generation: {str(e)}")
+            logger.exception("Exception details:")
+            yield format_sse_event('error', {'error': str(e)})
+    
+    return Response(
+        stream_with_context(generate_events()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # Disable response buffering in nginx so chunks reach the client immediately
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+@app.route('/api/jobs/generate-policy', methods=['POST'])
+def submit_generate_policy_job():
+    """
+    Queue a policy generation and return its job id immediately.
+    
+    Takes the same parameters as /api/generate-policy. Identical requests that are
+    already queued or running return the existing job.
+    """
+    data = request.json
+    params = {
+        'user_prompt': data.get('prompt', ''),
+        'policy_type': data.get('policy_type', 'general'),
+        'target_path': data.get('target_path', ''),
+        'repository': data.get('repository', ''),
+        'use_cache': not data.get('bypass_cache', False)
+    }
+    
+    logger.info(f"Received policy generation job request")
+    logger.info(f"User prompt: {params['user_prompt']}")
+    
+    try:
+        job = get_job_manager().submit('generate-policy', params, run_generation_pipeline)
+    except QueueFullError as e:
+        logger.warning(f"Rejecting policy generation job: {str(e)}")
+        response = jsonify({
+            'success': False,
+            'error': str(e)
+        })
+        response.headers['Retry-After'] = '5'
+        return response, 429
+    
+    return jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'status_url': f"/api/jobs/{job['id']}"
+    }), 202
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """
+    Return the status and result of a job.
+    
+    Pass ?wait=<seconds> (up to 60) to long-poll until the job finishes.
+    """
+    try:
+        wait = min(float(request.args.get('wait', 0)), 60)
+    except ValueError:
+        wait = 0
+    
+    job = get_job_manager().get(job_id, wait=wait)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': f"Job not found: {job_id}"
+        }), 404
+    
+    return jsonify({
+        'success': True,
+        'job': public_job(job)
+    })
+
+@app.route('/api/generate-policies', methods=['POST'])
+def generate_policies():
+    """
+    Generate policies for a batch of prompts, streaming one JSON line per item as it completes.
+
+    The body is JSONL (one request per line, as in the batch CLI) or a JSON object
+    with a "requests" list. Optional ?concurrency= limits parallel generations.
+    """
+    if request.is_json:
+        body = request.get_json(silent=True)
+        records = body.get('requests', []) if isinstance(body, dict) else None
+        if not isinstance(records, list):
+            return jsonify({
+                'success': False,
+                'error': 'Body must be a JSON object with a "requests" list'
+            }), 400
+        lines = [json.dumps(record) for record in records]
+    else:
+        lines = request.get_data(as_text=True).splitlines()
+
+    items = read_batch_items(lines)
+    if not items:
+        return jsonify({
+            'success': False,
+            'error': 'No requests in batch'
+        }), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({
+            'success': False,
+            'error': f"Batch has {len(items)} requests, the limit is {BATCH_MAX_ITEMS}"
+        }), 413
+
+    concurrency = min(request.args.get('concurrency', BATCH_CONCURRENCY, type=int), BATCH_CONCURRENCY)
+    logger.info(f"Received batch policy generation request with {len(items)} items")
+
+    def generate_lines():
+        for result in run_batch(items, concurrency=concurrency):
+            yield json.dumps(result) + '\n'
+
+    return Response(
+        stream_with_context(generate_lines()),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/create-pr', methods=['POST'])
 def create_pull_request():
     """Create a pull request with the generated policy"""
@@ -224,6 +415,115 @@ def create_pull_request():
             'error': str(e)
         }), 500
 
+@app.route('/api/permissions/index', methods=['POST'])
+def index_permissions():
+    """
+    Build the permission graph used by the /api/permissions queries.
+
+    The body may contain a "policies" object mapping names to policy texts;
+    without it the graph is rebuilt from POLICY_GRAPH_DIR.
+    """
+    data = request.get_json(silent=True) or {}
+    policies = data.get('policies')
+    if not policies and not POLICY_GRAPH_DIR:
+        return jsonify({
+            'success': False,
+            'error': 'No policies given and POLICY_GRAPH_DIR is not set'
+        }), 400
+
+    try:
+        if policies:
+            graph = build_permission_graph(policies=policies)
+        else:
+            graph = build_permission_graph([POLICY_GRAPH_DIR])
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
+    set_permission_graph(graph)
+    return jsonify({
+        'success': True,
+        'stats': graph.stats()
+    })
+
+def query_permission_graph(query):
+    """Run a query against the permission graph and format the response"""
+    graph = get_permission_graph()
+    if graph is None:
+        return jsonify({
+            'success': False,
+            'error': 'No policies indexed, POST to /api/permissions/index first'
+        }), 503
+
+    start = time.perf_counter()
+    try:
+        result = query(graph)
+    except KeyError as e:
+        return jsonify({
+            'success': False,
+            'error': e.args[0]
+        }), 404
+    result.update({
+        'success': True,
+        'lookup_ms': round((time.perf_counter() - start) * 1000, 3)
+    })
+    return jsonify(result)
+
+@app.route('/api/permissions')
+def role_permissions():
+    """What a role can do: ?role=host:app/ci[&privilege=read]"""
+    role = request.args.get('role')
+    if not role:
+        return jsonify({'success': False, 'error': 'Missing role'}), 400
+    privilege = request.args.get('privilege')
+    return query_permission_graph(lambda graph: {
+        'role': role,
+        'memberships': graph.memberships(role),
+        'permissions': graph.permissions(role, privilege)
+    })
+
+@app.route('/api/permissions/authorized-roles')
+def authorized_roles():
+    """Who can do something: ?resource=webservice:conjur/authn-jwt/github&privilege=authenticate"""
+    resource = request.args.get('resource')
+    privilege = request.args.get('privilege')
+    if not resource or not privilege:
+        return jsonify({'success': False, 'error': 'Missing resource or privilege'}), 400
+    return query_permission_graph(lambda graph: {
+        'resource': resource,
+        'privilege': privilege,
+        'roles': graph.authorized_roles(resource, privilege)
+    })
+
+@app.route('/api/permissions/check')
+def check_permission():
+    """Whether a role has a privilege: ?role=...&privilege=...&resource=..."""
+    role = request.args.get('role')
+    privilege = request.args.get('privilege')
+    resource = request.args.get('resource')
+    if not role or not privilege or not resource:
+        return jsonify({'success': False, 'error': 'Missing role, privilege or resource'}), 400
+    return query_permission_graph(lambda graph: {
+        'allowed': graph.is_allowed(role, privilege, resource)
+    })
+
+@app.route('/api/cache/stats')
+def cache_stats():
+    """Return response cache hit/miss statistics"""
+    cache = get_response_cache()
+    return jsonify({
+        'success': True,
+        'enabled': cache.enabled,
+        'stats': cache.stats()
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Stage timings, LLM token counts, cache and request metrics in the Prometheus text format"""
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/health')
 def health_check():
     """Simple health check endpoint"""
@@ -0,0 +1,163 @@
+"""
+Async serving mode for Policy Whisperer
+
+Policy generation endpoints are served by async handlers, so a single worker can
+hold hundreds of in-flight generations while they wait on the LLM and the policy
+repository. Every other route is delegated to the Flask app in app.py.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import logging
+
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route, request_response
+
+from app import app as flask_app, format_sse_event
+from policy_whisperer.generator import (
+    agenerate_policy_explanation,
+    arun_generation_pipeline,
+    astream_policy_from_prompt,
+    GeneratedPolicy
+)
+from policy_whisperer.fast_path import generate_fast_path_policy
+from policy_whisperer.policy_parser import analyze_policy_resources
+from policy_whisperer.utils import suggest_policy_path
+from policy_whisperer.metrics import MetricsMiddleware
+
+logger = logging.getLogger(__name__)
+
+async def read_json_body(request) -> dict:
+    """
+    Return the JSON object of a request body
+
+    Raises:
+        ValueError: If the body isn't a JSON object
+    """
+    try:
+        data = await request.json()
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON body: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("Body must be a JSON object")
+    return data
+
+def bad_request(error: ValueError) -> JSONResponse:
+    logger.warning(f"Rejected policy generation request: {error}")
+    return JSONResponse({
+        'success': False,
+        'error': str(error)
+    }, status_code=400)
+
+async def generate_policy(request):
+    """Async version of the /api/generate-policy endpoint, with the same JSON contract"""
+    try:
+        data = await read_json_body(request)
+    except ValueError as e:
+        return bad_request(e)
+    user_prompt = data.get('prompt', '')
+    policy_type = data.get('policy_type', 'general')
+    target_path = data.get('target_path', '')
+    repository = data.get('repository', '')
+    use_cache = not data.get('bypass_cache', False)
+
+    logger.info(f"Received async policy generation request")
+    logger.info(f"User prompt: {user_prompt}")
+    logger.info(f"Policy type: {policy_type}")
+
+    try:
+        return JSONResponse(await arun_generation_pipeline(
+            user_prompt,
+            policy_type,
+            target_path=target_path,
+            repository=repository,
+            use_cache=use_cache
+        ))
+    except Exception as e:
+        logger.error(f"Error in policy generation: {str(e)}")
+        logger.exception("Exception details:")
+        return JSONResponse({
+            'success': False,
+            'error': str(e)
+        }, status_code=500)
+
+async def generate_policy_stream(request):
+    """Async version of the /api/generate-policy/stream endpoint, with the same events"""
+    try:
+        data = await read_json_body(request)
+    except ValueError as e:
+        return bad_request(e)
+    user_prompt = data.get('prompt', '')
+    policy_type = data.get('policy_type', 'general')
+    target_path = data.get('target_path', '')
+    repository = data.get('repository', '')
+    use_cache = not data.get('bypass_cache', False)
+
+    logger.info(f"Received async streaming policy generation request")
+    logger.info(f"User prompt: {user_prompt}")
+
+    async def generate_events():
+        try:
+            fast_path = generate_fast_path_policy(user_prompt)
+            if fast_path is not None:
+                policy_yaml = fast_path['policy']
+                yield format_sse_event('policy_chunk', {'text': policy_yaml})
+            else:
+                async for chunk in astream_policy_from_prompt(user_prompt, policy_type, use_cache=use_cache):
+                    if isinstance(chunk, GeneratedPolicy):
+                        policy_yaml = chunk.policy
+                    else:
+                        yield format_sse_event('policy_chunk', {'text': chunk})
+
+            yield format_sse_event('policy', {
+                'policy': policy_yaml,
+                'suggested_path': suggest_policy_path(user_prompt, target_path),
+                'repository': repository,
+                'generation_path': 'fast' if fast_path is not None else 'llm',
+                'fast_path_rule': fast_path['rule'] if fast_path is not None else None
+            })
+
+            if fast_path is not None:
+                yield format_sse_event('resources', analyze_policy_resources(policy_yaml))
+                yield format_sse_event('explanation', {'explanation': fast_path['explanation']})
+                yield format_sse_event('done', {'success': True})
+                return
+
+            # Start the explanation while the resources are analyzed
+            explanation_task = asyncio.ensure_future(agenerate_policy_explanation(policy_yaml, user_prompt, use_cache))
+            try:
+                yield format_sse_event('resources', analyze_policy_resources(policy_yaml))
+                yield format_sse_event('explanation', {'explanation': await explanation_task})
+            finally:
+                # Don't leave the explanation running if the client went away
+                explanation_task.cancel()
+
+            yield format_sse_event('done', {'success': True})
+        except Exception as e:
+            logger.error(f"Error in streaming policy generation: {str(e)}")
+            logger.exception("Exception details:")
+            yield format_sse_event('error', {'error': str(e)})
+
+    return StreamingResponse(
+        generate_events(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+app = Starlette(routes=[
+    # Requests served by the Flask app are measured by the Flask app itself
+    Route('/api/generate-policy', MetricsMiddleware(request_response(generate_policy), '/api/generate-policy'),
+          methods=['POST']),
+    Route('/api/generate-policy/stream',
+          MetricsMiddleware(request_response(generate_policy_stream), '/api/generate-policy/stream'),
+          methods=['POST']),
+    # Everything else is served by the Flask app
+    Mount('/', app=WSGIMiddleware(flask_app))
+])
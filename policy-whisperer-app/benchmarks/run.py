@@ -0,0 +1,293 @@
+"""
+Benchmark suite for Policy Whisperer
+
+Runs the generation pipeline and its building blocks against a fake chat model,
+a local template server and a local GitHub API stub, at several concurrency
+levels, and reports latency percentiles and throughput as JSON. The dry-run
+benchmark validates a set of policy files against a local Conjur stub, as one
+CI run does. The cold-start benchmark times a new interpreter importing the
+app, as a new worker does.
+
+Usage (from policy-whisperer-app):
+    python -m benchmarks.run --concurrency 1,4,16 --iterations 50 --llm-latency 0.5 -o results.json
+    python -m benchmarks.run --compare baseline.json -o results.json
+    python -m benchmarks.run --llm-server --llm-failure-rate 0.05 --benchmarks generate-policy
+    python -m benchmarks.run --benchmarks cold-start --concurrency 1 --iterations 10
+    python -m benchmarks.run --benchmarks dry-run --concurrency 1 --iterations 5 --dry-run-files 60 --conjur-latency 0.3
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import logging
+import platform
+import itertools
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List
+
+from benchmarks.stubs import (ConjurHandler, GitHubHandler, OpenAIHandler, TemplateHandler, FAKE_POLICY,
+                              install_fake_llm, start_stub_server)
+
+BENCHMARKS = ["generate-policy", "identify-relevant-examples", "analyze-policy-resources",
+              "validate-policy", "create-github-pr", "dry-run", "cold-start"]
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Prompts that don't match a fast path rule, so /api/generate-policy calls the LLM
+PROMPTS = [
+    "A web application that needs to read its database password",
+    "Let the billing service hosts fetch the payment gateway API key",
+    "Give the reporting team read access to the warehouse credentials",
+    "Create a policy for the inventory app with two hosts and a secret",
+]
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[rank - 1]
+
+def measure(operation: Callable[[int], Any], concurrency: int, iterations: int) -> Dict[str, Any]:
+    """
+    Call operation(i) iterations times from concurrency threads
+
+    Returns:
+        Latency percentiles in milliseconds, throughput and error count
+    """
+    def timed(i: int):
+        start = time.perf_counter()
+        try:
+            operation(i)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, str(e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(iterations)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(duration * 1000 for duration, _ in results)
+    errors = [error for _, error in results if error]
+    return {
+        "concurrency": concurrency,
+        "iterations": iterations,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(latencies[-1], 3),
+        "throughput_per_s": round(iterations / elapsed, 2),
+    }
+
+def build_operations(conjur_url: str, policy_files: List[str],
+                     dry_run_concurrency: int) -> Dict[str, Callable[[int], Any]]:
+    """
+    Return the benchmarked operations. Must be called after the environment is set up.
+    """
+    import app as app_module
+    from policy_whisperer.dry_run import ConjurClient, dry_run_policy_files
+    from policy_whisperer.example_selector import identify_relevant_examples
+    from policy_whisperer.github_integration import create_github_pr
+    from policy_whisperer.policy_parser import analyze_policy_resources
+    from policy_whisperer.validator import validate_policy
+
+    client = app_module.app.test_client()
+
+    def generate_policy(i: int):
+        response = client.post("/api/generate-policy", json={
+            "prompt": PROMPTS[i % len(PROMPTS)],
+            "bypass_cache": True
+        })
+        data = response.get_json()
+        if response.status_code != 200 or not data.get("success"):
+            raise RuntimeError(data.get("error", f"HTTP {response.status_code}"))
+
+    # Parse results are cached by policy text, so make every policy unique
+    unique = itertools.count()
+
+    def create_pr(i: int):
+        # Use a new branch every time, as the app does
+        result = create_github_pr("benchmark", "policies", FAKE_POLICY, f"policies/app{i}.yml", "token",
+                                  branch_name=f"benchmark-{next(unique)}")
+        if not result["success"]:
+            raise RuntimeError(result["error"])
+
+    def dry_run(i: int):
+        # One CI run: a new client, so a new authentication, validating every file
+        client = ConjurClient(conjur_url, "benchmark", "github", concurrency=dry_run_concurrency)
+        results = dry_run_policy_files(client, policy_files, concurrency=dry_run_concurrency)
+        failed = [result for result in results if not result["success"]]
+        if failed:
+            raise RuntimeError(f"{failed[0]['file']}: {failed[0]['output']}")
+
+    def cold_start(i: int):
+        # Time to start a new worker: a fresh interpreter importing the app
+        subprocess.run([sys.executable, "-c", "import app"], cwd=APP_DIR, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return {
+        "generate-policy": generate_policy,
+        "identify-relevant-examples": lambda i: identify_relevant_examples(PROMPTS[i % len(PROMPTS)]),
+        "analyze-policy-resources": lambda i: analyze_policy_resources(f"{FAKE_POLICY}# {next(unique)}\n"),
+        "validate-policy": lambda i: validate_policy(f"{FAKE_POLICY}# {next(unique)}\n"),
+        "create-github-pr": create_pr,
+        "dry-run": dry_run,
+        "cold-start": cold_start,
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ""
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """
+    Describe the change of p50, p95 and throughput against a baseline run
+    """
+    previous = {(r["benchmark"], r["concurrency"]): r for r in baseline.get("results", [])}
+    lines = []
+    for result in results["results"]:
+        before = previous.get((result["benchmark"], result["concurrency"]))
+        if before is None:
+            continue
+        changes = []
+        for metric in ("p50_ms", "p95_ms", "throughput_per_s"):
+            if before[metric]:
+                changes.append(f"{metric} {(result[metric] - before[metric]) / before[metric] * 100:+.1f}%")
+        lines.append(f"{result['benchmark']} @ {result['concurrency']}: {', '.join(changes)}")
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Policy Whisperer with stubbed external services")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help="Comma separated benchmarks to run")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated concurrency levels")
+    parser.add_argument("--iterations", type=int, default=50, help="Calls per benchmark and concurrency level")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds before the fake LLM responds")
+    parser.add_argument("--llm-token-latency", type=float, default=0.0, help="Seconds per streamed line")
+    parser.add_argument("--template-latency", type=float, default=0.05, help="Template server latency in seconds")
+    parser.add_argument("--github-latency", type=float, default=0.05, help="GitHub API stub latency in seconds")
+    parser.add_argument("--github-rate-limit-rate", type=float, default=0.0,
+                        help="Share of GitHub API stub requests answered with a secondary rate limit")
+    parser.add_argument("--llm-server", action="store_true",
+                        help="Serve the LLM from an OpenAI-compatible stub through the real clients and dispatch layer")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0, help="Share of failed LLM stub requests")
+    parser.add_argument("--conjur-latency", type=float, default=0.05, help="Conjur stub latency in seconds")
+    parser.add_argument("--conjur-token-ttl", type=float, default=480.0,
+                        help="Seconds before the Conjur stub rejects a session token with 401")
+    parser.add_argument("--dry-run-files", type=int, default=20, help="Policy files validated per dry-run")
+    parser.add_argument("--dry-run-concurrency", type=int, default=8, help="Concurrent dry-runs per run")
+    parser.add_argument("-o", "--output", help="Write the results to this file (default: stdout)")
+    parser.add_argument("--compare", help="Previous results file to compare against")
+    args = parser.parse_args(argv)
+
+    selected = [name for name in args.benchmarks.split(",") if name]
+    unknown = set(selected) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    template_server, template_url = start_stub_server(TemplateHandler, args.template_latency)
+    github_server, github_url = start_stub_server(GitHubHandler, args.github_latency,
+                                                  rate_limit_rate=args.github_rate_limit_rate)
+    conjur_server, conjur_url = start_stub_server(ConjurHandler, args.conjur_latency, token_ttl=args.conjur_token_ttl)
+    servers = [template_server, github_server, conjur_server]
+    if args.llm_server:
+        llm_server, llm_url = start_stub_server(OpenAIHandler, args.llm_latency, failure_rate=args.llm_failure_rate)
+        servers.append(llm_server)
+        os.environ["OPENAI_API_BASE"] = f"{llm_url}/v1"
+    workdir = tempfile.mkdtemp(prefix="policy-whisperer-bench-")
+    policy_files = []
+    for i in range(args.dry_run_files):
+        policy_files.append(os.path.join(workdir, f"policy-{i}.yml"))
+        with open(policy_files[-1], "w") as f:
+            f.write(FAKE_POLICY)
+
+    # Settings are read at import time, so set them before importing the app
+    os.environ.update({
+        "POLICY_REPO_BASE_URL": template_url,
+        "GITHUB_API_URL": github_url,
+        "TEMPLATE_CACHE_PATH": os.path.join(workdir, "template_cache.db"),
+        "TEMPLATE_CACHE_WARMUP": "false",
+        "LLM_CLIENT_WARMUP": "false",
+        "RESPONSE_CACHE_BACKEND": "none",
+        "OPENAI_API_TYPE": "openai",
+        "LLM_PROVIDERS": "openai",
+        "OPENAI_API_KEY": "benchmark",
+        "JWT_TOKEN": "benchmark",
+    })
+    operations = build_operations(conjur_url, policy_files, args.dry_run_concurrency)
+    if not args.llm_server:
+        install_fake_llm(args.llm_latency, args.llm_token_latency)
+    logging.disable(logging.CRITICAL)
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "iterations": args.iterations,
+            "llm_latency": args.llm_latency,
+            "llm_token_latency": args.llm_token_latency,
+            "template_latency": args.template_latency,
+            "github_latency": args.github_latency,
+            "github_rate_limit_rate": args.github_rate_limit_rate,
+            "llm_server": args.llm_server,
+            "llm_failure_rate": args.llm_failure_rate,
+            "conjur_latency": args.conjur_latency,
+            "conjur_token_ttl": args.conjur_token_ttl,
+            "dry_run_files": args.dry_run_files,
+            "dry_run_concurrency": args.dry_run_concurrency,
+        },
+        "results": [],
+    }
+    try:
+        for name in selected:
+            for concurrency in levels:
+                GitHubHandler.calls.clear()
+                ConjurHandler.calls.clear()
+                result = dict(benchmark=name, **measure(operations[name], concurrency, args.iterations))
+                if name == "create-github-pr":
+                    result["github_calls_per_pr"] = round(sum(GitHubHandler.calls.values()) / args.iterations, 2)
+                if name == "dry-run":
+                    result["authentications_per_run"] = round(ConjurHandler.calls["authenticate"] / args.iterations, 2)
+                    result["rejected_tokens_per_run"] = round(ConjurHandler.calls["dry-run rejected"] / args.iterations, 2)
+                results["results"].append(result)
+                print(f"{name:28} c={concurrency:<3} p50={result['p50_ms']:>9.2f}ms p95={result['p95_ms']:>9.2f}ms "
+                      f"p99={result['p99_ms']:>9.2f}ms {result['throughput_per_s']:>9.2f}/s errors={result['errors']}"
+                      + (f" calls={result['github_calls_per_pr']}" if "github_calls_per_pr" in result else "")
+                      + (f" authentications={result['authentications_per_run']}"
+                         f" rejected={result['rejected_tokens_per_run']}" if "authentications_per_run" in result else ""),
+                      file=sys.stderr)
+    finally:
+        for server in servers:
+            server.shutdown()
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            results["comparison"] = compare(results, json.load(f))
+        for line in results["comparison"]:
+            print(line, file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+"""
+Stand-ins for the external services used by Policy Whisperer
+
+A deterministic fake chat model replaces the OpenAI/Azure models, and local HTTP
+servers stand in for the policy templates repository, the GitHub API and Conjur. Each
+takes a simulated latency so benchmarks see realistic waiting times without
+any network access. An OpenAI-compatible server can also stand in for the LLM,
+to exercise the real clients and the dispatch layer.
+"""
+
+import json
+import time
+import zlib
+import uuid
+import base64
+import random
+import asyncio
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, AsyncIterator, Iterator, List, Optional, Tuple
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+FAKE_POLICY = """- !policy
+  id: benchmark-app
+  body:
+  - !group consumers
+  - !layer hosts
+  - !host app-1
+  - !host app-2
+  - !variable db/password
+  - !variable api/key
+  - !grant
+    role: !layer hosts
+    members: [!host app-1, !host app-2]
+  - !grant
+    role: !group consumers
+    member: !layer hosts
+  - !permit
+    role: !group consumers
+    privileges: [read, execute]
+    resources: [!variable db/password, !variable api/key]
+"""
+
+FAKE_EXPLANATION = """## Summary
+Creates the benchmark-app policy with two hosts that can read its secrets.
+
+## Resources
+- A `consumers` group and a `hosts` layer
+- Two hosts and two variables
+
+## Permissions
+Hosts in the layer can read and execute the database password and API key.
+"""
+
+FAKE_RANKING = json.dumps([
+    {"category": "secrets", "file_name": "secrets", "relevance_score": 90, "reason": "Benchmark"}
+])
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model that returns a fixed response after a simulated latency
+
+    latency is the time to the first token, token_latency the time between
+    streamed lines.
+    """
+    response: str
+    latency: float = 0.0
+    token_latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency + self.token_latency * self.response.count("\n"))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self.latency + self.token_latency * self.response.count("\n"))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for line in self.response.splitlines(keepends=True):
+            time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=line))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.latency)
+        for line in self.response.splitlines(keepends=True):
+            await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=line))
+
+def fake_response(temperature: float) -> str:
+    """
+    Pick the response by temperature: explanation, example ranking or policy
+    """
+    from policy_whisperer import generator
+
+    if temperature == generator.EXPLANATION_TEMPERATURE:
+        return FAKE_EXPLANATION
+    if temperature == 0.3:
+        return FAKE_RANKING
+    return FAKE_POLICY
+
+def install_fake_llm(latency: float = 0.0, token_latency: float = 0.0):
+    """
+    Replace get_llm everywhere it is used with one returning fake chat models.
+    The response is picked by temperature: explanation, example ranking or policy.
+    """
+    from policy_whisperer import example_selector, generator
+
+    def get_fake_llm(model_name: str = "gpt-4", temperature: float = 0.7, **kwargs) -> FakeChatModel:
+        return FakeChatModel(response=fake_response(temperature), latency=latency, token_latency=token_latency)
+
+    generator.get_llm = get_fake_llm
+    example_selector.get_llm = get_fake_llm
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't let keep-alive clients wait for a delayed ACK
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: Any, content_type: str = "application/json", headers: Optional[dict] = None):
+        payload = (body if isinstance(body, str) else json.dumps(body)).encode("utf-8")
+        time.sleep(self.latency)
+        try:
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up, e.g. a hedged or timed out request
+            pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+class TemplateHandler(_StubHandler):
+    """Serves the same policy for every template path"""
+
+    def do_GET(self):
+        self._send(200, FAKE_POLICY, content_type="text/plain")
+
+class GitHubHandler(_StubHandler):
+    """
+    Answers the GitHub API calls made by create_github_pr, counting them by method
+    and endpoint in calls. Repository and branch lookups carry an ETag and are
+    answered with 304 when it matches. rate_limit_rate is the share of requests
+    answered with a secondary rate limit error and a Retry-After of rate_limit_wait.
+    """
+    rate_limit_rate = 0.0
+    rate_limit_wait = 0
+    calls = Counter()
+    branches = set()
+    pull_numbers = iter(range(1, 1 << 30))
+    lock = threading.Lock()
+
+    def _endpoint(self) -> str:
+        path = self.path.split("?")[0]
+        parts = path.split("/")
+        # /repos/<owner>/<repo>/<endpoint>/...
+        return "/".join(parts[4:6]) if len(parts) > 4 else "repo"
+
+    def _limited(self) -> bool:
+        with self.lock:
+            self.calls[f"{self.command} {self._endpoint()}"] += 1
+        if random.random() >= self.rate_limit_rate:
+            return False
+        self._send(403, {"message": "You have exceeded a secondary rate limit."},
+                   headers={"Retry-After": str(self.rate_limit_wait)})
+        return True
+
+    def _send_etag(self, body: Any):
+        etag = f'"{zlib.crc32(json.dumps(body, sort_keys=True).encode("utf-8")):x}"'
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, "", headers={"ETag": etag})
+        else:
+            self._send(200, body, headers={"ETag": etag, "X-RateLimit-Remaining": "4999"})
+
+    def do_GET(self):
+        if self._limited():
+            return
+        endpoint = self._endpoint()
+        if endpoint.startswith("branches/"):
+            self._send_etag({"name": endpoint.split("/", 1)[1],
+                             "commit": {"sha": "0" * 40, "commit": {"tree": {"sha": "4" * 40}}}})
+        elif endpoint == "pulls":
+            self._send(200, [])
+        elif endpoint == "repo":
+            self._send_etag({"default_branch": "main"})
+        else:
+            self._send(404, {"message": "Not Found"})
+
+    def do_POST(self):
+        body = json.loads(self._read_body() or b"{}")
+        if self._limited():
+            return
+        endpoint = self._endpoint()
+        if endpoint == "git/refs":
+            ref = body.get("ref")
+            with self.lock:
+                exists = ref in self.branches
+                self.branches.add(ref)
+            if exists:
+                self._send(422, {"message": "Reference already exists"})
+            else:
+                self._send(201, {"ref": ref, "object": {"sha": "1" * 40}})
+        elif endpoint == "git/trees":
+            self._send(201, {"sha": "5" * 40})
+        elif endpoint == "git/commits":
+            self._send(201, {"sha": "3" * 40})
+        elif endpoint == "pulls":
+            with self.lock:
+                number = next(self.pull_numbers)
+            self._send(201, {"number": number, "html_url": f"https://github.invalid/pull/{number}"})
+        else:
+            self._send(404, {"message": "Not Found"})
+
+    def do_PATCH(self):
+        self._read_body()
+        if self._limited():
+            return
+        self._send(200, {"object": {"sha": "3" * 40}})
+
+class ConjurHandler(_StubHandler):
+    """
+    Answers the Conjur calls made by dry_run: JWT authentication and policy
+    dry-runs, counting them by endpoint in calls. Session tokens are rejected
+    with 401 token_ttl seconds after they were issued, like Conjur's 8 minute
+    tokens. Dry-runs of policies without a Conjur tag are answered with 422.
+    """
+    token_ttl = 480.0
+    calls = Counter()
+    tokens = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self._read_body()
+        parts = self.path.split("?")[0].split("/")
+        if len(parts) == 5 and parts[1] == "authn-jwt" and parts[4] == "authenticate":
+            self._authenticate(body)
+        elif len(parts) >= 5 and parts[1] == "policies" and "dryRun=true" in self.path:
+            self._dry_run(body)
+        else:
+            self._send(404, {"error": {"message": "Not Found"}})
+
+    def _authenticate(self, body: bytes):
+        with self.lock:
+            self.calls["authenticate"] += 1
+        if not body.startswith(b"jwt=") or len(body) == 4:
+            self._send(401, "Unauthorized", content_type="text/plain")
+            return
+        token = base64.b64encode(json.dumps({"protected": "stub", "payload": uuid.uuid4().hex}).encode()).decode()
+        with self.lock:
+            self.tokens[token] = time.monotonic()
+        self._send(200, token, content_type="text/plain")
+
+    def _dry_run(self, body: bytes):
+        token = self.headers.get("Authorization", "")[len('Token token="'):-1]
+        with self.lock:
+            issued = self.tokens.get(token)
+            valid = issued is not None and time.monotonic() - issued < self.token_ttl
+            self.calls["dry-run" if valid else "dry-run rejected"] += 1
+        if not valid:
+            self._send(401, "Unauthorized", content_type="text/plain")
+        elif b"- !" not in body:
+            self._send(422, {"status": "Invalid YAML", "errors": [{"line": 1, "column": 1,
+                                                                    "message": "no Conjur records found"}]})
+        else:
+            self._send(200, {"status": "Valid YAML", "created": {"items": []}, "updated": {"before": {"items": []},
+                             "after": {"items": []}}, "deleted": {"items": []}})
+
+class OpenAIHandler(_StubHandler):
+    """
+    Answers chat completion requests like the OpenAI and Azure OpenAI APIs.
+    failure_rate is the share of requests answered with a 500 error, and
+    slow_rate the share taking slow_latency instead of latency.
+    """
+    failure_rate = 0.0
+    slow_rate = 0.0
+    slow_latency = 0.0
+
+    def do_GET(self):
+        self._send(200, {"data": []})
+
+    def do_POST(self):
+        body = json.loads(self._read_body() or b"{}")
+        if not self.path.split("?")[0].endswith("/chat/completions"):
+            self._send(404, {"error": {"message": "Not Found"}})
+            return
+        if random.random() < self.failure_rate:
+            self._send(500, {"error": {"message": "Simulated failure", "type": "server_error"}})
+            return
+        if random.random() < self.slow_rate:
+            time.sleep(self.slow_latency - self.latency)
+
+        content = fake_response(body.get("temperature", 0.7))
+        completion = {
+            "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "usage": {"prompt_tokens": sum(len(m.get("content", "").split()) for m in body.get("messages", [])),
+                      "completion_tokens": len(content.split()), "total_tokens": 0}
+        }
+        if not body.get("stream"):
+            completion["choices"] = [{"index": 0, "finish_reason": "stop",
+                                      "message": {"role": "assistant", "content": content}}]
+            self._send(200, completion)
+            return
+
+        events = []
+        for line in content.splitlines(keepends=True):
+            chunk = dict(completion, object="chat.completion.chunk",
+                         choices=[{"index": 0, "finish_reason": None, "delta": {"content": line}}])
+            del chunk["usage"]
+            events.append(f"data: {json.dumps(chunk)}\n\n")
+        events.append("data: [DONE]\n\n")
+        self._send(200, "".join(events), content_type="text/event-stream")
+
+def start_stub_server(handler: type, latency: float = 0.0, **settings) -> Tuple[ThreadingHTTPServer, str]:
+    """
+    Start a stub server on a free local port in a daemon thread. settings
+    override other attributes of the handler.
+
+    Returns:
+        The server (call shutdown() to stop it) and its base URL
+    """
+    handler_class = type(handler.__name__, (handler,), dict(settings, latency=latency))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
@@ -0,0 +1,199 @@
+"""
+Batch policy generation for Policy Whisperer
+
+Generates many policies from a JSONL file of prompts with bounded parallelism.
+The examples of every prompt are ranked in parallel up front, their templates
+are fetched in one go and the rankings are passed on to generation, and
+identical prompts are generated only once.
+
+Each input line is a JSON object with either a "prompt" field (plus optional
+"id", "policy_type", "target_path" and "repository"), or "title"/"body" fields
+with an optional "request_id", which are joined into the prompt.
+
+Usage:
+    python -m policy_whisperer.batch prompts.jsonl -o results.jsonl --concurrency 4
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, Iterator, List
+
+from policy_whisperer.example_selector import collect_examples_content, identify_relevant_examples
+from policy_whisperer.generator import run_generation_pipeline
+from policy_whisperer.response_cache import normalize_prompt
+from policy_whisperer.templates import fetch_policy_templates
+
+logger = logging.getLogger(__name__)
+
+# Number of generations run concurrently in a batch
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+# Maximum number of items accepted in one batch by the API
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+
+# Input fields that must be strings when given
+STRING_FIELDS = ("prompt", "title", "body", "policy_type", "target_path", "repository")
+
+def parse_batch_item(record: Dict[str, Any], index: int) -> Dict[str, Any]:
+    """
+    Convert an input record to the parameters of a generation
+
+    Raises:
+        ValueError: If the record has no prompt or a field that isn't a string
+    """
+    for field in STRING_FIELDS:
+        if record.get(field) is not None and not isinstance(record[field], str):
+            raise ValueError(f"'{field}' must be a string")
+
+    prompt = record.get("prompt")
+    if not prompt and (record.get("title") or record.get("body")):
+        prompt = "\n\n".join(part for part in (record.get("title"), record.get("body")) if part)
+    if not prompt:
+        raise ValueError("Missing 'prompt' (or 'title'/'body')")
+
+    return {
+        "id": str(record.get("id") or record.get("request_id") or index),
+        "index": index,
+        "user_prompt": prompt,
+        "policy_type": record.get("policy_type", "general"),
+        "target_path": record.get("target_path", ""),
+        "repository": record.get("repository", ""),
+        "use_cache": not record.get("bypass_cache", False)
+    }
+
+def read_batch_items(lines: Iterable[str]) -> List[Dict[str, Any]]:
+    """
+    Parse JSONL lines into batch items. Blank lines are skipped; invalid lines
+    become items with an "error" that are reported as failed.
+    """
+    items = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        index = len(items)
+        try:
+            items.append(parse_batch_item(json.loads(line), index))
+        except (ValueError, AttributeError) as e:
+            items.append({"id": str(index), "index": index, "error": f"Invalid input line: {e}"})
+    return items
+
+def prefetch_batch_examples(items: List[Dict[str, Any]],
+                            concurrency: int = BATCH_CONCURRENCY) -> Dict[int, Dict[str, Dict[str, Any]]]:
+    """
+    Rank the examples of every item of a batch in parallel, then fetch all their
+    templates in one go
+
+    Returns:
+        The fetched examples of each item (as returned by fetch_relevant_examples) by item index
+    """
+    items = [item for item in items if "error" not in item]
+    if not items:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="policy-batch") as executor:
+        rankings = list(executor.map(lambda item: identify_relevant_examples(item["user_prompt"]), items))
+
+    templates = fetch_policy_templates([
+        (example["category"], example["file_name"]) for ranking in rankings for example in ranking
+    ], deadline=None)
+    logger.info(f"Prefetched {len(templates)} example templates for {len(items)} batch items")
+    return {item["index"]: collect_examples_content(ranking, templates) for item, ranking in zip(items, rankings)}
+
+def _generate(item: Dict[str, Any], relevant_examples: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    return run_generation_pipeline(
+        item["user_prompt"],
+        item["policy_type"],
+        target_path=item["target_path"],
+        repository=item["repository"],
+        use_cache=item["use_cache"],
+        relevant_examples=relevant_examples
+    )
+
+def run_batch(items: List[Dict[str, Any]], concurrency: int = BATCH_CONCURRENCY) -> Iterator[Dict[str, Any]]:
+    """
+    Generate the policies of a batch, yielding one result per item as it completes
+
+    Yields:
+        Dictionaries with the item id and index, a status of "succeeded" or "failed",
+        the result (same format as /api/generate-policy) or error, and the duration in seconds
+    """
+    started = time.time()
+
+    # Group identical requests so each one is generated only once
+    groups = {}
+    for item in items:
+        if "error" in item:
+            yield {"id": item["id"], "index": item["index"], "status": "failed", "error": item["error"], "duration": 0.0}
+            continue
+        key = json.dumps([
+            normalize_prompt(item["user_prompt"]), item["policy_type"], item["target_path"],
+            item["repository"], item["use_cache"]
+        ])
+        groups.setdefault(key, []).append(item)
+
+    examples = prefetch_batch_examples([group[0] for group in groups.values()], concurrency)
+
+    succeeded = failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="policy-batch") as executor:
+        futures = {}
+        for group in groups.values():
+            futures[executor.submit(_generate, group[0], examples[group[0]["index"]])] = (group, time.time())
+
+        for future in as_completed(futures):
+            group, submitted = futures[future]
+            duration = round(time.time() - submitted, 3)
+            try:
+                outcome = {"status": "succeeded", "result": future.result()}
+            except Exception as e:
+                logger.error(f"Batch item {group[0]['id']} failed: {e}")
+                outcome = {"status": "failed", "error": str(e)}
+
+            for item in group:
+                if outcome["status"] == "succeeded":
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield {"id": item["id"], "index": item["index"], **outcome, "duration": duration}
+
+    logger.info(f"Batch of {len(items)} items finished in {time.time() - started:.2f}s: "
+                f"{succeeded} succeeded, {failed} failed")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Conjur policies for every prompt in a JSONL file")
+    parser.add_argument("input", help="JSONL file of prompts, or - for stdin")
+    parser.add_argument("-o", "--output", help="File to write JSONL results to (default: stdout)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Number of concurrent generations")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.input == "-":
+            items = read_batch_items(sys.stdin)
+        else:
+            with open(args.input, "r") as f:
+                items = read_batch_items(f)
+    except Exception as e:
+        print(f"Error reading batch input: {str(e)}", file=sys.stderr)
+        return 1
+
+    output = open(args.output, "w") if args.output else sys.stdout
+    failed = 0
+    try:
+        for result in run_batch(items, concurrency=args.concurrency):
+            if result["status"] != "succeeded":
+                failed += 1
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    finally:
+        if args.output:
+            output.close()
+
+    print(f"Generated {len(items) - failed}/{len(items)} policies", file=sys.stderr)
+    return 0 if failed == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
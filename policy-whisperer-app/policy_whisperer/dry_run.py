@@ -0,0 +1,227 @@
+"""
+Dry-run validation of Conjur policies against a live Conjur server
+
+Authenticates once with the JWT authenticator, caches the session token until
+shortly before it expires, and submits the dry-runs of all policy files
+concurrently over a shared connection pool. Every file gets a result; a failing
+file doesn't stop the others.
+
+The JWT is taken from the GitHub Actions OIDC endpoint (ACTIONS_ID_TOKEN_REQUEST_URL
+and ACTIONS_ID_TOKEN_REQUEST_TOKEN) or, for local testing, from JWT_TOKEN.
+
+Usage:
+    python -m policy_whisperer.dry_run [--concurrency 8] [--markdown-output FILE] FILE...
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Number of dry-runs submitted concurrently
+DRY_RUN_CONCURRENCY = int(os.getenv("DRY_RUN_CONCURRENCY", "8"))
+
+# Timeout in seconds of a single request to Conjur
+DRY_RUN_TIMEOUT = float(os.getenv("DRY_RUN_TIMEOUT", "30"))
+
+# Policy branch the dry-runs are loaded into
+CONJUR_POLICY_BRANCH = os.getenv("CONJUR_POLICY_BRANCH", "whisper")
+
+# Conjur access tokens are valid for 8 minutes; refresh a little before that
+CONJUR_TOKEN_TTL = float(os.getenv("CONJUR_TOKEN_TTL", "480"))
+CONJUR_TOKEN_REFRESH_MARGIN = float(os.getenv("CONJUR_TOKEN_REFRESH_MARGIN", "30"))
+
+# The action has always accepted self-signed Conjur certificates (curl -k)
+CONJUR_VERIFY_SSL = os.getenv("CONJUR_VERIFY_SSL", "false").lower() == "true"
+
+def fetch_jwt(session: requests.Session) -> str:
+    """
+    Return a JWT for the Conjur JWT authenticator
+
+    Raises:
+        RuntimeError: If no JWT is available
+    """
+    request_url = os.getenv("ACTIONS_ID_TOKEN_REQUEST_URL")
+    request_token = os.getenv("ACTIONS_ID_TOKEN_REQUEST_TOKEN")
+    if request_url and request_token:
+        response = session.get(request_url, headers={"Authorization": f"bearer {request_token}"},
+                               timeout=DRY_RUN_TIMEOUT)
+        response.raise_for_status()
+        jwt = response.json().get("value")
+        if jwt:
+            return jwt
+    jwt = os.getenv("JWT_TOKEN")
+    if jwt:
+        return jwt
+    raise RuntimeError("Failed to obtain JWT token.")
+
+class ConjurClient:
+    """
+    Conjur client that shares one session token and connection pool between threads
+    """
+
+    def __init__(self, url: str, account: str, service_id: str, concurrency: int = DRY_RUN_CONCURRENCY,
+                 branch: str = CONJUR_POLICY_BRANCH, verify: bool = CONJUR_VERIFY_SSL):
+        self.url = url.rstrip("/")
+        self.account = account
+        self.service_id = service_id
+        self.branch = branch
+        self.session = requests.Session()
+        self.session.verify = verify
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._token = None
+        self._token_expires = 0.0
+        self._token_lock = threading.Lock()
+        self.authentications = 0
+
+    def _authenticate(self) -> str:
+        jwt = fetch_jwt(self.session)
+        response = self.session.post(
+            f"{self.url}/authn-jwt/{self.service_id}/{self.account}/authenticate",
+            data={"jwt": jwt},
+            headers={"Accept-Encoding": "base64"},
+            timeout=DRY_RUN_TIMEOUT
+        )
+        response.raise_for_status()
+        if not response.text:
+            raise RuntimeError("Failed to obtain session token.")
+        self.authentications += 1
+        logger.info(f"Authenticated with Conjur (authn-jwt/{self.service_id})")
+        return response.text
+
+    def token(self, stale: Optional[str] = None) -> str:
+        """
+        Return the cached session token, authenticating if it expired or if it
+        is the stale token a request was rejected with
+        """
+        with self._token_lock:
+            if self._token is None or self._token == stale or time.monotonic() >= self._token_expires:
+                self._token = self._authenticate()
+                self._token_expires = time.monotonic() + CONJUR_TOKEN_TTL - CONJUR_TOKEN_REFRESH_MARGIN
+            return self._token
+
+    def dry_run(self, policy: str) -> requests.Response:
+        """
+        Submit a policy dry-run, re-authenticating once if the token was rejected
+        """
+        url = f"{self.url}/policies/{self.account}/policy/{self.branch}"
+        token = self.token()
+        for attempt in range(2):
+            response = self.session.post(
+                url, params={"dryRun": "true"}, data=policy.encode("utf-8"),
+                headers={"Authorization": f'Token token="{token}"'},
+                timeout=DRY_RUN_TIMEOUT
+            )
+            if response.status_code != 401 or attempt:
+                return response
+            token = self.token(stale=token)
+        return response
+
+def dry_run_policy_file(client: ConjurClient, path: str) -> Dict[str, Any]:
+    """
+    Dry-run a policy file
+
+    Returns:
+        Dictionary with the file, success flag, HTTP status, Conjur output and duration
+    """
+    start = time.perf_counter()
+    try:
+        with open(path, "r") as f:
+            policy = f.read()
+        response = client.dry_run(policy)
+        success, status, output = response.ok, response.status_code, response.text
+    except Exception as e:
+        logger.error(f"Error validating {path}: {e}")
+        success, status, output = False, None, str(e)
+    return {
+        "file": path,
+        "success": success,
+        "status": status,
+        "output": output,
+        "duration": round(time.perf_counter() - start, 3)
+    }
+
+def dry_run_policy_files(client: ConjurClient, paths: List[str],
+                         concurrency: int = DRY_RUN_CONCURRENCY) -> List[Dict[str, Any]]:
+    """
+    Dry-run policy files concurrently and return the results in input order
+    """
+    paths = list(dict.fromkeys(paths))
+    if not paths:
+        return []
+    try:
+        # Authenticate up front so the workers don't all wait on the first request
+        client.token()
+    except Exception as e:
+        logger.error(f"Error authenticating with Conjur: {e}")
+        return [{"file": path, "success": False, "status": None, "output": str(e), "duration": 0.0}
+                for path in paths]
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(paths))),
+                            thread_name_prefix="dry-run") as executor:
+        return list(executor.map(lambda path: dry_run_policy_file(client, path), paths))
+
+def format_markdown(results: List[Dict[str, Any]]) -> str:
+    """
+    Format the results for the PR comment
+    """
+    lines = []
+    for result in results:
+        if result["success"]:
+            lines.append(f"## ✅ Policy validation succeeded for: {result['file']}")
+        else:
+            lines.append(f"## ❌ Policy validation failed for: {result['file']}")
+        lines.extend(["", "```", result["output"].strip(), "```", ""])
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dry-run Conjur policy files against a Conjur server")
+    parser.add_argument("files", nargs="*", help="Policy files (comma or whitespace separated lists are accepted)")
+    parser.add_argument("--concurrency", type=int, default=DRY_RUN_CONCURRENCY, help="Number of concurrent dry-runs")
+    parser.add_argument("--branch", default=CONJUR_POLICY_BRANCH, help="Policy branch to dry-run against")
+    parser.add_argument("--format", choices=["text", "json"], default="text", help="Output format")
+    parser.add_argument("--markdown-output", help="Write a markdown summary to this file")
+    args = parser.parse_args(argv)
+
+    settings = {name: os.getenv(name) for name in ("CONJUR_URL", "CONJUR_ACCOUNT", "CONJUR_JWT_SERVICE_ID")}
+    missing = [name for name, value in settings.items() if not value]
+    if missing:
+        print(f"Missing required Conjur configuration: {', '.join(missing)}", file=sys.stderr)
+        return 2
+
+    paths = [path for arg in args.files for path in re.split(r"[,\s]+", arg) if path]
+    client = ConjurClient(settings["CONJUR_URL"], settings["CONJUR_ACCOUNT"], settings["CONJUR_JWT_SERVICE_ID"],
+                          concurrency=args.concurrency, branch=args.branch)
+    start = time.perf_counter()
+    results = dry_run_policy_files(client, paths, concurrency=args.concurrency)
+    elapsed = time.perf_counter() - start
+
+    if args.format == "json":
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"{result['file']}: {'ok' if result['success'] else 'failed'} ({result['status']}, {result['duration']}s)")
+    if args.markdown_output:
+        with open(args.markdown_output, "w") as f:
+            f.write(format_markdown(results))
+
+    passed_count = sum(1 for result in results if result["success"])
+    print(f"{passed_count}/{len(results)} policy files passed the dry-run in {elapsed:.2f}s "
+          f"({client.authentications} authentication(s))", file=sys.stderr)
+    return 0 if passed_count == len(results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
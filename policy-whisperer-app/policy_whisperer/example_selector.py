@@ -1,22 +1,68 @@
 """
 Example selector for Policy Whisperer
 
-This module uses LLM to identify the most relevant examples for a given policy request.
+This module identifies the most relevant examples for a given policy request.
+Examples are ranked with a local retrieval index; an LLM ranker can be enabled
+as a fallback for low-confidence queries.
 """
 
+import os
+import asyncio
 import logging
 import json
 from typing import List, Dict, Any
 
-from langchain.prompts import ChatPromptTemplate
-from langchain.schema import StrOutputParser
-
-from policy_whisperer.llm_client import get_llm
-from policy_whisperer.templates import POLICY_STRUCTURE, fetch_policy_template
+from policy_whisperer.llm_client import get_llm, get_prompt_template, text_output_parser
+from policy_whisperer.templates import get_all_templates, fetch_policy_templates, afetch_policy_templates
+from policy_whisperer.retrieval import search_templates
+from policy_whisperer.metrics import llm_callbacks, span
+from policy_whisperer.logging_setup import log_payload
 
 logger = logging.getLogger(__name__)
 
+# Whether to ask the LLM to rank examples when the local index has low confidence
+EXAMPLE_SELECTOR_LLM_FALLBACK = os.getenv("EXAMPLE_SELECTOR_LLM_FALLBACK", "false").lower() == "true"
+
+# Relevance score (0-100) below which a local retrieval result is considered low confidence
+EXAMPLE_SELECTOR_MIN_SCORE = float(os.getenv("EXAMPLE_SELECTOR_MIN_SCORE", "20"))
+
 def identify_relevant_examples(user_prompt: str, max_examples: int = 3) -> List[Dict[str, str]]:
+    """
+    Identify the most relevant example files for a given policy request.
+    
+    Examples are ranked with the local retrieval index. If the best match scores
+    below EXAMPLE_SELECTOR_MIN_SCORE and EXAMPLE_SELECTOR_LLM_FALLBACK is enabled,
+    the LLM ranker is used instead.
+    
+    Args:
+        user_prompt: The user's policy request
+        max_examples: Maximum number of examples to return
+        
+    Returns:
+        List of dictionaries containing category, file_name, relevance_score and reason
+    """
+    logger.info(f"Identifying relevant examples for prompt: {user_prompt}")
+    
+    try:
+        with span("select_examples"):
+            examples = search_templates(user_prompt, max_examples)
+    except Exception as e:
+        logger.error(f"Error searching the template index: {e}")
+        logger.exception("Exception details:")
+        examples = []
+    
+    top_score = examples[0]["relevance_score"] if examples else 0
+    if top_score < EXAMPLE_SELECTOR_MIN_SCORE and EXAMPLE_SELECTOR_LLM_FALLBACK:
+        logger.info(f"Local retrieval confidence is low ({top_score}), falling back to LLM ranking")
+        with span("rank_examples"):
+            llm_examples = rank_examples_with_llm(user_prompt, max_examples)
+        if llm_examples:
+            return llm_examples
+    
+    logger.info(f"Identified {len(examples)} relevant examples: {examples}")
+    return examples
+
+def rank_examples_with_llm(user_prompt: str, max_examples: int = 3) -> List[Dict[str, str]]:
     """
     Use LLM to identify the most relevant example files for a given policy request.
     
@@ -28,29 +74,10 @@ def identify_relevant_examples(user_prompt: str, max_examples: int = 3) -> List[
         List of dictionaries containing category, file_name, and relevance_score
     """
     try:
-        logger.info(f"Identifying relevant examples for prompt: {user_prompt}")
+        logger.info(f"Ranking examples with LLM for prompt: {user_prompt}")
         
         # Create a flattened list of all available templates
-        all_templates = []
-        
-        for category, value in POLICY_STRUCTURE.items():
-            if isinstance(value, list):
-                # Simple category with list of files
-                for file_name in value:
-                    all_templates.append({
-                        "category": category,
-                        "file_name": file_name.replace(".yml", ""),
-                        "path": f"{category}/{file_name}"
-                    })
-            elif isinstance(value, dict):
-                # Nested category
-                for subcategory, files in value.items():
-                    for file_name in files:
-                        all_templates.append({
-                            "category": f"{category}/{subcategory}",
-                            "file_name": file_name.replace(".yml", ""),
-                            "path": f"{category}/{subcategory}/{file_name}"
-                        })
+        all_templates = get_all_templates()
         
         # Create a prompt for the LLM to identify relevant examples
         example_selector_template = """
@@ -86,7 +113,7 @@ def identify_relevant_examples(user_prompt: str, max_examples: int = 3) -> List[
         ])
         
         # Create the prompt template
-        prompt = ChatPromptTemplate.from_template(example_selector_template)
+        prompt = get_prompt_template(example_selector_template)
         
         # Initialize the LLM - use a smaller model for cost efficiency
         model = get_llm(model_name="gpt-4o", temperature=0.3)
@@ -94,8 +121,8 @@ def identify_relevant_examples(user_prompt: str, max_examples: int = 3) -> List[
         # Create the chain
         chain = (
             prompt
-            | model
-            | StrOutputParser()
+            | model.with_config(callbacks=llm_callbacks("gpt-4o"))
+            | text_output_parser()
         )
         
         # Execute the chain
@@ -105,7 +132,7 @@ def identify_relevant_examples(user_prompt: str, max_examples: int = 3) -> List[
             "max_examples": max_examples
         })
         
-        logger.debug(f"LLM response for example selection: {response}")
+        log_payload(logger, "LLM response for example selection", lambda: response, model="gpt-4o")
         
         # Parse the JSON response
         try:
@@ -150,19 +177,46 @@ def fetch_relevant_examples(user_prompt: str, max_examples: int = 3) -> Dict[str
     # Identify relevant examples
     relevant_examples = identify_relevant_examples(user_prompt, max_examples)
     
-    # Fetch the content of each example
+    # Fetch the content of all examples concurrently
+    templates = fetch_policy_templates([
+        (example["category"], example["file_name"]) for example in relevant_examples
+    ])
+    return collect_examples_content(relevant_examples, templates)
+
+async def afetch_relevant_examples(user_prompt: str, max_examples: int = 3) -> Dict[str, str]:
+    """
+    Async version of fetch_relevant_examples
+    """
+    if EXAMPLE_SELECTOR_LLM_FALLBACK:
+        # The LLM ranker is blocking, keep it off the event loop
+        relevant_examples = await asyncio.to_thread(identify_relevant_examples, user_prompt, max_examples)
+    else:
+        relevant_examples = identify_relevant_examples(user_prompt, max_examples)
+    
+    templates = await afetch_policy_templates([
+        (example["category"], example["file_name"]) for example in relevant_examples
+    ])
+    return collect_examples_content(relevant_examples, templates)
+
+def collect_examples_content(relevant_examples: List[Dict[str, Any]], templates: Dict[str, str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Combine the identified examples with their fetched template content
+    
+    Args:
+        relevant_examples: Examples returned by identify_relevant_examples
+        templates: Dictionary mapping example paths to their content
+        
+    Returns:
+        Dictionary mapping example paths to their content, relevance score and reason
+    """
     examples_content = {}
     
     for example in relevant_examples:
-        category = example["category"]
-        file_name = example["file_name"]
-        
-        # Fetch the template content
-        template_content = fetch_policy_template(category, file_name)
+        example_path = f"{example['category']}/{example['file_name']}"
+        template_content = templates.get(example_path)
         
         if template_content:
             # Add to the examples content dictionary
-            example_path = f"{category}/{file_name}"
             examples_content[example_path] = {
                 "content": template_content,
                 "relevance_score": example.get("relevance_score", 0),
@@ -170,6 +224,6 @@ def fetch_relevant_examples(user_prompt: str, max_examples: int = 3) -> Dict[str
             }
             logger.info(f"Fetched content for example: {example_path}")
         else:
-            logger.warning(f"Failed to fetch content for example: {category}/{file_name}")
+            logger.warning(f"Failed to fetch content for example: {example_path}")
     
     return examples_content
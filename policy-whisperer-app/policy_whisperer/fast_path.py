@@ -0,0 +1,503 @@
+"""
+Rule-based fast path for Policy Whisperer
+
+Most requests ask for one of a few well-known policies (GitHub Actions hosts,
+JWT authenticators, AWS credentials, Kubernetes apps, Terraform). For these,
+parameters such as repositories, host ids, variable names and service ids are
+extracted from the prompt and rendered into a fixed template, without an LLM
+call. Requests that don't match a rule with all of its required parameters are
+left to the LLM.
+"""
+
+import os
+import re
+import logging
+from typing import Any, Dict, List, Optional
+
+from policy_whisperer.policy_parser import parse_policy
+
+logger = logging.getLogger(__name__)
+
+# Whether to answer matching requests with the rule-based generator instead of the LLM
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() == "true"
+
+# Longer prompts usually carry requirements the rules can't express
+FAST_PATH_MAX_WORDS = int(os.getenv("FAST_PATH_MAX_WORDS", "60"))
+
+# Words that ask for something none of the rules render, including restrictions
+# of the privileges they grant (always read and execute)
+UNSUPPORTED_TERMS = {
+    "user", "users", "delete", "remove", "revoke", "rotate", "rotation",
+    "deny", "layer", "layers", "except", "unless", "without",
+    "only", "not", "read-only", "readonly", "write", "update"
+}
+
+# Words asking for secrets. A prompt using them must name its variables, except for
+# the words of the matched rule's keyword (e.g. "aws credentials")
+SECRET_TERMS = {
+    "secret", "secrets", "password", "passwords", "key", "keys", "api-key", "api-keys",
+    "credential", "credentials", "token", "tokens", "certificate", "certificates"
+}
+
+# Words that are never parameter values
+PARAMETER_STOPWORDS = {
+    "a", "an", "the", "and", "or", "for", "to", "of", "in", "on", "with", "that",
+    "each", "every", "any", "all", "same", "its", "their", "our", "my", "this",
+    "named", "called", "k8s", "kubernetes", "conjur", "policy"
+}
+
+# Words that follow or precede "namespace" or "service account" without being its name
+NAME_STOPWORDS = {
+    "access", "needs", "need", "should", "must", "can", "could", "will", "to", "be", "is", "are",
+    "has", "have", "able", "read", "reads", "fetch", "fetches", "get", "gets", "use", "uses",
+    "using", "retrieve", "give", "grant", "allow", "let", "app", "apps", "application", "service",
+    "services", "workload", "workloads", "pod", "pods", "deployment", "namespace", "namespaces",
+    "account", "accounts", "from", "into", "as", "at", "by", "which", "who", "where", "new"
+}
+
+# Slash-separated words that are not repositories
+NOT_REPOSITORIES = {"ci/cd", "read/write", "and/or", "input/output"}
+
+# Display names of the JWT providers
+JWT_PROVIDERS = {"github": "GitHub", "gitlab": "GitLab", "jenkins": "Jenkins"}
+
+# Identifier, optionally quoted, in a list of parameter values
+_VALUE = r"[`'\"]?[A-Za-z0-9][\w./-]*[`'\"]?"
+_VALUE_LIST = rf"{_VALUE}(?:\s*,\s*(?:and\s+)?{_VALUE}|\s+and\s+{_VALUE})*"
+
+def _sanitize_id(value: str) -> str:
+    """Turn a value into a short, hyphenated lowercase Conjur id"""
+    return re.sub(r"[^a-z0-9]+", "-", value.lower()).strip("-")
+
+def _split_values(match: str, require_identifier: bool = True) -> List[str]:
+    """
+    Split a matched list of values, keeping only the ones that look like identifiers.
+    Quoted values are always kept; unquoted ones need a '-', '_', '/', '.' or digit.
+    """
+    values = []
+    for raw in re.split(r"\s*,\s*(?:and\s+)?|\s+and\s+", match):
+        value = raw.strip().rstrip(".")
+        quoted = len(value) > 1 and value[0] in "`'\"" and value[-1] == value[0]
+        value = value.strip("`'\"")
+        if not value or value.lower() in PARAMETER_STOPWORDS:
+            continue
+        if quoted or not require_identifier or re.search(r"[-_/.0-9]", value):
+            values.append(value)
+    return list(dict.fromkeys(values))
+
+def _first_match(patterns: List[str], text: str, stopwords: frozenset = frozenset()) -> Optional[str]:
+    for pattern in patterns:
+        for match in re.finditer(pattern, text, re.IGNORECASE):
+            value = match.group(1).strip("`'\"").rstrip(".")
+            if value.lower() not in PARAMETER_STOPWORDS and value.lower() not in stopwords:
+                return value
+    return None
+
+def extract_parameters(user_prompt: str) -> Dict[str, Any]:
+    """
+    Extract the parameters used by the fast path rules from a prompt
+
+    Returns:
+        Dictionary with variables, hosts and repositories (lists) and service_id,
+        branch, namespace, service_account and app_name (strings or None)
+    """
+    variables = []
+    for match in re.finditer(rf"\b(?:variables?|secrets?)\s+(?:named\s+|called\s+)?({_VALUE_LIST})",
+                             user_prompt, re.IGNORECASE):
+        variables.extend(_split_values(match.group(1)))
+
+    hosts = []
+    for match in re.finditer(rf"\bhosts?\s+(?:named\s+|called\s+)?({_VALUE_LIST})", user_prompt, re.IGNORECASE):
+        hosts.extend(_split_values(match.group(1)))
+
+    # Variable paths look like repositories, so skip the ones already taken
+    repositories = []
+    for match in re.finditer(r"(?<![\w/.:-])([A-Za-z0-9][\w.-]*/[A-Za-z0-9][\w.-]*?)(?=[.,;]?(?:\s|$))", user_prompt):
+        candidate = match.group(1)
+        if candidate.lower() in NOT_REPOSITORIES or candidate in variables or candidate.endswith((".yml", ".yaml")):
+            continue
+        repositories.append(candidate)
+
+    return {
+        "variables": list(dict.fromkeys(variables)),
+        "hosts": list(dict.fromkeys(hosts)),
+        "repositories": list(dict.fromkeys(repositories)),
+        "service_id": _first_match([
+            r"\bservice[-_ ]?id\s*(?:of\s+|is\s+|=\s*|:\s*)?([`'\"]?[\w-]+)",
+            r"\bauthn-(?:jwt|k8s)/([\w-]+)"
+        ], user_prompt),
+        "branch": _first_match([
+            r"\bbranch(?:es)?\s+([`'\"]?[\w./-]+)",
+            r"\b([\w./-]+)\s+branch\b"
+        ], user_prompt),
+        "namespace": _first_match([
+            r"\bnamespace\s+([`'\"]?[a-z0-9][a-z0-9-]*)",
+            r"\b([a-z0-9][a-z0-9-]*)\s+namespace\b"
+        ], user_prompt, NAME_STOPWORDS),
+        "service_account": _first_match([
+            r"\bservice[- ]account\s+([`'\"]?[a-z0-9][a-z0-9-]*)",
+            r"\b([a-z0-9][a-z0-9-]*)\s+service[- ]account\b"
+        ], user_prompt, NAME_STOPWORDS),
+        "app_name": _first_match([
+            r"\b(?:app|application|service)\s+(?:named|called)\s+([`'\"]?[\w-]+)",
+            r"\bfor\s+(?:the\s+|our\s+|my\s+)?([\w-]+)\s+(?:app|application|service)\b(?![-\w])"
+        ], user_prompt)
+    }
+
+def _variables_block(variables: List[str], indent: str = "    ") -> str:
+    lines = [f"{indent}# Secrets the workloads can fetch (values are set separately with `conjur variable set`)",
+             f"{indent}- &variables"]
+    for variable in variables:
+        lines.append(f"{indent}  - !variable {variable}")
+    return "\n".join(lines)
+
+def _permit_variables_block(indent: str = "    ") -> str:
+    return "\n".join([
+        f"{indent}# Allow the group to read and fetch the secrets",
+        f"{indent}- !permit",
+        f"{indent}  role: !group",
+        f"{indent}  privileges: [ read, execute ]",
+        f"{indent}  resources: *variables"
+    ])
+
+def _explanation(summary: str, resources: List[str], rules: List[str], notes: List[str]) -> str:
+    sections = [f"## Summary\n\n{summary}"]
+    sections.append("## Key Resources\n\n" + "\n".join(f"- {item}" for item in resources[:5]))
+    sections.append("## Access Rules\n\n" + "\n".join(f"- {item}" for item in rules[:3]))
+    if notes:
+        sections.append("## Usage Notes\n\n" + "\n".join(f"- {item}" for item in notes[:2]))
+    return "\n\n".join(sections)
+
+def render_github_actions(params: Dict[str, Any]) -> Dict[str, str]:
+    service_id = params["service_id"] or "github"
+    policy_id = _sanitize_id(params["app_name"]) if params["app_name"] else "github-actions"
+
+    host_lines = []
+    for repository in params["repositories"]:
+        host_lines += [
+            "      - !host",
+            f"        id: {_sanitize_id(repository)}",
+            "        annotations:",
+            f"          description: GitHub Actions workflows of {repository}",
+            f"          authn-jwt/{service_id}/repository: {repository}"
+        ]
+        if params["branch"]:
+            host_lines.append(f"          authn-jwt/{service_id}/ref: refs/heads/{params['branch']}")
+
+    body = [
+        "    # One host per repository, matched on the claims of the workflow's JWT",
+        "    - &hosts",
+        *host_lines,
+        "",
+        "    # Group of all workflow hosts",
+        "    - !group",
+        "",
+        "    - !grant",
+        "      role: !group",
+        "      members: *hosts"
+    ]
+    if params["variables"]:
+        body += ["", _variables_block(params["variables"]), "", _permit_variables_block()]
+
+    policy = "\n".join([
+        "# GitHub Actions workflows that authenticate with the JWT authenticator",
+        "- !policy",
+        f"  id: {policy_id}",
+        "  body:",
+        *body
+    ])
+
+    repositories = ", ".join(params["repositories"])
+    return {
+        "policy": policy,
+        "explanation": _explanation(
+            f"Defines Conjur hosts for the GitHub Actions workflows of {repositories}.",
+            [f"`{policy_id}` policy"]
+            + [f"Host `{_sanitize_id(repository)}` for `{repository}`" for repository in params["repositories"]]
+            + [f"Variable `{variable}`" for variable in params["variables"]],
+            ["All workflow hosts are members of the policy's group"]
+            + (["The group can read and fetch the variables"] if params["variables"] else []),
+            [f"Grant `{policy_id}` to the consumers group of `conjur/authn-jwt/{service_id}` so the hosts can authenticate.",
+             "Load the policy with `conjur policy load -b root -f <file>`."]
+        )
+    }
+
+def render_jwt_authenticator(params: Dict[str, Any]) -> Dict[str, str]:
+    provider = params["provider"]
+    provider_name = JWT_PROVIDERS[provider]
+    service_id = params["service_id"] or provider
+    variables = ["jwks-uri", "issuer", "token-app-property", "identity-path"]
+    if provider != "github":
+        variables.append("audience")
+
+    policy = "\n".join([
+        f"# JWT authenticator for {provider_name}",
+        "- !policy",
+        f"  id: conjur/authn-jwt/{service_id}",
+        "  body:",
+        "    # The authenticator itself",
+        "    - !webservice",
+        "",
+        "    # Authenticator configuration (values are set separately with `conjur variable set`)",
+        *[f"    - !variable {variable}" for variable in variables],
+        "",
+        "    # Hosts that are allowed to authenticate",
+        "    - !group apps",
+        "",
+        "    - !permit",
+        "      role: !group apps",
+        "      privilege: [ read, authenticate ]",
+        "      resource: !webservice"
+    ])
+
+    return {
+        "policy": policy,
+        "explanation": _explanation(
+            f"Configures a JWT authenticator for {provider_name} at `conjur/authn-jwt/{service_id}`.",
+            ["Authenticator webservice"] + [f"Variable `{variable}`" for variable in variables[:3]] + ["Group `apps`"],
+            ["Members of `apps` can authenticate with the webservice"],
+            [f"Enable the authenticator with `authn-jwt/{service_id}` in `CONJUR_AUTHENTICATORS`.",
+             "Set the configuration variables before hosts try to authenticate."]
+        )
+    }
+
+def render_aws(params: Dict[str, Any]) -> Dict[str, str]:
+    policy_id = _sanitize_id(params["app_name"]) if params["app_name"] else "aws"
+    variables = params["variables"] or ["access-key-id", "secret-access-key", "region"]
+
+    body = [
+        "    # Group of workloads that use the AWS credentials",
+        "    - !group",
+        "",
+        _variables_block(variables),
+        "",
+        _permit_variables_block()
+    ]
+    if params["hosts"]:
+        body += [
+            "",
+            "    # Workloads that use the credentials",
+            "    - &hosts",
+            *[f"      - !host {_sanitize_id(host)}" for host in params["hosts"]],
+            "",
+            "    - !grant",
+            "      role: !group",
+            "      members: *hosts"
+        ]
+
+    policy = "\n".join([
+        "# AWS credentials and the workloads that can use them",
+        "- !policy",
+        f"  id: {policy_id}",
+        "  body:",
+        *body
+    ])
+
+    return {
+        "policy": policy,
+        "explanation": _explanation(
+            f"Stores AWS credentials in the `{policy_id}` policy and controls who can fetch them.",
+            [f"Variable `{variable}`" for variable in variables]
+            + [f"Host `{_sanitize_id(host)}`" for host in params["hosts"]],
+            ["Members of the policy's group can read and fetch the credentials"],
+            ["Add workloads to the group to give them access."]
+        )
+    }
+
+def render_kubernetes(params: Dict[str, Any]) -> Dict[str, str]:
+    namespace = params["namespace"]
+    service_account = params["service_account"]
+    app_id = _sanitize_id(params["app_name"] or service_account or namespace)
+    policy_id = f"{_sanitize_id(namespace)}-apps"
+
+    annotations = [f"          authn-k8s/namespace: {namespace}"]
+    if service_account:
+        annotations.append(f"          authn-k8s/service-account: {service_account}")
+    annotations.append("          authn-k8s/authentication-container-name: authenticator")
+
+    body = [
+        "    # Workload identified by its Kubernetes namespace and service account",
+        "    - &hosts",
+        "      - !host",
+        f"        id: {app_id}",
+        "        annotations:",
+        *annotations,
+        "",
+        "    # Group of the namespace's workloads",
+        "    - !group",
+        "",
+        "    - !grant",
+        "      role: !group",
+        "      members: *hosts"
+    ]
+    if params["variables"]:
+        body += ["", _variables_block(params["variables"]), "", _permit_variables_block()]
+
+    policy = "\n".join([
+        f"# Kubernetes workloads in the {namespace} namespace",
+        "- !policy",
+        f"  id: {policy_id}",
+        "  body:",
+        *body
+    ])
+
+    service_id = params["service_id"] or "<service-id>"
+    return {
+        "policy": policy,
+        "explanation": _explanation(
+            f"Defines a Conjur host for the `{app_id}` workload in the `{namespace}` Kubernetes namespace.",
+            [f"Host `{app_id}`"] + [f"Variable `{variable}`" for variable in params["variables"]],
+            ["The host is a member of the policy's group"]
+            + (["The group can read and fetch the variables"] if params["variables"] else []),
+            [f"Grant `{policy_id}` to the consumers group of `conjur/authn-k8s/{service_id}` so the host can authenticate."]
+        )
+    }
+
+def render_terraform(params: Dict[str, Any]) -> Dict[str, str]:
+    host_id = _sanitize_id(params["hosts"][0]) if params["hosts"] else "terraform"
+    policy_id = _sanitize_id(params["app_name"]) if params["app_name"] else "terraform"
+
+    policy = "\n".join([
+        "# Secrets used by Terraform runs",
+        "- !policy",
+        f"  id: {policy_id}",
+        "  body:",
+        "    # Identity of the Terraform runner",
+        f"    - !host {host_id}",
+        "",
+        "    # Group of Terraform runners",
+        "    - !group",
+        "",
+        "    - !grant",
+        "      role: !group",
+        f"      member: !host {host_id}",
+        "",
+        _variables_block(params["variables"]),
+        "",
+        _permit_variables_block()
+    ])
+
+    return {
+        "policy": policy,
+        "explanation": _explanation(
+            f"Gives the Terraform runner `{host_id}` access to the secrets it needs.",
+            [f"Host `{host_id}`"] + [f"Variable `{variable}`" for variable in params["variables"]],
+            ["The runner is a member of the policy's group, which can read and fetch the variables"],
+            ["Use the host's API key with the Conjur Terraform provider."]
+        )
+    }
+
+# Fast path rules: matched keywords, words that rule them out, required parameters (a tuple
+# requires one of its parameters) and renderer
+FAST_PATH_RULES: Dict[str, Dict[str, Any]] = {
+    "github-actions": {
+        "keywords": ["github actions", "github workflow", "github workflows"],
+        "excludes": ["gitlab", "jenkins", "authenticator", "jwt", "token", "tokens", "pat", "webhook", "webhooks",
+                     "enterprise", "organization", "org"],
+        "required": ["repositories"],
+        "render": render_github_actions
+    },
+    "jwt-authenticator": {
+        "keywords": ["github jwt", "gitlab jwt", "jenkins jwt", "github authentication",
+                     "gitlab authentication", "jenkins authentication", "jwt authenticator"],
+        "excludes": ["host", "hosts", "repository", "repositories", "repo", "repos"],
+        "required": ["provider"],
+        "render": render_jwt_authenticator
+    },
+    "aws": {
+        "keywords": ["aws credentials", "aws access key", "aws access keys", "aws keys", "aws secret", "aws secrets"],
+        "excludes": ["iam", "lambda", "ec2", "ecs", "eks", "rds", "s3", "dynamodb", "database", "db", "password",
+                     "passwords", "running", "hosted", "deployed", "authn", "authenticator", "authentication",
+                     "azure", "gcp"],
+        "required": [("variables", "hosts")],
+        "render": render_aws
+    },
+    "kubernetes": {
+        "keywords": ["kubernetes", "k8s"],
+        "excludes": ["authenticator", "openshift"],
+        "required": ["namespace"],
+        "render": render_kubernetes
+    },
+    "terraform": {
+        "keywords": ["terraform"],
+        "excludes": ["aws", "azure", "gcp"],
+        "required": ["variables"],
+        "render": render_terraform
+    }
+}
+
+def _asks_for_secrets(user_prompt: str, rule: Dict[str, Any]) -> bool:
+    """
+    Whether the prompt mentions secrets, not counting the words of the rule's keywords
+    """
+    user_prompt_lower = user_prompt.lower()
+    for keyword in rule["keywords"]:
+        user_prompt_lower = re.sub(rf"\b{re.escape(keyword)}\b", " ", user_prompt_lower)
+    return bool(SECRET_TERMS.intersection(re.findall(r"[a-z0-9-]+", user_prompt_lower)))
+
+def match_fast_path_rule(user_prompt: str) -> Optional[str]:
+    """
+    Return the name of the rule with the longest keyword found in the prompt
+    """
+    user_prompt_lower = user_prompt.lower()
+    best_match = None
+    best_match_length = 0
+    for name, rule in FAST_PATH_RULES.items():
+        for keyword in rule["keywords"]:
+            if re.search(rf"\b{re.escape(keyword)}\b", user_prompt_lower) and len(keyword) > best_match_length:
+                best_match = name
+                best_match_length = len(keyword)
+    return best_match
+
+def generate_fast_path_policy(user_prompt: str) -> Optional[Dict[str, Any]]:
+    """
+    Generate a policy and its explanation with the rule-based fast path
+
+    Returns:
+        Dictionary with policy, explanation, rule and parameters, or None when no rule
+        can confidently answer the request and the LLM should be used
+    """
+    if not FAST_PATH_ENABLED:
+        return None
+
+    words = re.findall(r"[a-z0-9-]+", user_prompt.lower())
+    if len(words) > FAST_PATH_MAX_WORDS or UNSUPPORTED_TERMS.intersection(words):
+        return None
+
+    name = match_fast_path_rule(user_prompt)
+    if name is None:
+        return None
+    rule = FAST_PATH_RULES[name]
+    if any(term in words for term in rule["excludes"]):
+        logger.debug(f"Fast path rule {name} ruled out by prompt")
+        return None
+
+    params = extract_parameters(user_prompt)
+    if not params["variables"] and _asks_for_secrets(user_prompt, rule):
+        # The rules can't tell which variables hold the secrets asked for
+        logger.debug(f"Fast path rule {name} ruled out by secrets without variable names")
+        return None
+    params["provider"] = next((provider for provider in JWT_PROVIDERS if provider in words), None)
+    missing = [param for param in rule["required"]
+               if not any(params.get(name) for name in (param if isinstance(param, tuple) else (param,)))]
+    if missing:
+        logger.debug(f"Fast path rule {name} is missing parameters: {missing}")
+        return None
+
+    try:
+        result = rule["render"](params)
+        # Make sure the rendered policy is valid before skipping the LLM
+        parsed = parse_policy(result["policy"])
+        if not parsed.valid:
+            raise ValueError(parsed.error)
+    except Exception as e:
+        logger.error(f"Error rendering fast path rule {name}: {e}")
+        return None
+
+    logger.info(f"Policy generated with fast path rule {name}")
+    return {
+        "policy": result["policy"],
+        "explanation": result["explanation"],
+        "rule": name,
+        "parameters": {key: value for key, value in params.items() if value}
+    }
@@ -1,21 +1,233 @@
 """
 GitHub integration for Policy Whisperer to create pull requests with Conjur policies
 Using direct GitHub API calls with requests library for simplicity
+
+All requests go through one shared keep-alive session. The default branch of each
+repository and its head commit are cached and revalidated with conditional
+requests, which GitHub answers with 304 without counting them against the rate
+limit. The policy is committed with the Git Data API (one request for the tree
+with the new file, one for the commit and one for the branch pointing at it), so
+the existing file doesn't have to be looked up. Requests hitting the primary or
+secondary rate limit are retried after the wait GitHub asks for.
 """
 
 import os
-import base64
+import time
 import logging
+import threading
 import requests
 from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from requests.adapters import HTTPAdapter
+
+from policy_whisperer.policy_parser import parse_policy
+from policy_whisperer.metrics import inc, record_cache, record_stage, set_gauge
 
 logger = logging.getLogger(__name__)
 
-def create_github_pr(repo_owner, repo_name, policy_content, file_path, github_token, 
+# GitHub API URL (GitHub Enterprise Server uses https://<host>/api/v3)
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+
+# Seconds to wait for a GitHub API response, and maximum connections kept open to the API
+GITHUB_TIMEOUT = float(os.getenv("GITHUB_TIMEOUT", "30"))
+GITHUB_MAX_CONNECTIONS = int(os.getenv("GITHUB_MAX_CONNECTIONS", "10"))
+
+# Times a rate-limited request is retried, and the longest wait in seconds for a
+# rate limit to reset before the request fails instead
+GITHUB_RATE_LIMIT_RETRIES = int(os.getenv("GITHUB_RATE_LIMIT_RETRIES", "3"))
+GITHUB_RATE_LIMIT_MAX_WAIT = float(os.getenv("GITHUB_RATE_LIMIT_MAX_WAIT", "60"))
+
+# Seconds the name of the default branch of a repository is used before it is revalidated
+GITHUB_REPO_CACHE_TTL = float(os.getenv("GITHUB_REPO_CACHE_TTL", "3600"))
+
+# GitHub asks to wait at least a minute after a secondary rate limit without a Retry-After
+SECONDARY_RATE_LIMIT_WAIT = 60.0
+
+_session = None
+_session_lock = threading.Lock()
+
+# Conditional request cache: (url) -> (etag, data)
+_conditional_cache: Dict[str, Tuple[str, dict]] = {}
+# Default branch of each repository: api_base -> (expires, branch)
+_default_branches: Dict[str, Tuple[float, str]] = {}
+_cache_lock = threading.Lock()
+
+class GitHubAPIError(Exception):
+    """Raised when a GitHub API request fails"""
+
+    def __init__(self, response: requests.Response):
+        try:
+            message = response.json().get("message", response.text)
+        except ValueError:
+            message = response.text
+        super().__init__(f"{response.request.method} {response.url} returned {response.status_code}: {message}")
+        self.response = response
+        self.status_code = response.status_code
+
+def get_session() -> requests.Session:
+    """
+    Return the keep-alive session shared by all GitHub API requests
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=GITHUB_MAX_CONNECTIONS, pool_maxsize=GITHUB_MAX_CONNECTIONS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+def rate_limit_wait(response: requests.Response, attempt: int) -> Optional[float]:
+    """
+    Return how long to wait before retrying a rate-limited response, or None if
+    the response wasn't rate limited
+    """
+    if response.status_code not in (403, 429):
+        return None
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            return SECONDARY_RATE_LIMIT_WAIT
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        # Primary rate limit, wait for the reset time
+        reset = float(response.headers.get("X-RateLimit-Reset", 0))
+        return max(reset - time.time(), 0.0) + 1.0
+    if "secondary rate limit" in response.text.lower():
+        return SECONDARY_RATE_LIMIT_WAIT * 2 ** attempt
+    return None
+
+def github_request(method: str, url: str, token: str, etag: Optional[str] = None, **kwargs) -> requests.Response:
+    """
+    Send a GitHub API request, waiting out rate limits. With an etag the request
+    is conditional and may be answered with 304 Not Modified.
+    """
+    headers = {
+        'Authorization': f'token {token}',
+        'Accept': 'application/vnd.github.v3+json'
+    }
+    if etag:
+        headers['If-None-Match'] = etag
+
+    session = get_session()
+    for attempt in range(GITHUB_RATE_LIMIT_RETRIES + 1):
+        response = session.request(method, url, headers=headers, timeout=GITHUB_TIMEOUT, **kwargs)
+        inc("github_requests_total", method=method, status=response.status_code)
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if remaining is not None:
+            set_gauge("github_rate_limit_remaining", int(remaining),
+                      resource=response.headers.get("X-RateLimit-Resource", "core"))
+
+        wait = rate_limit_wait(response, attempt)
+        if wait is None or attempt == GITHUB_RATE_LIMIT_RETRIES:
+            return response
+        if wait > GITHUB_RATE_LIMIT_MAX_WAIT:
+            logger.warning(f"GitHub rate limit resets in {wait:.0f}s, giving up on {method} {url}")
+            return response
+        logger.warning(f"GitHub rate limit hit on {method} {url}, retrying in {wait:.1f}s")
+        inc("github_rate_limited_total")
+        time.sleep(wait)
+    return response
+
+def _checked(response: requests.Response) -> dict:
+    if response.status_code >= 400:
+        raise GitHubAPIError(response)
+    return response.json() if response.content else {}
+
+def conditional_get(url: str, token: str, cache: str) -> dict:
+    """
+    GET a GitHub API resource, revalidating the cached copy with its ETag
+    """
+    with _cache_lock:
+        cached = _conditional_cache.get(url)
+    response = github_request("GET", url, token, etag=cached[0] if cached else None)
+    if response.status_code == 304 and cached:
+        record_cache(cache, "hits")
+        return cached[1]
+
+    record_cache(cache, "misses")
+    data = _checked(response)
+    etag = response.headers.get("ETag")
+    if etag:
+        with _cache_lock:
+            _conditional_cache[url] = (etag, data)
+    return data
+
+def get_default_branch(api_base: str, token: str) -> str:
+    """
+    Return the name of the default branch of a repository
+    """
+    with _cache_lock:
+        cached = _default_branches.get(api_base)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    branch = conditional_get(api_base, token, "github_repo")['default_branch']
+    with _cache_lock:
+        _default_branches[api_base] = (time.monotonic() + GITHUB_REPO_CACHE_TTL, branch)
+    return branch
+
+def get_branch_head(api_base: str, branch: str, token: str) -> Tuple[str, str]:
+    """
+    Return the SHA of the head commit of a branch and of its tree
+    """
+    data = conditional_get(f'{api_base}/branches/{branch}', token, "github_branch")
+    return data['commit']['sha'], data['commit']['commit']['tree']['sha']
+
+def get_default_branch_head(api_base: str, token: str) -> Tuple[str, str, str]:
+    """
+    Return the default branch of a repository, its head commit SHA and its tree SHA
+    """
+    default_branch = get_default_branch(api_base, token)
+    try:
+        return (default_branch,) + get_branch_head(api_base, default_branch, token)
+    except GitHubAPIError as e:
+        if e.status_code != 404:
+            raise
+        # The default branch was renamed since it was cached
+        with _cache_lock:
+            _default_branches.pop(api_base, None)
+        default_branch = get_default_branch(api_base, token)
+        return (default_branch,) + get_branch_head(api_base, default_branch, token)
+
+def commit_file(api_base: str, token: str, parent_sha: str, base_tree: str,
+                file_path: str, content: str, message: str) -> str:
+    """
+    Create a commit adding or replacing a file on top of a parent commit
+
+    Returns:
+        The SHA of the new commit
+    """
+    # The blob is created along with the tree from its inline content
+    tree = _checked(github_request("POST", f'{api_base}/git/trees', token, json={
+        'base_tree': base_tree,
+        'tree': [{'path': file_path, 'mode': '100644', 'type': 'blob', 'content': content}]
+    }))
+    commit = _checked(github_request("POST", f'{api_base}/git/commits', token, json={
+        'message': message,
+        'tree': tree['sha'],
+        'parents': [parent_sha]
+    }))
+    return commit['sha']
+
+def describe_policy(policy_content):
+    """
+    Summarize the records and statements of a policy for the PR description
+    """
+    parsed = parse_policy(policy_content)
+    if not parsed.valid:
+        return "**Warning:** the policy could not be parsed as Conjur policy YAML."
+
+    counts = [f"{count} {tag}" for tag, count in parsed.counts().items() if count]
+    return f"Policy contents: {', '.join(counts) if counts else 'empty'}"
+
+def create_github_pr(repo_owner, repo_name, policy_content, file_path, github_token,
                      branch_name=None, commit_message=None, pr_title=None, pr_description=None):
     """
     Create a PR to the GitHub repository with the policy content using direct API calls
-    
+
     Args:
         repo_owner: GitHub repository owner
         repo_name: GitHub repository name
@@ -26,122 +238,63 @@ def create_github_pr(repo_owner, repo_name, policy_content, file_path, github_to
         commit_message: Commit message (default: "Add/Update Conjur policy: {file_path}")
         pr_title: PR title (default: "Add/Update Conjur policy: {file_basename}")
         pr_description: PR description
-        
+
     Returns:
         Dictionary with PR details (url, number, etc.)
     """
+    start = time.perf_counter()
     try:
         # Set default values
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
         file_basename = os.path.basename(file_path).split(".")[0]
-        
+        file_path = file_path.lstrip("/")
+
         branch_name = branch_name or f"policy-update-{file_basename}-{timestamp}"
         commit_message = commit_message or f"Add/Update Conjur policy: {file_path}"
         pr_title = pr_title or f"Add/Update Conjur policy: {file_basename}"
         pr_description = pr_description or (
             f"This PR adds or updates the Conjur policy file at `{file_path}`.\n\n"
+            f"{describe_policy(policy_content)}\n\n"
             f"Generated by the Conjur Policy Whisperer at {datetime.now().isoformat()}"
         )
-        
+
         logger.info(f"Creating PR for repository {repo_owner}/{repo_name}")
         logger.info(f"File path: {file_path}, Branch: {branch_name}")
-        
-        # Setup headers for GitHub API requests
-        headers = {
-            'Authorization': f'token {github_token}',
-            'Accept': 'application/vnd.github.v3+json'
-        }
-        
+
         # GitHub API base URL
-        api_base = f'https://api.github.com/repos/{repo_owner}/{repo_name}'
-        
-        # Step 1: Get the default branch reference
-        logger.info(f"Getting default branch reference")
-        response = requests.get(f'{api_base}/git/refs/heads', headers=headers)
-        response.raise_for_status()
-        
-        # Find the default branch (usually main or master)
-        default_branch = None
-        for ref in response.json():
-            if ref['ref'].endswith('/main'):
-                default_branch = 'main'
-                default_branch_sha = ref['object']['sha']
-                break
-            elif ref['ref'].endswith('/master') and not default_branch:
-                default_branch = 'master'
-                default_branch_sha = ref['object']['sha']
-        
-        if not default_branch:
-            # If we couldn't find main or master, get the repo info to find the default branch
-            repo_response = requests.get(api_base, headers=headers)
-            repo_response.raise_for_status()
-            default_branch = repo_response.json()['default_branch']
-            
-            # Now get the SHA for this branch
-            branch_response = requests.get(f'{api_base}/git/refs/heads/{default_branch}', headers=headers)
-            branch_response.raise_for_status()
-            default_branch_sha = branch_response.json()['object']['sha']
-        
-        logger.info(f"Default branch is {default_branch} with SHA {default_branch_sha}")
-        
-        # Step 2: Create a new branch (or use existing)
-        try:
-            logger.info(f"Creating new branch: {branch_name}")
-            create_branch_data = {
-                'ref': f'refs/heads/{branch_name}',
-                'sha': default_branch_sha
-            }
-            branch_response = requests.post(f'{api_base}/git/refs', json=create_branch_data, headers=headers)
-            branch_response.raise_for_status()
-            logger.info(f"Created new branch: {branch_name}")
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 422:  # Branch already exists
-                logger.warning(f"Branch {branch_name} already exists. Will update it.")
-            else:
-                raise
-        
-        # Step 3: Check if file exists and get its SHA if it does
-        file_sha = None
-        try:
-            file_response = requests.get(f'{api_base}/contents/{file_path}?ref={branch_name}', headers=headers)
-            file_response.raise_for_status()
-            file_sha = file_response.json()['sha']
-            logger.info(f"File exists, will update it. SHA: {file_sha}")
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 404:
-                logger.info(f"File does not exist, will create it")
-            else:
-                raise
-        
-        # Step 4: Create or update the file
-        file_content_encoded = base64.b64encode(policy_content.encode('utf-8')).decode('utf-8')
-        file_data = {
-            'message': commit_message,
-            'content': file_content_encoded,
-            'branch': branch_name
-        }
-        
-        if file_sha:
-            # Update existing file
-            file_data['sha'] = file_sha
-            update_response = requests.put(f'{api_base}/contents/{file_path}', json=file_data, headers=headers)
-            update_response.raise_for_status()
-            logger.info(f"Updated file: {file_path}")
+        api_base = f'{GITHUB_API_URL}/repos/{repo_owner}/{repo_name}'
+
+        # Step 1: Get the default branch and its head commit (usually a free 304)
+        default_branch, base_sha, base_tree = get_default_branch_head(api_base, github_token)
+        logger.info(f"Default branch is {default_branch} with SHA {base_sha}")
+
+        # Step 2: Commit the file on top of the default branch and create the branch at that commit
+        commit_sha = commit_file(api_base, github_token, base_sha, base_tree, file_path, policy_content, commit_message)
+        response = github_request("POST", f'{api_base}/git/refs', github_token, json={
+            'ref': f'refs/heads/{branch_name}',
+            'sha': commit_sha
+        })
+        branch_exists = response.status_code == 422
+        if branch_exists:
+            # Commit on top of the existing branch instead
+            logger.warning(f"Branch {branch_name} already exists. Will update it.")
+            head_sha, head_tree = get_branch_head(api_base, branch_name, github_token)
+            commit_sha = commit_file(api_base, github_token, head_sha, head_tree, file_path, policy_content, commit_message)
+            _checked(github_request("PATCH", f'{api_base}/git/refs/heads/{branch_name}', github_token,
+                                    json={'sha': commit_sha}))
         else:
-            # Create new file
-            create_response = requests.put(f'{api_base}/contents/{file_path}', json=file_data, headers=headers)
-            create_response.raise_for_status()
-            logger.info(f"Created file: {file_path}")
-        
-        # Step 5: Check for existing PRs
-        pr_exists = False
-        pr_number = None
-        pr_url = None
-        
-        prs_response = requests.get(f'{api_base}/pulls?head={repo_owner}:{branch_name}&base={default_branch}&state=open', headers=headers)
-        prs_response.raise_for_status()
-        existing_prs = prs_response.json()
-        
+            _checked(response)
+            logger.info(f"Created new branch: {branch_name}")
+        logger.info(f"Committed {file_path}: {commit_sha}")
+
+        # Step 3: Open a PR, unless the existing branch already has one
+        existing_prs = []
+        if branch_exists:
+            existing_prs = _checked(github_request(
+                "GET", f'{api_base}/pulls', github_token,
+                params={'head': f'{repo_owner}:{branch_name}', 'base': default_branch, 'state': 'open'}
+            ))
+
         if existing_prs:
             # Use existing PR
             pr_exists = True
@@ -150,21 +303,19 @@ def create_github_pr(repo_owner, repo_name, policy_content, file_path, github_to
             logger.info(f"Using existing PR #{pr_number}: {pr_url}")
         else:
             # Create a new PR
-            pr_data = {
+            pr_exists = False
+            pr_result = _checked(github_request("POST", f'{api_base}/pulls', github_token, json={
                 'title': pr_title,
                 'body': pr_description,
                 'head': branch_name,
                 'base': default_branch
-            }
-            
-            pr_response = requests.post(f'{api_base}/pulls', json=pr_data, headers=headers)
-            pr_response.raise_for_status()
-            pr_result = pr_response.json()
-            
+            }))
             pr_number = pr_result['number']
             pr_url = pr_result['html_url']
             logger.info(f"Created new PR #{pr_number}: {pr_url}")
-        
+
+        record_stage("create_pr", time.perf_counter() - start)
+
         # Return success response
         return {
             'success': True,
@@ -173,12 +324,13 @@ def create_github_pr(repo_owner, repo_name, policy_content, file_path, github_to
             'message': f"{'Updated existing' if pr_exists else 'Created new'} PR #{pr_number}",
             'branch': branch_name
         }
-        
+
     except Exception as e:
         error_msg = f"Error creating PR: {str(e)}"
         logger.error(error_msg)
         logger.exception("Exception details:")
-        
+        record_stage("create_pr", time.perf_counter() - start, "error")
+
         return {
             'success': False,
             'error': error_msg
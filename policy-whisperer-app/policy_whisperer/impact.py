@@ -0,0 +1,234 @@
+"""
+Incremental change detection for Conjur policy trees
+
+Indexes the policy files of a git tree into a cross-file reference graph: the
+records each file declares and the records it references without declaring.
+Index entries are keyed by git blob SHA and persisted between runs, so only
+files whose content changed are parsed again.
+
+From a diff, the impacted set is the changed files plus every file that
+references a record whose declaration was added or removed by the change.
+Record ids are taken as written, i.e. files are assumed to be loaded into the
+same policy branch.
+
+Usage:
+    python -m policy_whisperer.impact --base origin/main [--head HEAD] [--policy-dir DIR] [--index FILE]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import logging
+import subprocess
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from policy_whisperer.policy_parser import RECORD_TAGS, STATEMENT_TAGS, parse_policy
+
+logger = logging.getLogger(__name__)
+
+# Where the index is persisted between runs
+POLICY_INDEX_PATH = os.getenv("POLICY_INDEX_PATH", ".policy-index.json")
+
+# Bumped whenever the format of index entries changes
+INDEX_VERSION = 2
+
+POLICY_EXTENSIONS = (".yml", ".yaml")
+
+# A list item tagged with a Conjur record or statement tag, e.g. "- !host app"
+CONJUR_ITEM = re.compile(r"^\s*-\s+!(?:%s)(?:\s|$)" % "|".join(
+    re.escape(tag) for tag in sorted(RECORD_TAGS | STATEMENT_TAGS, key=len, reverse=True)), re.MULTILINE)
+
+def is_policy_file(path: str) -> bool:
+    return path.endswith(POLICY_EXTENSIONS)
+
+def is_policy_content(content: str) -> bool:
+    """
+    Whether a YAML file is a Conjur policy, i.e. a list of Conjur tagged items.
+    Checked on the text rather than the parse so that broken policies still count.
+    """
+    return CONJUR_ITEM.search(content) is not None
+
+def _git(*args: str) -> str:
+    return subprocess.run(["git", *args], check=True, capture_output=True, text=True).stdout
+
+def list_policy_blobs(revision: str, policy_dir: str = ".") -> Dict[str, str]:
+    """
+    Return the blob SHA of every policy file under policy_dir at a revision
+    """
+    blobs = {}
+    for line in _git("ls-tree", "-r", "-z", "--full-name", revision, "--", policy_dir).split("\0"):
+        if not line:
+            continue
+        meta, path = line.split("\t", 1)
+        _, kind, sha = meta.split()
+        if kind == "blob" and is_policy_file(path):
+            blobs[path] = sha
+    return blobs
+
+def read_blobs(shas: Iterable[str]) -> Dict[str, str]:
+    """
+    Read the content of many blobs with a single git process
+    """
+    shas = list(dict.fromkeys(shas))
+    if not shas:
+        return {}
+    output = subprocess.run(["git", "cat-file", "--batch"], input="\n".join(shas).encode() + b"\n",
+                            check=True, capture_output=True).stdout
+    contents = {}
+    offset = 0
+    for sha in shas:
+        end = output.index(b"\n", offset)
+        header = output[offset:end].split()
+        offset = end + 1
+        if len(header) < 3 or header[1] == b"missing":
+            continue
+        size = int(header[2])
+        contents[sha] = output[offset:offset + size].decode("utf-8", errors="replace")
+        offset += size + 1
+    return contents
+
+def index_policy(policy: str) -> Dict[str, Any]:
+    """
+    Return the index entry of a policy: the records it declares, the records
+    it references without declaring them and whether it is a Conjur policy at all
+    """
+    if not is_policy_content(policy):
+        return {"declared": [], "references": [], "valid": False, "policy": False}
+    parsed = parse_policy(policy)
+    declared = parsed.declared()
+    referenced = {fqid for reference in parsed.references for fqid in (reference.source, reference.target)}
+    return {
+        "declared": sorted(declared),
+        "references": sorted(referenced - declared),
+        "valid": parsed.valid,
+        "policy": True
+    }
+
+class PolicyIndex:
+    """
+    Index entries by blob SHA, loaded from and saved to a JSON file
+    """
+
+    def __init__(self, path: Optional[str] = POLICY_INDEX_PATH):
+        self.path = path
+        self.entries = {}
+        self.parsed = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == INDEX_VERSION:
+                    self.entries = data.get("blobs", {})
+                logger.info(f"Loaded {len(self.entries)} policy index entries from {path}")
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable policy index {path}: {e}")
+
+    def get(self, shas: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Return the entries of the given blobs, parsing the ones not indexed yet
+        """
+        shas = set(shas)
+        missing = [sha for sha in shas if sha not in self.entries]
+        for sha, content in read_blobs(missing).items():
+            self.entries[sha] = index_policy(content)
+            self.parsed += 1
+        return {sha: self.entries.get(sha, {"declared": [], "references": [], "valid": False, "policy": False}) for sha in shas}
+
+    def save(self, keep: Set[str]):
+        """
+        Save the index, dropping the entries of blobs not in keep
+        """
+        if not self.path:
+            return
+        self.entries = {sha: entry for sha, entry in self.entries.items() if sha in keep}
+        with open(self.path, "w") as f:
+            json.dump({"version": INDEX_VERSION, "blobs": self.entries}, f, separators=(",", ":"))
+
+def diff_policy_files(base: str, head: str, policy_dir: str = ".") -> List[Tuple[str, Optional[str]]]:
+    """
+    Return the changed policy files as (old path, new path) pairs, with None
+    for the side where the file doesn't exist
+    """
+    fields = _git("diff", "--name-status", "-z", "--no-renames", base, head, "--", policy_dir).split("\0")
+    changes = []
+    for status, path in zip(fields[0::2], fields[1::2]):
+        if not is_policy_file(path):
+            continue
+        if status.startswith("A"):
+            changes.append((None, path))
+        elif status.startswith("D"):
+            changes.append((path, None))
+        else:
+            changes.append((path, path))
+    return changes
+
+def compute_impacted_policies(base: str, head: str = "HEAD", policy_dir: str = ".",
+                              index: Optional[PolicyIndex] = None) -> Dict[str, Any]:
+    """
+    Compute the policy files to revalidate for a change. YAML files that aren't
+    Conjur policies are left out.
+
+    Returns:
+        Dictionary with the changed files, the impacted files (changed files plus
+        the files that reference records declared or removed by the change), the
+        record ids whose declaration changed, and index statistics
+    """
+    start = time.perf_counter()
+    index = index if index is not None else PolicyIndex()
+    changes = diff_policy_files(base, head, policy_dir)
+    head_blobs = list_policy_blobs(head, policy_dir)
+    base_blobs = list_policy_blobs(base, policy_dir) if any(old for old, _ in changes) else {}
+
+    # Records whose declaration was added or removed
+    pairs = [(base_blobs.get(old_path), head_blobs.get(new_path)) for old_path, new_path in changes]
+    entries = index.get(sha for pair in pairs for sha in pair if sha)
+    changed_ids = set()
+    for old_sha, new_sha in pairs:
+        old_declared = set(entries[old_sha]["declared"]) if old_sha else set()
+        new_declared = set(entries[new_sha]["declared"]) if new_sha else set()
+        changed_ids |= old_declared ^ new_declared
+
+    # Other YAML files under policy_dir (workflows, action.yml...) are not policies
+    changed = [new_path for (_, new_path), (_, new_sha) in zip(changes, pairs)
+               if new_sha and entries[new_sha]["policy"]]
+    impacted = set(changed)
+    if changed_ids:
+        # Unchanged files come from the index, only new blobs are parsed
+        entries = index.get(head_blobs.values())
+        for path, sha in head_blobs.items():
+            if path not in impacted and changed_ids.intersection(entries[sha]["references"]):
+                impacted.add(path)
+
+    index.save(set(head_blobs.values()))
+    return {
+        "changed": changed,
+        "impacted": sorted(impacted),
+        "changed_ids": sorted(changed_ids),
+        "parsed": index.parsed,
+        "indexed": len(head_blobs),
+        "duration": round(time.perf_counter() - start, 3)
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List the Conjur policy files impacted by a change")
+    parser.add_argument("--base", required=True, help="Base revision of the change")
+    parser.add_argument("--head", default="HEAD", help="Head revision of the change")
+    parser.add_argument("--policy-dir", default=".", help="Directory containing policy files")
+    parser.add_argument("--index", default=POLICY_INDEX_PATH, help="Index file persisted between runs")
+    parser.add_argument("--format", choices=["text", "json"], default="text", help="Output format")
+    args = parser.parse_args(argv)
+
+    result = compute_impacted_policies(args.base, args.head, args.policy_dir, PolicyIndex(args.index))
+    if args.format == "json":
+        print(json.dumps(result, indent=2))
+    else:
+        print("\n".join(result["impacted"]))
+    print(f"{len(result['impacted'])} impacted policy files ({len(result['changed'])} changed), "
+          f"parsed {result['parsed']} of {result['indexed']} in {result['duration']}s", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
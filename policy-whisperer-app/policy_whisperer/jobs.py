@@ -0,0 +1,360 @@
+"""
+Background jobs for Policy Whisperer
+
+Policy generations can be submitted as jobs that run on a bounded worker pool.
+Clients get a job id immediately and poll (or long-poll) for the result, so
+long generations survive reverse-proxy timeouts and client disconnects.
+
+Workers refresh the updated_at of their queued and running jobs every
+JOB_HEARTBEAT_INTERVAL seconds. Jobs left active by a worker that died are
+marked failed once they haven't been refreshed for JOB_STALE_TIMEOUT seconds,
+when a job manager starts and whenever finished jobs are purged.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from policy_whisperer.response_cache import hash_text, normalize_prompt
+
+logger = logging.getLogger(__name__)
+
+# Job state backend: 'memory' or 'sqlite' (shares job state across workers on a host)
+JOB_BACKEND = os.getenv("JOB_BACKEND", "memory").lower()
+
+# Number of jobs run concurrently per process
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "4"))
+
+# Maximum number of queued and running jobs per process before new jobs are rejected
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "100"))
+
+# Seconds a finished job is kept before it is discarded
+JOB_TTL = int(os.getenv("JOB_TTL", "3600"))
+
+# Seconds between refreshes of the queued and running jobs of a worker
+JOB_HEARTBEAT_INTERVAL = int(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+
+# Seconds without a refresh after which a queued or running job is marked failed
+JOB_STALE_TIMEOUT = int(os.getenv("JOB_STALE_TIMEOUT", "120"))
+
+# Location of the SQLite database used by the sqlite backend
+JOB_DB_PATH = os.getenv(
+    "JOB_DB_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "jobs.db")
+)
+
+# Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+# Error of the jobs whose worker stopped refreshing them
+STALE_JOB_ERROR = "The worker running the job stopped before it finished"
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at its limit"""
+
+class MemoryJobStore:
+    """
+    Job state kept in the memory of the current process
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def save(self, job: Dict[str, Any]):
+        with self._lock:
+            self._jobs[job["id"]] = dict(job)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def find_active(self, dedup_key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            for job in self._jobs.values():
+                if job["dedup_key"] == dedup_key and job["status"] in ACTIVE_STATUSES:
+                    return dict(job)
+        return None
+
+    def touch(self, job_ids, now: float):
+        # Jobs kept in memory can't outlive the worker running them
+        pass
+
+    def purge(self, finished_before: float, stale_before: float):
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job["status"] not in ACTIVE_STATUSES and job["updated_at"] < finished_before
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+class SQLiteJobStore:
+    """
+    Job state kept in a SQLite database, so any worker on the host can answer polls
+    """
+
+    def __init__(self, path: str = JOB_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " dedup_key TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " data TEXT NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key, status)")
+        connection.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def save(self, job: Dict[str, Any]):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO jobs (id, dedup_key, status, updated_at, data) VALUES (?, ?, ?, ?, ?)",
+            (job["id"], job["dedup_key"], job["status"], job["updated_at"], json.dumps(job))
+        )
+        connection.commit()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def find_active(self, dedup_key: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            "SELECT data FROM jobs WHERE dedup_key = ? AND status IN (?, ?) LIMIT 1",
+            (dedup_key, *ACTIVE_STATUSES)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def touch(self, job_ids, now: float):
+        """
+        Refresh the updated_at of the given jobs that are still queued or running
+        """
+        job_ids = list(job_ids)
+        if not job_ids:
+            return
+        connection = self._connection()
+        connection.execute(
+            f"UPDATE jobs SET updated_at = ? WHERE status IN (?, ?) AND id IN ({', '.join('?' * len(job_ids))})",
+            (now, *ACTIVE_STATUSES, *job_ids)
+        )
+        connection.commit()
+
+    def purge(self, finished_before: float, stale_before: float):
+        """
+        Delete the jobs finished before finished_before, and mark failed the
+        queued or running jobs not refreshed since stale_before
+        """
+        connection = self._connection()
+        stale = connection.execute(
+            "SELECT data FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (*ACTIVE_STATUSES, stale_before)
+        ).fetchall()
+        now = time.time()
+        for (data,) in stale:
+            job = json.loads(data)
+            job.update(status=FAILED, error=STALE_JOB_ERROR, updated_at=now)
+            # Skip the job if its worker refreshed or finished it meanwhile
+            cursor = connection.execute(
+                "UPDATE jobs SET status = ?, updated_at = ?, data = ? WHERE id = ? AND status IN (?, ?) AND updated_at < ?",
+                (FAILED, now, json.dumps(job), job["id"], *ACTIVE_STATUSES, stale_before)
+            )
+            if cursor.rowcount:
+                logger.warning(f"Marked stale job {job['id']} failed, its worker stopped refreshing it")
+        connection.execute(
+            "DELETE FROM jobs WHERE status NOT IN (?, ?) AND updated_at < ?",
+            (*ACTIVE_STATUSES, finished_before)
+        )
+        connection.commit()
+
+def create_job_store(name: str = JOB_BACKEND):
+    """
+    Create the job store configured by name
+    """
+    if name == "sqlite":
+        return SQLiteJobStore()
+    if name != "memory":
+        logger.warning(f"Unknown job backend '{name}', using memory")
+    return MemoryJobStore()
+
+class JobManager:
+    """
+    Runs jobs on a bounded thread pool and tracks their state in a job store
+    """
+
+    def __init__(self, store, concurrency: int = JOB_CONCURRENCY, queue_limit: int = JOB_QUEUE_LIMIT,
+                 ttl: int = JOB_TTL, heartbeat_interval: int = JOB_HEARTBEAT_INTERVAL,
+                 stale_timeout: int = JOB_STALE_TIMEOUT):
+        self.store = store
+        self.queue_limit = queue_limit
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_timeout = stale_timeout
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="policy-job")
+        self._pending = 0
+        self._finished = {}
+        self._lock = threading.Lock()
+
+        # Fail the jobs left active by a worker that died
+        self.purge()
+        self._heartbeat = threading.Thread(target=self._refresh_jobs, name="policy-job-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def purge(self):
+        """
+        Discard the expired finished jobs and fail the stale active ones
+        """
+        now = time.time()
+        self.store.purge(now - self.ttl, now - self.stale_timeout)
+
+    def _refresh_jobs(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                job_ids = list(self._finished)
+            try:
+                self.store.touch(job_ids, time.time())
+            except Exception as e:
+                logger.warning(f"Could not refresh {len(job_ids)} jobs: {e}")
+
+    def submit(self, kind: str, params: Dict[str, Any], func: Callable[..., Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Submit a job, or return the identical job that is already queued or running
+
+        Args:
+            kind: Type of job, part of the deduplication key
+            params: Keyword arguments passed to func
+            func: Function that runs the job and returns its result
+
+        Raises:
+            QueueFullError: If the queue is at its limit
+        """
+        self.purge()
+
+        dedup_key = hash_text(json.dumps(
+            [kind, {key: normalize_prompt(value) if key == "user_prompt" else value for key, value in params.items()}],
+            sort_keys=True
+        ))
+
+        with self._lock:
+            existing = self.store.find_active(dedup_key)
+            if existing is not None:
+                logger.info(f"Deduplicated job {kind} onto in-flight job {existing['id']}")
+                return existing
+
+            if self._pending >= self.queue_limit:
+                raise QueueFullError(f"Job queue is full ({self.queue_limit} jobs)")
+
+            now = time.time()
+            job = {
+                "id": uuid.uuid4().hex,
+                "kind": kind,
+                "dedup_key": dedup_key,
+                "status": QUEUED,
+                "result": None,
+                "error": None,
+                "created_at": now,
+                "updated_at": now
+            }
+            self.store.save(job)
+            self._pending += 1
+            self._finished[job["id"]] = threading.Event()
+
+        logger.info(f"Queued job {job['id']} ({kind})")
+        self._executor.submit(self._run, job, params, func)
+        return job
+
+    def _run(self, job: Dict[str, Any], params: Dict[str, Any], func: Callable[..., Dict[str, Any]]):
+        job.update(status=RUNNING, updated_at=time.time())
+        self.store.save(job)
+        started = time.time()
+        try:
+            job["result"] = func(**params)
+            job["status"] = SUCCEEDED
+            logger.info(f"Job {job['id']} succeeded in {time.time() - started:.2f}s")
+        except Exception as e:
+            job["error"] = str(e)
+            job["status"] = FAILED
+            logger.error(f"Job {job['id']} failed: {e}")
+            logger.exception("Exception details:")
+        finally:
+            job["updated_at"] = time.time()
+            self.store.save(job)
+            with self._lock:
+                self._pending -= 1
+                finished = self._finished.pop(job["id"], None)
+            if finished is not None:
+                finished.set()
+
+    def get(self, job_id: str, wait: float = 0) -> Optional[Dict[str, Any]]:
+        """
+        Return the job with the given id, waiting up to wait seconds for it to finish
+        """
+        job = self.store.get(job_id)
+        if job is None or job["status"] not in ACTIVE_STATUSES or wait <= 0:
+            return job
+
+        deadline = time.time() + wait
+        with self._lock:
+            finished = self._finished.get(job_id)
+        if finished is not None:
+            # Job runs in this process, wait for it directly
+            finished.wait(wait)
+            return self.store.get(job_id)
+
+        # Job runs in another worker, poll the shared store
+        while True:
+            job = self.store.get(job_id)
+            remaining = deadline - time.time()
+            if job is None or job["status"] not in ACTIVE_STATUSES or remaining <= 0:
+                return job
+            time.sleep(min(0.5, remaining))
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the number of queued or running jobs in this process and the queue limit
+        """
+        with self._lock:
+            return {"pending": self._pending, "queue_limit": self.queue_limit}
+
+# Shared job manager, created on first use
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+def get_job_manager() -> JobManager:
+    """
+    Return the shared job manager
+    """
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager(create_job_store())
+            logger.info(f"Job manager started with {JOB_BACKEND} backend")
+        return _job_manager
+
+def public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return the fields of a job exposed by the API
+    """
+    return {key: value for key, value in job.items() if key != "dedup_key"}
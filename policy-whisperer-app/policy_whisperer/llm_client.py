@@ -1,11 +1,26 @@
 """
 LLM client setup for Policy Whisperer
+
+Clients are created once per (provider, model or deployment, temperature) and
+reused for every request. All of them share one pooled HTTP client per mode
+(sync and async), so connections to the LLM endpoint are kept alive between
+requests instead of paying for a new TCP and TLS handshake each time.
+
+With LLM_DISPATCH enabled, get_llm returns a model that spreads requests over
+the clients of every provider in LLM_PROVIDERS (see llm_dispatch).
+
+httpx, openai and langchain are imported when the first client is created, so
+importing this module (and the app) stays fast.
 """
 
 import os
 import logging
-from langchain_community.chat_models import ChatOpenAI
-from langchain_openai import AzureChatOpenAI
+import threading
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    import httpx
 
 # Load environment variables for API keys if needed
 from dotenv import load_dotenv
@@ -16,50 +31,248 @@ logger = logging.getLogger(__name__)
 # Get OpenAI API type from environment
 OPENAI_API_TYPE = os.getenv("OPENAI_API_TYPE", "openai").lower()
 
-def get_llm(model_name="gpt-4", temperature=0.7):
+# Providers requests are sent to, in order of preference, e.g. "azure,openai" to fail over to OpenAI
+LLM_PROVIDERS = [provider.strip().lower() for provider in os.getenv("LLM_PROVIDERS", OPENAI_API_TYPE).split(",")
+                 if provider.strip()]
+
+# Whether to send requests through the dispatcher (deadline, retries, hedging and circuit breakers)
+LLM_DISPATCH = os.getenv("LLM_DISPATCH", "true").lower() == "true"
+
+# Maximum connections to the LLM endpoint, and how many idle ones are kept alive
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "10"))
+
+# Seconds to wait for an LLM response, and for a connection to the LLM endpoint
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+
+# Number of times a failed LLM request is retried (by the dispatcher, or else by the OpenAI SDK)
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+
+# Whether to create the LLM clients and connect to the endpoint at app start
+LLM_CLIENT_WARMUP = os.getenv("LLM_CLIENT_WARMUP", "true").lower() == "true"
+
+# Shared HTTP clients and the registry of LLM clients, created on first use
+_http_client = None
+_async_http_client = None
+_http_lock = threading.Lock()
+_llm_clients = {}
+_llm_lock = threading.Lock()
+
+def _http_settings():
+    import httpx
+    return {
+        "limits": httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS
+        ),
+        "timeout": httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+    }
+
+def get_http_client() -> "httpx.Client":
+    """
+    Return the pooled HTTP client shared by all LLM clients
+    """
+    import httpx
+    global _http_client
+    with _http_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(**_http_settings())
+        return _http_client
+
+def get_async_http_client() -> "httpx.AsyncClient":
+    """
+    Return the pooled async HTTP client shared by all LLM clients
+    """
+    import httpx
+    global _async_http_client
+    with _http_lock:
+        if _async_http_client is None:
+            _async_http_client = httpx.AsyncClient(**_http_settings())
+        return _async_http_client
+
+def _client_options():
+    # The dispatcher retries on another endpoint instead
+    return {"timeout": LLM_TIMEOUT, "max_retries": 0 if LLM_DISPATCH else LLM_MAX_RETRIES}
+
+def _create_openai_llm(model_name: str, temperature: float):
+    import openai
+    from langchain_openai import ChatOpenAI
+    llm = ChatOpenAI(model_name=model_name, temperature=temperature, **_client_options())
+    options = dict(api_key=llm.openai_api_key, organization=llm.openai_organization,
+                   base_url=llm.openai_api_base, **_client_options())
+    llm.client = openai.OpenAI(http_client=get_http_client(), **options).chat.completions
+    llm.async_client = openai.AsyncOpenAI(http_client=get_async_http_client(), **options).chat.completions
+    return llm
+
+def _create_azure_llm(deployment_name: str, temperature: float):
+    import openai
+    from langchain_openai import AzureChatOpenAI
+    api_key = os.getenv("AZURE_OPENAI_API_KEY")
+    endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
+    api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2023-05-15")
+
+    # For Azure OpenAI, we don't need to specify model_name, just the deployment name
+    # The model is already associated with the deployment in Azure OpenAI Studio
+    llm = AzureChatOpenAI(
+        openai_api_key=api_key,
+        azure_endpoint=endpoint,
+        azure_deployment=deployment_name,
+        api_version=api_version,
+        temperature=temperature,
+        **_client_options()
+    )
+    options = dict(api_key=api_key, azure_endpoint=endpoint, azure_deployment=deployment_name,
+                   api_version=api_version, **_client_options())
+    llm.client = openai.AzureOpenAI(http_client=get_http_client(), **options).chat.completions
+    llm.async_client = openai.AsyncAzureOpenAI(http_client=get_async_http_client(), **options).chat.completions
+    return llm
+
+@lru_cache(maxsize=None)
+def resolve_llm_keys(model_name: str, temperature: float) -> Tuple[Tuple[str, str, float], ...]:
+    """
+    Return the (provider, model or deployment, temperature) keys of the clients for a model,
+    one per configured provider in LLM_PROVIDERS order. The configuration is read once per
+    model and temperature.
+    """
+    keys = []
+    for provider in LLM_PROVIDERS:
+        if provider == "azure":
+            # Get the appropriate deployment name based on the model
+            # In Azure OpenAI, we use the deployment name directly rather than model name
+            # The deployment name should match what's configured in the Azure portal
+            if "gpt-4" in model_name:
+                deployment_name = os.getenv("AZURE_OPENAI_GPT4_DEPLOYMENT")
+            else:  # For GPT-3.5 models
+                deployment_name = os.getenv("AZURE_OPENAI_GPT35_DEPLOYMENT")
+
+            if all([os.getenv("AZURE_OPENAI_API_KEY"), os.getenv("AZURE_OPENAI_ENDPOINT"), deployment_name]):
+                keys.append(("azure", deployment_name, temperature))
+            else:
+                logger.warning("Azure OpenAI configuration incomplete, skipping it.")
+        elif provider == "openai":
+            keys.append(("openai", model_name, temperature))
+        else:
+            logger.warning(f"Unknown LLM provider {provider}, skipping it.")
+
+    if not keys:
+        logger.warning("No LLM provider configured. Falling back to regular OpenAI.")
+        keys.append(("openai", model_name, temperature))
+    return tuple(dict.fromkeys(keys))
+
+def resolve_llm_key(model_name: str, temperature: float) -> Tuple[str, str, float]:
+    """
+    Return the key of the client of the preferred provider for a model
+    """
+    return resolve_llm_keys(model_name, temperature)[0]
+
+def create_llm(provider: str, model_name: str, temperature: float):
     """
-    Initialize the appropriate language model based on environment configuration
-    """
-    if OPENAI_API_TYPE == "azure":
-        # Get Azure OpenAI configuration from environment
-        api_key = os.getenv("AZURE_OPENAI_API_KEY")
-        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-        api_version = os.getenv("AZURE_OPENAI_API_VERSION", "2023-05-15")
-        
-        # Get the appropriate deployment name based on the model
-        # In Azure OpenAI, we use the deployment name directly rather than model name
-        # The deployment name should match what's configured in the Azure portal
-        if "gpt-4" in model_name:
-            deployment_name = os.getenv("AZURE_OPENAI_GPT4_DEPLOYMENT")
-            logger.info(f"Using GPT-4 deployment: {deployment_name}")
-        else:  # For GPT-3.5 models
-            deployment_name = os.getenv("AZURE_OPENAI_GPT35_DEPLOYMENT")
-            logger.info(f"Using GPT-3.5 deployment: {deployment_name}")
-        
-        if not all([api_key, endpoint, deployment_name]):
-            logger.warning("Azure OpenAI configuration incomplete. Falling back to regular OpenAI.")
-            return ChatOpenAI(model_name=model_name, temperature=temperature)
-        
-        logger.info(f"Using Azure OpenAI with deployment: {deployment_name}")
+    Create a new LLM client that uses the shared HTTP clients
+    """
+    if provider == "azure":
+        logger.info(f"Initializing AzureChatOpenAI with deployment: {model_name}")
         try:
-            # For Azure OpenAI, we don't need to specify model_name, just the deployment name
-            # The model is already associated with the deployment in Azure OpenAI Studio
-            logger.info(f"Initializing AzureChatOpenAI with deployment: {deployment_name}")
-            return AzureChatOpenAI(
-                openai_api_key=api_key,
-                azure_endpoint=endpoint,
-                azure_deployment=deployment_name,
-                api_version=api_version,
-                temperature=temperature,
-                # Don't pass model_name for Azure OpenAI
-                # model_name=model_name
-            )
+            return _create_azure_llm(model_name, temperature)
         except Exception as e:
             logger.error(f"Error initializing Azure OpenAI: {e}")
             logger.exception("Exception details:")
             logger.warning("Falling back to regular OpenAI due to Azure initialization error")
-            return ChatOpenAI(model_name=model_name, temperature=temperature)
-    
-    # Default to regular OpenAI
-    logger.info(f"Using regular OpenAI with model: {model_name}")
-    return ChatOpenAI(model_name=model_name, temperature=temperature)
+            return _create_openai_llm(model_name, temperature)
+
+    logger.info(f"Initializing OpenAI client with model: {model_name}")
+    return _create_openai_llm(model_name, temperature)
+
+def _get_client(key: Tuple[str, str, float]):
+    llm = _llm_clients.get(key)
+    if llm is not None:
+        return llm
+
+    with _llm_lock:
+        llm = _llm_clients.get(key)
+        if llm is None:
+            provider, name, temperature = key
+            llm = create_llm(provider, name, temperature)
+            _llm_clients[key] = llm
+        return llm
+
+def get_llm(model_name="gpt-4", temperature=0.7):
+    """
+    Return the shared language model client for the given model and temperature,
+    creating it based on environment configuration on first use.
+
+    Clients are thread-safe and can be used by concurrent requests.
+    """
+    if not LLM_DISPATCH:
+        return _get_client(resolve_llm_key(model_name, temperature))
+    from policy_whisperer.llm_dispatch import DispatchedChatModel, create_endpoint
+
+    key = ("dispatch", model_name, temperature)
+    llm = _llm_clients.get(key)
+    if llm is not None:
+        return llm
+
+    endpoints = [create_endpoint(f"{provider}:{name}", _get_client((provider, name, temp)))
+                 for provider, name, temp in resolve_llm_keys(model_name, temperature)]
+    with _llm_lock:
+        llm = _llm_clients.get(key)
+        if llm is None:
+            llm = DispatchedChatModel(endpoints=endpoints, max_retries=LLM_MAX_RETRIES)
+            _llm_clients[key] = llm
+        return llm
+
+@lru_cache(maxsize=None)
+def get_prompt_template(template: str):
+    """
+    Return the chat prompt for a template, parsed once per process
+    """
+    from langchain_core.prompts import ChatPromptTemplate
+    return ChatPromptTemplate.from_template(template)
+
+def text_output_parser():
+    """
+    Return a parser that returns the text of an LLM response
+    """
+    from langchain_core.output_parsers import StrOutputParser
+    return StrOutputParser()
+
+def endpoint_clients(llm) -> List:
+    """
+    Return the provider clients behind a client returned by get_llm
+    """
+    from policy_whisperer.llm_dispatch import DispatchedChatModel
+    if isinstance(llm, DispatchedChatModel):
+        return [endpoint.llm for endpoint in llm.endpoints]
+    return [llm]
+
+def warm_llm_clients(models: Iterable[Tuple[str, float]]):
+    """
+    Create the LLM clients for the given (model_name, temperature) pairs and open a
+    connection to each endpoint, so the first request doesn't pay for the TLS handshake
+    """
+    endpoints = set()
+    for model_name, temperature in models:
+        try:
+            for client in endpoint_clients(get_llm(model_name=model_name, temperature=temperature)):
+                endpoints.add(str(client.client._client.base_url))
+        except Exception as e:
+            logger.warning(f"Could not create LLM client for {model_name}: {e}")
+
+    http_client = get_http_client()
+    for endpoint in endpoints:
+        try:
+            # Any response will do, we only want an open keep-alive connection
+            http_client.get(endpoint)
+            logger.info(f"Opened connection to LLM endpoint {endpoint}")
+        except Exception as e:
+            logger.warning(f"Could not connect to LLM endpoint {endpoint}: {e}")
+
+def start_llm_client_warmup(models: Iterable[Tuple[str, float]]) -> Optional[threading.Thread]:
+    """
+    Warm up the LLM clients in a background thread if enabled
+    """
+    if not LLM_CLIENT_WARMUP:
+        return None
+    thread = threading.Thread(target=warm_llm_clients, args=(list(models),), name="llm-warmup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,407 @@
+"""
+LLM request dispatch for Policy Whisperer
+
+Every LLM request goes through a dispatcher holding one endpoint per configured
+provider (e.g. an Azure deployment and OpenAI). A request must complete within
+LLM_DEADLINE seconds. Failed attempts are retried on the next endpoint after a
+jittered backoff. If an endpoint hasn't answered within its p95 latency, a
+hedged request is sent to the next endpoint and the first answer wins. An
+endpoint that keeps failing is skipped by its circuit breaker until
+LLM_BREAKER_RESET seconds have passed.
+"""
+
+import os
+import math
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import httpx
+import openai
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from policy_whisperer.metrics import inc, set_gauge
+
+logger = logging.getLogger(__name__)
+
+# Seconds an LLM request may take, including retries and hedged requests
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "90"))
+
+# Base and maximum backoff in seconds before retrying a failed LLM request
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.5"))
+LLM_RETRY_MAX_BACKOFF = float(os.getenv("LLM_RETRY_MAX_BACKOFF", "8"))
+
+# Whether to send a hedged request to the next endpoint when the first one is slower than its p95
+LLM_HEDGING = os.getenv("LLM_HEDGING", "true").lower() == "true"
+
+# Hedge delay in seconds until an endpoint has LLM_HEDGE_MIN_SAMPLES latency samples
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "10"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+# Consecutive failures that open the circuit breaker of an endpoint, and seconds before it is tried again
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+# Number of recent latencies kept per endpoint to compute the hedge delay
+LATENCY_WINDOW = 200
+
+# Runs the attempts of synchronous requests so they can be hedged and abandoned at the deadline.
+# The threads only wait on the LLM, the shared connection pool limits the requests in flight.
+_dispatch_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="llm-dispatch")
+
+class LLMUnavailableError(Exception):
+    """Raised when every endpoint has an open circuit breaker or the deadline has passed"""
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Whether a failed request may succeed if sent again: timeouts, connection
+    errors, rate limits and server errors
+    """
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (openai.APIConnectionError, httpx.TransportError, TimeoutError, ConnectionError))
+
+def backoff(attempt: int) -> float:
+    """
+    Full-jitter exponential backoff before retry number attempt (0-based)
+    """
+    return random.uniform(0, min(LLM_RETRY_MAX_BACKOFF, LLM_RETRY_BACKOFF * 2 ** attempt))
+
+class CircuitBreaker:
+    """
+    Closed while requests succeed. Opens after LLM_BREAKER_FAILURES consecutive
+    failures, then lets a single trial request through every LLM_BREAKER_RESET
+    seconds until one succeeds.
+    """
+
+    def __init__(self, name: str, failures: int = LLM_BREAKER_FAILURES, reset: float = LLM_BREAKER_RESET):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def available(self) -> bool:
+        """
+        Whether allow() would let a request through, without taking the trial slot
+        """
+        with self._lock:
+            return self._opened_at is None or time.monotonic() - self._opened_at >= self.reset
+
+    def allow(self) -> bool:
+        """
+        Whether to send a request. Only call it for a request about to be sent:
+        an open breaker gives its single trial slot to the first caller.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset:
+                # Half open: let this request through, the next ones wait for its outcome
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"Circuit breaker of LLM endpoint {self.name} closed")
+                set_gauge("llm_circuit_open", 0, endpoint=self.name)
+            self._consecutive_failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self.failures:
+                if self._opened_at is None:
+                    logger.warning(f"Circuit breaker of LLM endpoint {self.name} opened "
+                                   f"after {self._consecutive_failures} failures")
+                    set_gauge("llm_circuit_open", 1, endpoint=self.name)
+                self._opened_at = time.monotonic()
+
+class Endpoint:
+    """
+    An LLM client with its circuit breaker and recent latencies. Streams are kept
+    in a window of their own (time to first chunk) so that the length of the
+    streamed responses doesn't inflate the hedge delay of other requests.
+    """
+
+    def __init__(self, name: str, llm: BaseChatModel, breaker: CircuitBreaker, latencies: deque,
+                 stream_latencies: deque):
+        self.name = name
+        self.llm = llm
+        self.breaker = breaker
+        self.latencies = latencies
+        self.stream_latencies = stream_latencies
+
+    def hedge_delay(self) -> float:
+        """
+        Seconds to wait for this endpoint before sending a hedged request: its p95 latency
+        """
+        samples = sorted(self.latencies)
+        if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return LLM_HEDGE_DELAY
+        return samples[math.ceil(len(samples) * 0.95) - 1]
+
+    def record(self, start: float, error: Optional[BaseException] = None, first_chunk: Optional[float] = None):
+        """
+        Record the outcome of a request started at start; for streams, first_chunk
+        is when the first chunk arrived
+        """
+        if error is None:
+            if first_chunk is None:
+                self.latencies.append(time.monotonic() - start)
+            else:
+                self.stream_latencies.append(first_chunk - start)
+            self.breaker.record_success()
+            inc("llm_attempts_total", endpoint=self.name, result="ok")
+        elif is_retryable(error):
+            self.breaker.record_failure()
+            inc("llm_attempts_total", endpoint=self.name, result="error")
+        elif not isinstance(error, asyncio.CancelledError):
+            # The request itself is wrong, the endpoint is healthy
+            self.breaker.record_success()
+            inc("llm_attempts_total", endpoint=self.name, result="rejected")
+
+# Circuit breakers and latencies are shared by all clients of the same endpoint
+_endpoint_state = {}
+_endpoint_state_lock = threading.Lock()
+
+def create_endpoint(name: str, llm: BaseChatModel) -> Endpoint:
+    """
+    Wrap an LLM client, sharing the breaker and latencies of other clients of the same endpoint
+    """
+    with _endpoint_state_lock:
+        state = _endpoint_state.get(name)
+        if state is None:
+            state = _endpoint_state[name] = (CircuitBreaker(name), deque(maxlen=LATENCY_WINDOW),
+                                             deque(maxlen=LATENCY_WINDOW))
+    return Endpoint(name, llm, *state)
+
+class DispatchedChatModel(BaseChatModel):
+    """
+    Chat model sending each request to the first available of several endpoints,
+    with a deadline, retries, hedged requests and circuit breakers
+    """
+    endpoints: List[Any]
+    deadline: float = LLM_DEADLINE
+    max_retries: int = 2
+    hedging: bool = LLM_HEDGING
+
+    @property
+    def _llm_type(self) -> str:
+        return "dispatched-chat"
+
+    def _available_endpoints(self, attempt: int) -> List[Endpoint]:
+        """
+        Return the endpoint to send a request to, followed by the other available
+        endpoints a hedged request may go to. Only the first one is let through its
+        circuit breaker here; a hedge is let through when it is sent.
+        """
+        # Start each retry on the next endpoint
+        offset = attempt % len(self.endpoints)
+        endpoints = [endpoint for endpoint in self.endpoints[offset:] + self.endpoints[:offset]
+                     if endpoint.breaker.available()]
+        for i, endpoint in enumerate(endpoints):
+            if endpoint.breaker.allow():
+                return endpoints[i:]
+        raise LLMUnavailableError("Every LLM endpoint is failing, try again later")
+
+    def _call(self, endpoint: Endpoint, messages: List[BaseMessage], stop: Optional[List[str]], kwargs) -> ChatResult:
+        start = time.monotonic()
+        try:
+            result = endpoint.llm.generate([messages], stop=stop, **kwargs)
+        except BaseException as e:
+            endpoint.record(start, e)
+            raise
+        endpoint.record(start)
+        return ChatResult(generations=result.generations[0], llm_output=result.llm_output)
+
+    async def _acall(self, endpoint: Endpoint, messages: List[BaseMessage], stop: Optional[List[str]], kwargs) -> ChatResult:
+        start = time.monotonic()
+        try:
+            result = await endpoint.llm.agenerate([messages], stop=stop, **kwargs)
+        except BaseException as e:
+            endpoint.record(start, e)
+            raise
+        endpoint.record(start)
+        return ChatResult(generations=result.generations[0], llm_output=result.llm_output)
+
+    def _retry_wait(self, attempt: int, error: BaseException, deadline: float) -> float:
+        """
+        Seconds to wait before the next attempt; raises the error if it shouldn't be retried
+        """
+        if not is_retryable(error) or attempt >= self.max_retries:
+            raise error
+        delay = backoff(attempt)
+        if time.monotonic() + delay >= deadline:
+            raise LLMUnavailableError(f"LLM request deadline of {self.deadline}s exceeded") from error
+        logger.warning(f"LLM request failed, retrying in {delay:.2f}s: {error}")
+        inc("llm_retries_total")
+        return delay
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                return self._hedged_generate(self._available_endpoints(attempt), messages, stop, kwargs, deadline)
+            except Exception as e:
+                time.sleep(self._retry_wait(attempt, e, deadline))
+                attempt += 1
+
+    def _hedged_generate(self, endpoints: List[Endpoint], messages: List[BaseMessage],
+                         stop: Optional[List[str]], kwargs, deadline: float) -> ChatResult:
+        start = time.monotonic()
+        primary = endpoints[0]
+        futures = {_dispatch_executor.submit(self._call, primary, messages, stop, kwargs): primary}
+        hedge = endpoints[1] if self.hedging and len(endpoints) > 1 else None
+        hedge_at = start + primary.hedge_delay()
+        hedged = False
+        error = None
+
+        while futures:
+            now = time.monotonic()
+            if now >= deadline:
+                # Requests in flight can't be interrupted, their responses are discarded
+                raise LLMUnavailableError(f"LLM request deadline of {self.deadline}s exceeded")
+            timeout = deadline - now
+            if hedge is not None:
+                timeout = max(0, min(timeout, hedge_at - now))
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                endpoint = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if endpoint is not primary:
+                    inc("llm_hedged_requests_total", result="won")
+                elif hedged:
+                    inc("llm_hedged_requests_total", result="lost")
+                return result
+            if hedge is not None and time.monotonic() >= hedge_at and futures:
+                if hedge.breaker.allow():
+                    logger.info(f"LLM endpoint {primary.name} slower than {primary.hedge_delay():.2f}s, "
+                                f"hedging with {hedge.name}")
+                    futures[_dispatch_executor.submit(self._call, hedge, messages, stop, kwargs)] = hedge
+                    hedged = True
+                hedge = None
+        raise error
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                return await asyncio.wait_for(
+                    self._ahedged_generate(self._available_endpoints(attempt), messages, stop, kwargs),
+                    timeout=max(0, deadline - time.monotonic())
+                )
+            except asyncio.TimeoutError as e:
+                raise LLMUnavailableError(f"LLM request deadline of {self.deadline}s exceeded") from e
+            except Exception as e:
+                await asyncio.sleep(self._retry_wait(attempt, e, deadline))
+                attempt += 1
+
+    async def _ahedged_generate(self, endpoints: List[Endpoint], messages: List[BaseMessage],
+                                stop: Optional[List[str]], kwargs) -> ChatResult:
+        primary = endpoints[0]
+        tasks = {asyncio.ensure_future(self._acall(primary, messages, stop, kwargs)): primary}
+        hedge = endpoints[1] if self.hedging and len(endpoints) > 1 else None
+        hedged = False
+        error = None
+        try:
+            while tasks:
+                timeout = primary.hedge_delay() if hedge is not None else None
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    endpoint = tasks.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    if endpoint is not primary:
+                        inc("llm_hedged_requests_total", result="won")
+                    elif hedged:
+                        inc("llm_hedged_requests_total", result="lost")
+                    return result
+                if hedge is not None and tasks:
+                    if hedge.breaker.allow():
+                        logger.info(f"LLM endpoint {primary.name} slower than {timeout:.2f}s, hedging with {hedge.name}")
+                        tasks[asyncio.ensure_future(self._acall(hedge, messages, stop, kwargs))] = hedge
+                        hedged = True
+                    hedge = None
+            raise error
+        finally:
+            # Cancel the slower request
+            for task in tasks:
+                task.cancel()
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        # Streams are not hedged, and only retried until the first chunk arrives
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            endpoint = self._available_endpoints(attempt)[0]
+            start = time.monotonic()
+            first_chunk = None
+            try:
+                for chunk in endpoint.llm.stream(messages, stop=stop, **kwargs):
+                    if first_chunk is None:
+                        first_chunk = time.monotonic()
+                    if run_manager:
+                        run_manager.on_llm_new_token(chunk.content)
+                    yield ChatGenerationChunk(message=chunk)
+            except Exception as e:
+                endpoint.record(start, e)
+                if first_chunk is not None:
+                    raise
+                time.sleep(self._retry_wait(attempt, e, deadline))
+                attempt += 1
+                continue
+            endpoint.record(start, first_chunk=first_chunk if first_chunk is not None else time.monotonic())
+            return
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Any = None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            endpoint = self._available_endpoints(attempt)[0]
+            start = time.monotonic()
+            first_chunk = None
+            try:
+                async for chunk in endpoint.llm.astream(messages, stop=stop, **kwargs):
+                    if first_chunk is None:
+                        first_chunk = time.monotonic()
+                    if run_manager:
+                        await run_manager.on_llm_new_token(chunk.content)
+                    yield ChatGenerationChunk(message=chunk)
+            except Exception as e:
+                endpoint.record(start, e)
+                if first_chunk is not None:
+                    raise
+                await asyncio.sleep(self._retry_wait(attempt, e, deadline))
+                attempt += 1
+                continue
+            endpoint.record(start, first_chunk=first_chunk if first_chunk is not None else time.monotonic())
+            return
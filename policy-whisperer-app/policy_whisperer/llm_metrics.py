@@ -0,0 +1,46 @@
+"""
+LangChain callback recording the LLM requests and tokens of Policy Whisperer
+
+Kept apart from metrics so that recording metrics doesn't import langchain; use
+metrics.llm_callbacks to get the shared callback of a model.
+"""
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from policy_whisperer.metrics import inc
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """
+    Counts the requests and tokens of an LLM. Streamed responses don't report
+    usage, so their completion tokens are counted as they arrive.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self._streamed = {}
+
+    def on_llm_new_token(self, token: str, *, run_id, **kwargs):
+        self._streamed[run_id] = self._streamed.get(run_id, 0) + 1
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        streamed = self._streamed.pop(run_id, 0)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if not usage:
+            # Chat models report usage on the message instead
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + metadata.get("input_tokens", 0)
+                    usage["completion_tokens"] = usage.get("completion_tokens", 0) + metadata.get("output_tokens", 0)
+            if not any(usage.values()):
+                usage = {}
+        inc("llm_requests_total", model=self.model, status="ok")
+        if usage:
+            inc("llm_tokens_total", usage.get("prompt_tokens", 0), model=self.model, type="prompt")
+            inc("llm_tokens_total", usage.get("completion_tokens", 0), model=self.model, type="completion")
+        elif streamed:
+            inc("llm_tokens_total", streamed, model=self.model, type="completion")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._streamed.pop(run_id, None)
+        inc("llm_requests_total", model=self.model, status="error")
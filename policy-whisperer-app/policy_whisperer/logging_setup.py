@@ -0,0 +1,157 @@
+"""
+Logging setup for Policy Whisperer
+
+Request threads only put log records on a bounded in-memory queue; a single
+listener thread formats them and writes them to the console and to a size-rotated
+log file of JSON records, one per line. When the queue is full, records are
+dropped (and counted in log_records_dropped_total) rather than blocking a request.
+
+Prompt and response bodies are large, so they are logged at DEBUG level with
+log_payload, for a LOG_PAYLOAD_SAMPLE_RATE share of calls only, and built only
+when they are logged.
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Callable, Optional
+
+from policy_whisperer.metrics import inc
+
+# Minimum level of the records logged, DEBUG when the DEBUG setting is on
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG" if os.getenv("DEBUG", "False").lower() == "true" else "INFO").upper()
+
+# File of JSON log records, rotated when it reaches LOG_FILE_MAX_BYTES ('' to only log to the console)
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+LOG_FILE_MAX_BYTES = int(os.getenv("LOG_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_FILE_BACKUP_COUNT = int(os.getenv("LOG_FILE_BACKUP_COUNT", "5"))
+
+# Format of the console logs: text or json
+LOG_CONSOLE_FORMAT = os.getenv("LOG_CONSOLE_FORMAT", "text").lower()
+
+# Maximum number of records waiting to be written before new ones are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Share of prompt and response bodies logged at DEBUG level (0 to 1)
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# Attributes of every log record, anything else was passed in extra
+RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime", "taskName"}
+
+# Listener writing the queued records, started by configure_logging
+_listener = None
+_listener_lock = threading.Lock()
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line, with the fields passed in extra
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        data.update((key, value) for key, value in record.__dict__.items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, default=str)
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler that drops records when the queue is full instead of blocking
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message and traceback now, as the arguments may change once
+        # the call returns, but leave the formatting to the listener thread
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            inc("log_records_dropped_total")
+
+def _console_handler() -> logging.Handler:
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JSONFormatter() if LOG_CONSOLE_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+    return handler
+
+def _file_handler() -> Optional[logging.Handler]:
+    if not LOG_FILE:
+        return None
+    try:
+        handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUP_COUNT,
+                                      encoding="utf-8", delay=True)
+    except Exception as e:
+        logging.getLogger(__name__).warning(f"Could not log to {LOG_FILE}: {e}")
+        return None
+    handler.setFormatter(JSONFormatter())
+    return handler
+
+def configure_logging(level: str = LOG_LEVEL):
+    """
+    Send the records of every logger through the queue to the console and the
+    log file. Calling it again only changes the level.
+    """
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(level)
+    with _listener_lock:
+        if _listener is not None:
+            return
+
+        handlers = [handler for handler in (_console_handler(), _file_handler()) if handler is not None]
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(DroppingQueueHandler(log_queue))
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        # Write the records still queued on exit
+        atexit.register(stop_logging)
+
+def stop_logging():
+    """
+    Write the queued records and stop the listener thread
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            try:
+                _listener.stop()
+            except queue.Full:
+                # No room for the stop marker, the queued records are lost with the thread
+                pass
+            _listener = None
+
+def log_payload(logger: logging.Logger, kind: str, build: Callable[[], str], **fields):
+    """
+    Log a prompt or response body at DEBUG level, for a LOG_PAYLOAD_SAMPLE_RATE share of
+    calls. build is only called when the body is logged; fields are added to the record.
+    """
+    if not logger.isEnabledFor(logging.DEBUG) or random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    logger.debug(f"{kind}: {build()}", extra={"payload": kind, **fields})
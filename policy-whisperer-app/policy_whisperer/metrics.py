@@ -0,0 +1,322 @@
+"""
+Timing and metrics for Policy Whisperer
+
+Records the duration of every pipeline stage (example selection, template fetch,
+generation, explanation, PR creation, ...), LLM token counts, cache hits and
+misses, and in-flight requests, and renders them in the Prometheus text format
+for the /metrics endpoint. Stages can also be exported as OpenTelemetry spans
+when the opentelemetry package is installed and OTEL_TRACING_ENABLED is set.
+
+Metrics are kept per process. With METRICS_ENABLED=false every call returns
+immediately.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Whether to record metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# Whether to export stages as OpenTelemetry spans (requires the opentelemetry-api package
+# and a configured SDK/exporter, e.g. via opentelemetry-instrument)
+OTEL_TRACING_ENABLED = os.getenv("OTEL_TRACING_ENABLED", "false").lower() == "true"
+
+# Upper bounds in seconds of the duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIX = "policy_whisperer"
+
+HELP = {
+    "stage_duration_seconds": ("histogram", "Duration of pipeline stages"),
+    "http_request_duration_seconds": ("histogram", "Duration of HTTP requests"),
+    "http_requests_in_flight": ("gauge", "HTTP requests being served"),
+    "llm_tokens_total": ("counter", "LLM tokens used"),
+    "llm_requests_total": ("counter", "LLM requests"),
+    "llm_attempts_total": ("counter", "LLM requests sent to each endpoint, by result"),
+    "llm_retries_total": ("counter", "Retried LLM requests"),
+    "llm_hedged_requests_total": ("counter", "Hedged LLM requests, by whether they answered first"),
+    "llm_circuit_open": ("gauge", "Whether the circuit breaker of an LLM endpoint is open"),
+    "cache_requests_total": ("counter", "Cache lookups by result"),
+    "cache_hit_ratio": ("gauge", "Share of cache lookups that were hits"),
+    "speculative_generations_total": ("counter", "Speculative generations by result: hit, miss, cached or skipped"),
+    "speculation_hit_ratio": ("gauge", "Share of speculative generations that were used"),
+    "speculation_saved_seconds": ("histogram", "Time saved by speculative generations that were used"),
+    "prompt_example_tokens_total": ("counter", "Tokens of prompt examples before (original) and after (sent) compression"),
+    "github_requests_total": ("counter", "GitHub API requests, by method and status"),
+    "github_rate_limited_total": ("counter", "GitHub API requests retried after hitting a rate limit"),
+    "github_rate_limit_remaining": ("gauge", "Requests left in the current GitHub rate limit window, by resource"),
+    "policy_repairs_total": ("counter", "Generated policies by repair outcome: valid, local, llm or failed"),
+    "policy_repair_fixes_total": ("counter", "Fixes applied to generated policies, by fix"),
+    "policy_repair_saved_seconds": ("histogram", "Estimated time saved by repairing a policy instead of generating it again"),
+    "log_records_dropped_total": ("counter", "Log records dropped because the logging queue was full"),
+}
+
+_lock = threading.Lock()
+_counters = {}      # (name, labels) -> value
+_gauges = {}        # (name, labels) -> value
+_histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+
+_tracer = None
+if METRICS_ENABLED and OTEL_TRACING_ENABLED:
+    try:
+        from opentelemetry import trace
+        _tracer = trace.get_tracer("policy_whisperer")
+    except ImportError:
+        logger.warning("OTEL_TRACING_ENABLED is set but opentelemetry is not installed")
+
+def _labels(labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name: str, value: float = 1, **labels):
+    """
+    Increment a counter
+    """
+    if not METRICS_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def add_gauge(name: str, value: float, **labels):
+    """
+    Add to (or, with a negative value, subtract from) a gauge
+    """
+    if not METRICS_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + value
+
+def set_gauge(name: str, value: float, **labels):
+    """
+    Set a gauge
+    """
+    if not METRICS_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _gauges[key] = value
+
+def observe(name: str, value: float, **labels):
+    """
+    Record a value in a histogram
+    """
+    if not METRICS_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+def record_stage(stage: str, seconds: float, status: str = "ok"):
+    """
+    Record the duration of a stage timed by the caller
+    """
+    observe("stage_duration_seconds", seconds, stage=stage, status=status)
+
+def mean_duration(stage: str) -> Optional[float]:
+    """
+    Return the mean duration of the successful runs of a stage, if any were recorded
+    """
+    with _lock:
+        histogram = _histograms.get(("stage_duration_seconds", _labels({"stage": stage, "status": "ok"})))
+        if not histogram:
+            return None
+        return histogram[-2] / histogram[-1]
+
+def record_cache(cache: str, result: str):
+    """
+    Record a cache lookup: result is hits, near_hits, misses or errors
+    """
+    inc("cache_requests_total", cache=cache, result=result)
+
+class _Span:
+    __slots__ = ("stage", "attributes", "start", "otel")
+
+    def __init__(self, stage: str, attributes: Dict[str, Any]):
+        self.stage = stage
+        self.attributes = attributes
+        self.otel = None
+
+    def __enter__(self):
+        if _tracer is not None:
+            self.otel = _tracer.start_as_current_span(self.stage, attributes=self.attributes)
+            self.otel.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            status = "ok"
+        else:
+            status = "cancelled" if issubclass(exc_type, asyncio.CancelledError) else "error"
+        record_stage(self.stage, time.perf_counter() - self.start, status)
+        if self.otel is not None:
+            self.otel.__exit__(exc_type, exc, traceback)
+        return False
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+def span(stage: str, **attributes):
+    """
+    Time a stage of the pipeline:
+
+        with span("generate_policy", model=POLICY_MODEL):
+            ...
+    """
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return _Span(stage, attributes)
+
+def start_request(endpoint: str) -> float:
+    """
+    Count a request as in flight
+
+    Returns:
+        The start time to pass to finish_request
+    """
+    add_gauge("http_requests_in_flight", 1, endpoint=endpoint)
+    return time.perf_counter()
+
+def finish_request(endpoint: str, method: str, status: int, start: float):
+    """
+    Record the duration of a request started with start_request
+    """
+    add_gauge("http_requests_in_flight", -1, endpoint=endpoint)
+    observe("http_request_duration_seconds", time.perf_counter() - start,
+            endpoint=endpoint, method=method, status=status)
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the in-flight count and duration of the requests
+    of one endpoint, including the time spent streaming the response body
+    """
+
+    def __init__(self, app, endpoint: str):
+        self.app = app
+        self.endpoint = endpoint
+
+    async def __call__(self, scope, receive, send):
+        if not METRICS_ENABLED or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = start_request(self.endpoint)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            finish_request(self.endpoint, scope["method"], status, start)
+
+_llm_callbacks = {}
+
+def llm_callbacks(model: str) -> List[Any]:
+    """
+    Return the callbacks that record the metrics of an LLM, for with_config(callbacks=...)
+    """
+    if not METRICS_ENABLED:
+        return []
+    # Imported on first use, so importing the metrics doesn't import langchain
+    from policy_whisperer.llm_metrics import LLMMetricsCallback
+    with _lock:
+        callback = _llm_callbacks.get(model)
+        if callback is None:
+            callback = _llm_callbacks[model] = LLMMetricsCallback(model)
+    return [callback]
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def render_prometheus() -> str:
+    """
+    Render all metrics in the Prometheus text exposition format
+    """
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {key: list(values) for key, values in _histograms.items()}
+
+    # Hit ratio of each cache, from its lookup counters
+    lookups = {}
+    for (name, labels), value in counters.items():
+        if name == "cache_requests_total":
+            labels = dict(labels)
+            totals = lookups.setdefault(labels["cache"], [0, 0])
+            if labels["result"] in ("hits", "near_hits"):
+                totals[0] += value
+            if labels["result"] != "errors":
+                totals[1] += value
+    for cache, (hits, total) in lookups.items():
+        gauges[("cache_hit_ratio", (("cache", cache),))] = hits / total if total else 0.0
+
+    speculations = {dict(labels)["result"]: value for (name, labels), value in counters.items()
+                     if name == "speculative_generations_total"}
+    if speculations.get("hit") or speculations.get("miss"):
+        hits = speculations.get("hit", 0)
+        gauges[("speculation_hit_ratio", ())] = hits / (hits + speculations.get("miss", 0))
+
+    lines = []
+    for metric, (kind, description) in HELP.items():
+        samples = counters if kind == "counter" else gauges if kind == "gauge" else histograms
+        series = sorted((labels, value) for (name, labels), value in samples.items() if name == metric)
+        if not series:
+            continue
+        lines.append(f"# HELP {PREFIX}_{metric} {description}")
+        lines.append(f"# TYPE {PREFIX}_{metric} {kind}")
+        for labels, value in series:
+            if kind != "histogram":
+                lines.append(f"{PREFIX}_{metric}{_format_labels(labels)} {_format_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS, value):
+                cumulative += count
+                lines.append(f"{PREFIX}_{metric}_bucket{_format_labels(labels, ('le', repr(bound)))} {cumulative}")
+            lines.append(f"{PREFIX}_{metric}_bucket{_format_labels(labels, ('le', '+Inf'))} {value[-1]}")
+            lines.append(f"{PREFIX}_{metric}_sum{_format_labels(labels)} {_format_number(value[-2])}")
+            lines.append(f"{PREFIX}_{metric}_count{_format_labels(labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+def reset_metrics():
+    """
+    Clear all recorded metrics
+    """
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
@@ -0,0 +1,392 @@
+"""
+Effective-permission graph for Conjur policies
+
+Models the roles of a policy tree (users, hosts, groups, layers and policies),
+their memberships from !grant, the privileges of !permit and ownership, and
+answers questions such as "what can host X read?" or "who can authenticate to
+webservice Y?".
+
+Role memberships are transitive, so the closure is precomputed when the graph
+is built: every role gets a bitset (a Python int) of the roles it has.
+Strongly connected components are collapsed first, so each closure is computed
+once, and permission checks are bitwise ANDs.
+
+The owner of a record has every privilege on it, and the owner of a role is a
+member of that role. Records without an owner are owned by their enclosing
+policy. Record ids are taken as written, i.e. files are assumed to be loaded
+into the same policy branch.
+
+Usage:
+    python -m policy_whisperer.permissions POLICY_DIR --role host:app1/ci [--privilege read]
+    python -m policy_whisperer.permissions POLICY_DIR --resource webservice:conjur/authn-jwt/github --privilege authenticate
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional
+
+from policy_whisperer.impact import is_policy_file
+from policy_whisperer.policy_parser import ParsedPolicy, parse_policy
+from policy_whisperer.validator import VALID_PRIVILEGES
+
+logger = logging.getLogger(__name__)
+
+# Policy tree indexed for the /api/permissions endpoints
+POLICY_GRAPH_DIR = os.getenv("POLICY_GRAPH_DIR", "")
+
+# Kinds of records that are roles
+ROLE_KINDS = {"user", "host", "group", "layer", "policy"}
+
+# Privileges of the owner of a resource
+OWNER_PRIVILEGES = tuple(sorted(VALID_PRIVILEGES))
+
+# Shared graph of POLICY_GRAPH_DIR, built on first use
+_permission_graph = None
+_permission_graph_lock = threading.Lock()
+
+def _bits(bitset: int) -> Iterator[int]:
+    while bitset:
+        low = bitset & -bitset
+        yield low.bit_length() - 1
+        bitset ^= low
+
+def transitive_closure(edges: List[List[int]]) -> List[int]:
+    """
+    Return, for each node, the bitset of nodes reachable from it through at least
+    one edge (so a node is only in its own closure if it is part of a cycle)
+
+    Uses an iterative Tarjan SCC pass: components are completed in reverse
+    topological order, so the closures of their successors are always ready.
+    """
+    count = len(edges)
+    closure = [0] * count
+    index = [-1] * count
+    lowlink = [0] * count
+    on_stack = [False] * count
+    stack = []
+    counter = 0
+
+    for root in range(count):
+        if index[root] != -1:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, position = work.pop()
+            if position == 0:
+                index[node] = lowlink[node] = counter
+                counter += 1
+                stack.append(node)
+                on_stack[node] = True
+            recurse = False
+            for position in range(position, len(edges[node])):
+                successor = edges[node][position]
+                if index[successor] == -1:
+                    work.append((node, position + 1))
+                    work.append((successor, 0))
+                    recurse = True
+                    break
+                if on_stack[successor]:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            if recurse:
+                continue
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                reach = 0
+                for member in component:
+                    for successor in edges[member]:
+                        # Successors outside the component are already complete,
+                        # the closures of the ones inside are still empty
+                        reach |= (1 << successor) | closure[successor]
+                for member in component:
+                    closure[member] = reach
+    return closure
+
+class PermissionGraph:
+    """
+    Roles, memberships, privileges and ownership of a set of policies
+    """
+
+    def __init__(self):
+        self.roles = []                 # role fqid by index, available after finalize
+        self.role_index = {}            # index by role fqid
+        self.resources = set()
+        self._role_set = {}             # role fqids in insertion order
+        self._memberships = {}          # member fqid -> role fqids granted to it
+        self._owners = {}               # resource fqid -> owner role fqid
+        self._permitted = {}            # resource fqid -> privilege -> role fqids
+        self._revoked = set()
+        self._denied = set()
+        self._parents = []              # direct memberships of each role
+        self._children = []             # direct members of each role
+        self._closure = []              # roles each role has through memberships
+        self._permits = {}              # resource -> privilege -> bitset of roles
+        self._role_permits = []         # (resource, privileges) permitted directly to each role
+        self._owned = []                # resources owned by each role
+        self.files = 0
+        self.build_seconds = 0.0
+
+    def _add_role(self, fqid: str):
+        self._role_set.setdefault(fqid, None)
+
+    def add_policy(self, parsed: ParsedPolicy):
+        """
+        Add the records and statements of a parsed policy
+        """
+        self.files += 1
+        for node in parsed.records:
+            self.resources.add(node.fqid)
+            if node.tag in ROLE_KINDS:
+                self._add_role(node.fqid)
+            owner = node.owner or (f"policy:{node.path}" if node.path else None)
+            if owner:
+                self._add_role(owner)
+                self._owners[node.fqid] = owner
+
+        for reference in parsed.references:
+            if reference.relation == "member":
+                self._add_role(reference.source)
+                self._add_role(reference.target)
+                self._memberships.setdefault(reference.source, set()).add(reference.target)
+            elif reference.relation == "revoke":
+                self._revoked.add((reference.source, reference.target))
+            elif reference.relation == "permit":
+                self._add_role(reference.source)
+                self.resources.add(reference.target)
+                privileges = self._permitted.setdefault(reference.target, {})
+                for privilege in reference.privileges:
+                    privileges.setdefault(privilege, set()).add(reference.source)
+            elif reference.relation == "deny":
+                for privilege in reference.privileges:
+                    self._denied.add((reference.source, privilege, reference.target))
+
+    def finalize(self):
+        """
+        Apply revocations and denials and precompute the membership closures
+        """
+        for member, role in self._revoked:
+            self._memberships.get(member, set()).discard(role)
+        for role, privilege, resource in self._denied:
+            self._permitted.get(resource, {}).get(privilege, set()).discard(role)
+
+        # The owner of a role is a member of it
+        for resource, owner in self._owners.items():
+            if resource in self._role_set:
+                self._memberships.setdefault(owner, set()).add(resource)
+
+        # Bitsets take as many bytes as their highest bit, so give the low bits
+        # to the roles with the most members, which appear in the most closures
+        member_counts = Counter(role for roles in self._memberships.values() for role in roles)
+        self.roles = sorted(self._role_set, key=lambda role: -member_counts[role])
+        self.role_index = {role: index for index, role in enumerate(self.roles)}
+
+        self._parents = [[] for _ in self.roles]
+        self._children = [[] for _ in self.roles]
+        for member, roles in self._memberships.items():
+            for role in roles:
+                self._parents[self.role_index[member]].append(self.role_index[role])
+                self._children[self.role_index[role]].append(self.role_index[member])
+        self._closure = transitive_closure(self._parents)
+
+        self._role_permits = [[] for _ in self.roles]
+        self._permits = {}
+        for resource, privileges in self._permitted.items():
+            by_role = {}
+            for privilege, roles in privileges.items():
+                bitset = 0
+                for role in roles:
+                    bitset |= 1 << self.role_index[role]
+                    by_role.setdefault(role, []).append(privilege)
+                self._permits.setdefault(resource, {})[privilege] = bitset
+            for role, granted in by_role.items():
+                self._role_permits[self.role_index[role]].append((resource, tuple(sorted(granted))))
+
+        self._owned = [[] for _ in self.roles]
+        for resource, owner in self._owners.items():
+            self._owned[self.role_index[owner]].append(resource)
+
+    def _index(self, role: str) -> int:
+        if role not in self.role_index:
+            raise KeyError(f"Unknown role: {role}")
+        return self.role_index[role]
+
+    def _roles_of(self, role: str) -> int:
+        index = self._index(role)
+        return self._closure[index] | (1 << index)
+
+    def memberships(self, role: str) -> List[str]:
+        """
+        Return every role the role has, directly or through other roles
+        """
+        index = self._index(role)
+        return sorted(self.roles[i] for i in _bits(self._closure[index]) if i != index)
+
+    def permissions(self, role: str, privilege: Optional[str] = None) -> Dict[str, List[str]]:
+        """
+        Return the resources the role has privileges on, with those privileges
+        """
+        permissions = {}
+        for index in _bits(self._roles_of(role)):
+            for resource, privileges in self._role_permits[index]:
+                permissions.setdefault(resource, set()).update(privileges)
+            for resource in self._owned[index]:
+                permissions.setdefault(resource, set()).update(OWNER_PRIVILEGES)
+        return {
+            resource: sorted(privileges) for resource, privileges in sorted(permissions.items())
+            if privilege is None or privilege in privileges
+        }
+
+    def _granted(self, resource: str, privilege: str) -> int:
+        granted = self._permits.get(resource, {}).get(privilege, 0)
+        if resource in self._owners:
+            granted |= 1 << self.role_index[self._owners[resource]]
+        return granted
+
+    def authorized_roles(self, resource: str, privilege: str) -> List[str]:
+        """
+        Return every role that has the privilege on the resource
+        """
+        if resource not in self.resources:
+            raise KeyError(f"Unknown resource: {resource}")
+        # Walk down the memberships from the roles granted the privilege; the
+        # walk only visits the roles in the answer
+        pending = list(_bits(self._granted(resource, privilege)))
+        seen = set(pending)
+        while pending:
+            for member in self._children[pending.pop()]:
+                if member not in seen:
+                    seen.add(member)
+                    pending.append(member)
+        return sorted(self.roles[i] for i in seen)
+
+    def is_allowed(self, role: str, privilege: str, resource: str) -> bool:
+        """
+        Return whether the role has the privilege on the resource
+        """
+        return bool(self._roles_of(role) & self._granted(resource, privilege))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "files": self.files,
+            "roles": len(self.roles),
+            "resources": len(self.resources),
+            "memberships": sum(len(edges) for edges in self._parents),
+            "permits": sum(len(permits) for permits in self._role_permits),
+            "closure_bytes": sum(sys.getsizeof(bitset) for bitset in {id(b): b for b in self._closure}.values()),
+            "build_seconds": round(self.build_seconds, 3)
+        }
+
+def list_policy_files(paths: List[str]) -> List[str]:
+    """
+    Expand directories into the policy files they contain
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+                files.extend(os.path.join(root, name) for name in sorted(names) if is_policy_file(name))
+        else:
+            files.append(path)
+    return files
+
+def build_permission_graph(paths: List[str] = None, policies: Dict[str, str] = None) -> PermissionGraph:
+    """
+    Build the permission graph of policy files (or directories) and/or policy texts
+    """
+    start = time.perf_counter()
+    graph = PermissionGraph()
+    for path in list_policy_files(paths or []):
+        try:
+            with open(path, "r") as f:
+                parsed = parse_policy(f.read())
+        except OSError as e:
+            logger.warning(f"Skipping unreadable policy file {path}: {e}")
+            continue
+        if not parsed.valid:
+            logger.warning(f"Skipping invalid policy file {path}")
+            continue
+        graph.add_policy(parsed)
+    for name, policy in (policies or {}).items():
+        parsed = parse_policy(policy)
+        if not parsed.valid:
+            raise ValueError(f"Invalid policy {name}: {parsed.error}")
+        graph.add_policy(parsed)
+    graph.finalize()
+    graph.build_seconds = time.perf_counter() - start
+    logger.info(f"Built permission graph: {graph.stats()}")
+    return graph
+
+def get_permission_graph() -> Optional[PermissionGraph]:
+    """
+    Return the shared permission graph of POLICY_GRAPH_DIR, or the graph last set
+    with set_permission_graph
+    """
+    global _permission_graph
+    with _permission_graph_lock:
+        if _permission_graph is None and POLICY_GRAPH_DIR:
+            _permission_graph = build_permission_graph([POLICY_GRAPH_DIR])
+        return _permission_graph
+
+def set_permission_graph(graph: PermissionGraph):
+    """
+    Replace the shared permission graph
+    """
+    global _permission_graph
+    with _permission_graph_lock:
+        _permission_graph = graph
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the effective permissions of Conjur policies")
+    parser.add_argument("paths", nargs="+", help="Policy files or directories")
+    parser.add_argument("--role", help="List the resources this role has privileges on")
+    parser.add_argument("--resource", help="List the roles that have --privilege on this resource")
+    parser.add_argument("--privilege", help="Privilege to filter on (required with --resource)")
+    parser.add_argument("--stats", action="store_true", help="Report index build time and memory")
+    args = parser.parse_args(argv)
+
+    if args.stats:
+        tracemalloc.start()
+    graph = build_permission_graph(args.paths)
+    output = {}
+    if args.stats:
+        output["stats"] = dict(graph.stats(), peak_memory_bytes=tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    start = time.perf_counter()
+    try:
+        if args.role and args.resource:
+            output["allowed"] = graph.is_allowed(args.role, args.privilege or "read", args.resource)
+        elif args.role:
+            output["memberships"] = graph.memberships(args.role)
+            output["permissions"] = graph.permissions(args.role, args.privilege)
+        elif args.resource:
+            if not args.privilege:
+                parser.error("--resource requires --privilege")
+            output["roles"] = graph.authorized_roles(args.resource, args.privilege)
+    except KeyError as e:
+        print(e.args[0], file=sys.stderr)
+        return 1
+    if args.role or args.resource:
+        output["lookup_ms"] = round((time.perf_counter() - start) * 1000, 3)
+
+    print(json.dumps(output, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
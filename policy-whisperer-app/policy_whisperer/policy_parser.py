@@ -0,0 +1,260 @@
+"""
+Conjur policy parser for Policy Whisperer
+
+Builds an AST of a Conjur policy from the YAML node graph produced by
+ConjurPolicyLoader. Records (policies, hosts, groups, variables, ...) keep their
+tag, id, fully qualified id, owner and enclosing policy, and statements (grant,
+permit, ...) are turned into references between fully qualified ids. Everything
+is computed in one pass over the document, and parse results are cached by
+policy text so a policy is parsed once per request.
+"""
+
+import logging
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import yaml
+
+from policy_whisperer.utils import ConjurPolicyLoader
+
+logger = logging.getLogger(__name__)
+
+# Tags that declare a record
+RECORD_TAGS = {"policy", "user", "host", "group", "layer", "variable", "webservice", "host-factory"}
+
+# Tags of statements that relate records to each other
+STATEMENT_TAGS = {"grant", "revoke", "permit", "deny", "delete"}
+
+# Composing the node graph doesn't need the tag constructors of ConjurPolicyLoader,
+# so use the much faster libyaml loader when it is available
+COMPOSE_LOADER = getattr(yaml, "CSafeLoader", ConjurPolicyLoader)
+
+# Resource types always present in the counts, in the order used by the API
+RESOURCE_COUNT_TAGS = ["policy", "user", "host", "group", "variable", "grant", "permit", "webservice"]
+
+class PolicyNode(NamedTuple):
+    """A record or statement of a policy"""
+    tag: str
+    id: str                 # id as written in the policy ('' for statements)
+    fqid: str               # kind:full/id of a record ('' for statements)
+    owner: Optional[str]    # fqid of the owner role, if given
+    path: str               # full id of the enclosing policy ('' at the root)
+    line: int
+    annotations: Dict[str, str]
+    fields: Tuple[str, ...]  # attribute names given in mapping form
+
+class PolicyReference(NamedTuple):
+    """An edge of the reference graph"""
+    source: str             # fqid of the member, role or owned record
+    relation: str           # member, revoke, permit, deny, owner or delete
+    target: str             # fqid of the role, resource, owner or deleted record
+    privileges: Tuple[str, ...]
+    line: int
+
+class ParsedPolicy:
+    """
+    Result of parsing a policy. If the policy can't be parsed, error (and error_line
+    when known) is set and the policy has no records, statements or references.
+    Entries the parser had to skip are listed in problems as (line, message) pairs.
+    """
+
+    def __init__(self, records: List[PolicyNode], statements: List[PolicyNode],
+                 references: List[PolicyReference], problems: Optional[List[Tuple[int, str]]] = None,
+                 error: Optional[str] = None, error_line: Optional[int] = None):
+        self.records = records
+        self.statements = statements
+        self.references = references
+        self.problems = problems or []
+        self.error = error
+        self.error_line = error_line
+
+    @property
+    def valid(self) -> bool:
+        return self.error is None
+
+    def counts(self) -> Dict[str, int]:
+        """
+        Return the number of records and statements of each type
+        """
+        counts = dict.fromkeys(RESOURCE_COUNT_TAGS, 0)
+        counts.update(Counter(node.tag for node in self.records))
+        counts.update(Counter(node.tag for node in self.statements))
+        return counts
+
+    def declared(self) -> Set[str]:
+        """
+        Return the fully qualified ids of the records declared by the policy
+        """
+        return {node.fqid for node in self.records}
+
+    def reference_graph(self) -> Dict[str, List[Tuple[str, str]]]:
+        """
+        Return the references of each fully qualified id as (relation, target) pairs
+        """
+        graph = {}
+        for reference in self.references:
+            graph.setdefault(reference.source, []).append((reference.relation, reference.target))
+        return graph
+
+    def undeclared_references(self) -> List[PolicyReference]:
+        """
+        Return the references to records that the policy does not declare
+        """
+        declared = self.declared()
+        return [
+            reference for reference in self.references
+            if reference.relation != "delete"
+            and (reference.source not in declared or reference.target not in declared)
+        ]
+
+def qualify(kind: str, record_id: str, path: str) -> str:
+    """
+    Return the fully qualified id of a record relative to the enclosing policy.
+    Absolute ids start with '/', and an empty id refers to the enclosing policy itself.
+    """
+    if record_id.startswith("/"):
+        full_id = record_id[1:]
+    elif not record_id:
+        full_id = path
+    else:
+        full_id = f"{path}/{record_id}" if path else record_id
+    return f"{kind}:{full_id}"
+
+def _tag(node: yaml.Node) -> Optional[str]:
+    return node.tag[1:] if node.tag.startswith("!") else None
+
+def _mapping(node: yaml.Node) -> Dict[str, yaml.Node]:
+    if not isinstance(node, yaml.MappingNode):
+        return {}
+    return {key.value: value for key, value in node.value if isinstance(key, yaml.ScalarNode)}
+
+def _scalars(node: Optional[yaml.Node]) -> Tuple[str, ...]:
+    if isinstance(node, yaml.ScalarNode):
+        return tuple(value.strip() for value in node.value.split(",") if value.strip())
+    if isinstance(node, yaml.SequenceNode):
+        return tuple(value for item in node.value for value in _scalars(item))
+    return ()
+
+def _record_id(node: yaml.Node) -> str:
+    if isinstance(node, yaml.ScalarNode):
+        return str(node.value)
+    id_node = _mapping(node).get("id")
+    return str(id_node.value) if isinstance(id_node, yaml.ScalarNode) else ""
+
+def _references(node: Optional[yaml.Node], path: str) -> Iterator[str]:
+    """
+    Yield the fully qualified ids referenced by a node: a tagged record, a !member,
+    or a (possibly aliased or nested) sequence of them
+    """
+    if node is None:
+        return
+    if isinstance(node, yaml.SequenceNode) and _tag(node) is None:
+        for item in node.value:
+            yield from _references(item, path)
+        return
+    tag = _tag(node)
+    if tag == "member":
+        # !member wraps the role of a grant with options such as admin_option
+        yield from _references(_mapping(node).get("role"), path)
+    elif tag is not None:
+        yield qualify(tag, _record_id(node), path)
+
+class _PolicyWalker:
+    def __init__(self):
+        self.records = []
+        self.statements = []
+        self.references = []
+        self.problems = []
+        self._seen = set()
+
+    def walk(self, node: yaml.Node, path: str):
+        if not isinstance(node, yaml.SequenceNode):
+            raise ValueError(f"Expected a list of policy statements at line {node.start_mark.line + 1}")
+        for item in node.value:
+            # Aliases point at the same node, declare it only once
+            if id(item) in self._seen:
+                continue
+            self._seen.add(id(item))
+
+            tag = _tag(item)
+            if tag is None:
+                if isinstance(item, yaml.SequenceNode):
+                    # Anchored list of records, e.g. - &hosts [ ... ]
+                    self.walk(item, path)
+                else:
+                    self.problems.append((item.start_mark.line + 1, "Statement has no tag (e.g. '- !host')"))
+                continue
+            if tag in STATEMENT_TAGS:
+                self._statement(tag, item, path)
+            else:
+                self._record(tag, item, path)
+
+    def _record(self, tag: str, node: yaml.Node, path: str):
+        fields = _mapping(node)
+        record_id = _record_id(node)
+        fqid = qualify(tag, record_id, path)
+        line = node.start_mark.line + 1
+
+        owner = next(_references(fields.get("owner"), path), None)
+        if owner is not None:
+            self.references.append(PolicyReference(fqid, "owner", owner, (), line))
+
+        annotations = {
+            key: str(value.value) for key, value in _mapping(fields.get("annotations")).items()
+            if isinstance(value, yaml.ScalarNode)
+        }
+        self.records.append(PolicyNode(tag, record_id, fqid, owner, path, line, annotations, tuple(fields)))
+
+        if tag == "policy" and "body" in fields:
+            if isinstance(fields["body"], yaml.SequenceNode):
+                self.walk(fields["body"], fqid.split(":", 1)[1])
+            else:
+                self.problems.append((fields["body"].start_mark.line + 1, "Policy body must be a list of statements"))
+
+    def _statement(self, tag: str, node: yaml.Node, path: str):
+        fields = _mapping(node)
+        line = node.start_mark.line + 1
+        self.statements.append(PolicyNode(tag, "", "", None, path, line, {}, tuple(fields)))
+
+        if tag in ("grant", "revoke"):
+            relation = "member" if tag == "grant" else "revoke"
+            roles = list(_references(fields.get("role"), path))
+            members = list(_references(fields.get("member", fields.get("members")), path))
+            for member in members:
+                for role in roles:
+                    self.references.append(PolicyReference(member, relation, role, (), line))
+        elif tag in ("permit", "deny"):
+            privileges = _scalars(fields.get("privilege", fields.get("privileges")))
+            roles = list(_references(fields.get("role"), path))
+            resources = list(_references(fields.get("resource", fields.get("resources")), path))
+            for role in roles:
+                for resource in resources:
+                    self.references.append(PolicyReference(role, tag, resource, privileges, line))
+        elif tag == "delete":
+            for record in _references(fields.get("record"), path):
+                self.references.append(PolicyReference(qualify("policy", "", path), "delete", record, (), line))
+
+@lru_cache(maxsize=256)
+def parse_policy(policy: str) -> ParsedPolicy:
+    """
+    Parse a Conjur policy into records, statements and references
+
+    Results are cached by policy text and must not be modified.
+    """
+    try:
+        document = yaml.compose(policy, Loader=COMPOSE_LOADER)
+        walker = _PolicyWalker()
+        if document is not None:
+            walker.walk(document, "")
+        return ParsedPolicy(walker.records, walker.statements, walker.references, walker.problems)
+    except Exception as e:
+        logger.warning(f"Error parsing policy: {e}")
+        mark = getattr(e, "problem_mark", None)
+        return ParsedPolicy([], [], [], error=str(e), error_line=mark.line + 1 if mark else None)
+
+def analyze_policy_resources(policy: str) -> Dict[str, int]:
+    """
+    Analyze a policy to count the different types of resources it contains
+    """
+    return parse_policy(policy).counts()
@@ -0,0 +1,231 @@
+"""
+Token-budgeted examples for the policy generation prompt
+
+Fetched templates can be long, so before they are added to the prompt they are
+compressed: comments and compliance/audit annotations are removed (the prompt
+tells the model to ignore them), and records repeated verbatim from a more
+relevant example are left out. If the examples still exceed
+PROMPT_EXAMPLES_TOKEN_BUDGET, the least relevant ones are truncated or dropped.
+"""
+
+import os
+import re
+import logging
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+
+from policy_whisperer.metrics import inc
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of tokens of the examples section of the generation prompt
+PROMPT_EXAMPLES_TOKEN_BUDGET = int(os.getenv("PROMPT_EXAMPLES_TOKEN_BUDGET", "3000"))
+
+# Whether to strip comments, compliance annotations and repeated records from examples
+PROMPT_COMPRESSION = os.getenv("PROMPT_COMPRESSION", "true").lower() == "true"
+
+# tiktoken encoding used to count tokens. tiktoken downloads encodings on first use;
+# without network access tokens are estimated from words and punctuation instead.
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "cl100k_base")
+
+# Examples truncated below this many tokens are dropped instead
+MIN_EXAMPLE_TOKENS = 100
+
+# Annotation keys the model is told to ignore
+IGNORED_ANNOTATION_PATTERN = re.compile(r"^\s*[\w./-]*(?:compliance|audit)[\w./-]*\s*:", re.IGNORECASE)
+
+RECORD_START_PATTERN = re.compile(r"^(\s*)- !\w+")
+ESTIMATE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+_token_counter = None
+_token_counter_lock = threading.Lock()
+
+class BudgetedExamples(NamedTuple):
+    text: str
+    original_tokens: int
+    tokens: int
+    dropped: List[str]
+
+def get_token_counter() -> Callable[[str], int]:
+    """
+    Return the function used to count tokens, loading the tokenizer on first use
+    """
+    global _token_counter
+    with _token_counter_lock:
+        if _token_counter is None:
+            try:
+                import tiktoken
+                encoding = tiktoken.get_encoding(PROMPT_TOKENIZER)
+                _token_counter = lambda text: len(encoding.encode(text, disallowed_special=()))
+            except Exception as e:
+                logger.warning(f"Could not load the {PROMPT_TOKENIZER} tokenizer, estimating token counts: {e}")
+                _token_counter = lambda text: len(ESTIMATE_PATTERN.findall(text))
+    return _token_counter
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens of a text
+    """
+    return get_token_counter()(text)
+
+def _strip_comment(line: str) -> str:
+    stripped = line.lstrip()
+    if stripped.startswith("#"):
+        return ""
+    # Leave lines with quotes alone, '#' may be part of a string
+    if " #" in line and "'" not in line and '"' not in line:
+        line = line[:line.index(" #")]
+    return line.rstrip()
+
+def compress_example(content: str) -> str:
+    """
+    Remove comments, blank lines and compliance/audit annotations from a policy
+    """
+    lines = []
+    for line in content.splitlines():
+        line = _strip_comment(line)
+        if not line.strip() or IGNORED_ANNOTATION_PATTERN.match(line):
+            continue
+        lines.append(line)
+
+    # Drop annotations blocks left empty
+    result = []
+    for i, line in enumerate(lines):
+        if line.strip() == "annotations:":
+            indent = len(line) - len(line.lstrip())
+            following = lines[i + 1] if i + 1 < len(lines) else ""
+            if len(following) - len(following.lstrip()) <= indent:
+                continue
+        result.append(line)
+    return "\n".join(result)
+
+def split_records(content: str) -> List[Tuple[bool, List[str]]]:
+    """
+    Split a policy into runs of lines, marking the runs that are a single record
+    which can be left out without breaking the policy: no nested body and no anchor
+    """
+    runs = []
+    current = None
+    indent = -1
+    # Indentation of the enclosing anchored list, whose records are all kept
+    anchor_indent = None
+    for line in content.splitlines():
+        match = RECORD_START_PATTERN.match(line)
+        line_indent = len(line) - len(line.lstrip())
+        if match or current is None or line_indent <= indent:
+            if anchor_indent is not None and line_indent <= anchor_indent:
+                anchor_indent = None
+            current = [line]
+            runs.append((anchor_indent is None, current))
+            indent = len(match.group(1)) if match else -1
+            if not match and "&" in line:
+                anchor_indent = line_indent
+        else:
+            current.append(line)
+    return [
+        (removable and RECORD_START_PATTERN.match(run[0]) is not None
+         and not any(line.strip() == "body:" or "&" in line for line in run), run)
+        for removable, run in runs
+    ]
+
+def _record_key(run: List[str]) -> str:
+    indent = len(run[0]) - len(run[0].lstrip())
+    return "\n".join(line[indent:] for line in run)
+
+def deduplicate_examples(contents: List[str]) -> List[str]:
+    """
+    Leave out records repeated verbatim from an earlier example
+    """
+    seen = set()
+    results = []
+    for content in contents:
+        lines = []
+        omitted = 0
+        for removable, run in split_records(content):
+            key = _record_key(run)
+            if removable and key in seen:
+                omitted += 1
+                continue
+            if removable:
+                seen.add(key)
+            lines.extend(run)
+        if omitted:
+            lines.append(f"# ({omitted} records identical to an earlier example omitted)")
+        results.append("\n".join(lines))
+    return results
+
+def truncate_example(content: str, max_tokens: int) -> str:
+    """
+    Cut a policy at a record boundary so it fits in max_tokens
+    """
+    marker = "# (truncated)"
+    budget = max_tokens - count_tokens(marker)
+    lines = []
+    used = 0
+    for _, run in split_records(content):
+        text = "\n".join(run)
+        tokens = count_tokens(text) + 1
+        if used + tokens > budget:
+            break
+        lines.extend(run)
+        used += tokens
+    return "\n".join(lines + [marker]) if lines else ""
+
+def format_example(example_path: str, example_data: Dict[str, Any], content: str) -> str:
+    """
+    Format an example for the generation prompt
+    """
+    text = f"\nExample {example_path} policy (relevance: {example_data.get('relevance_score', 0)}%):\n"
+    if example_data.get("reason"):
+        text += f"Reason for selection: {example_data['reason']}\n"
+    return text + f"```yaml\n{content}\n```\n"
+
+def build_examples_section(relevant_examples: Dict[str, Dict[str, Any]],
+                           budget: int = PROMPT_EXAMPLES_TOKEN_BUDGET) -> BudgetedExamples:
+    """
+    Format the examples for the generation prompt within a token budget
+
+    Args:
+        relevant_examples: Dictionary mapping example paths to their content, relevance score and reason
+        budget: Maximum number of tokens of the examples section
+
+    Returns:
+        The examples text, its token count before and after compression, and the
+        paths of the examples left out
+    """
+    ranked = sorted(relevant_examples.items(), key=lambda item: item[1].get("relevance_score", 0), reverse=True)
+    original_tokens = sum(count_tokens(format_example(path, data, data["content"])) for path, data in ranked)
+
+    contents = [data["content"] for _, data in ranked]
+    if PROMPT_COMPRESSION:
+        contents = deduplicate_examples([compress_example(content) for content in contents])
+
+    sections = []
+    dropped = []
+    used = 0
+    for (path, data), content in zip(ranked, contents):
+        section = format_example(path, data, content)
+        tokens = count_tokens(section)
+        if used + tokens > budget:
+            # The most relevant example is always kept, truncated if needed
+            overhead = count_tokens(format_example(path, data, ""))
+            available = budget - used - overhead
+            if available < MIN_EXAMPLE_TOKENS and sections:
+                dropped.append(path)
+                continue
+            truncated = truncate_example(content, max(available, MIN_EXAMPLE_TOKENS))
+            if not truncated:
+                dropped.append(path)
+                continue
+            section = format_example(path, data, truncated)
+            tokens = count_tokens(section)
+        sections.append(section)
+        used += tokens
+
+    text = "".join(sections)
+    tokens = count_tokens(text)
+    inc("prompt_example_tokens_total", original_tokens, state="original")
+    inc("prompt_example_tokens_total", tokens, state="sent")
+    logger.info(f"Examples use {tokens} tokens, saved {original_tokens - tokens} of {original_tokens}"
+                + (f", left out {dropped}" if dropped else ""))
+    return BudgetedExamples(text, original_tokens, tokens, dropped)
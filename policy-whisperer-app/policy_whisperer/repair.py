@@ -0,0 +1,414 @@
+"""
+Repair of generated policies
+
+A generated policy that fails validation is first fixed locally, without the LLM:
+code fences and prose around the YAML are removed, tabs and misaligned lines are
+re-indented, unknown tags are mapped to the closest Conjur tag (or their record is
+removed), repeated records are removed, and references reported as errors are
+pointed at a matching record. Each fix is kept only if it reduces the number of
+errors, so policies with warnings only are never changed.
+
+Only if errors remain is the LLM asked to fix them, with a small request holding
+the errors and the lines around them instead of the whole generation prompt and
+examples. The corrected lines are spliced back into the policy.
+"""
+
+import os
+import re
+import time
+import difflib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from policy_whisperer.llm_client import get_llm, get_prompt_template, text_output_parser
+from policy_whisperer.metrics import inc, llm_callbacks, mean_duration, observe, span
+from policy_whisperer.policy_parser import ParsedPolicy, parse_policy
+from policy_whisperer.validator import (
+    ERROR, RECORD_SCHEMAS, STATEMENT_SCHEMAS, Diagnostic, passed, validate_policy
+)
+
+logger = logging.getLogger(__name__)
+
+# Whether to repair generated policies that fail validation
+POLICY_REPAIR = os.getenv("POLICY_REPAIR", "true").lower() == "true"
+
+# Number of targeted LLM repair requests when the local fixes leave errors (0 to never ask the LLM)
+POLICY_REPAIR_LLM_ATTEMPTS = int(os.getenv("POLICY_REPAIR_LLM_ATTEMPTS", "2"))
+
+# Lines before and after the first error sent in a repair request
+POLICY_REPAIR_CONTEXT_LINES = int(os.getenv("POLICY_REPAIR_CONTEXT_LINES", "6"))
+
+REPAIR_MODEL = "gpt-4o"
+REPAIR_TEMPERATURE = 0.0
+
+# Number of repair results kept, so a policy cleaned twice (e.g. streamed and cached) is repaired once
+REPAIR_CACHE_SIZE = 256
+
+# Prompt used to repair the lines of a policy around its errors
+REPAIR_TEMPLATE = """
+Lines {start} to {end} of a Conjur policy fail validation:
+
+{errors}
+
+```yaml
+{region}
+```
+
+Return only the corrected lines, with the same indentation, so they can replace lines {start} to {end} of the policy.
+Only use these tags: !policy, !user, !host, !group, !layer, !variable, !webservice, !host-factory, !grant, !revoke, !permit, !deny, !delete.
+Do not add explanations or code fences.
+"""
+
+# Tags LLMs use that Conjur doesn't have, and the tag to use instead
+TAG_ALIASES = {
+    "secret": "variable",
+    "credential": "variable",
+    "password": "variable",
+    "app": "host",
+    "application": "host",
+    "workload": "host",
+    "service": "webservice",
+    "authenticator": "webservice",
+    "role": "group",
+    "team": "group",
+    "permission": "permit",
+    "privilege": "permit",
+    "membership": "grant",
+}
+
+KNOWN_TAGS = sorted(set(RECORD_SCHEMAS) | set(STATEMENT_SCHEMAS))
+
+FENCE_PATTERN = re.compile(r"^\s*```")
+ROOT_LINE_PATTERN = re.compile(r"^(-(\s|$)|#|---|\.\.\.)")
+MISSING_SPACE_PATTERN = re.compile(r"^(\s*)-(?=[!&*])")
+BLOCK_SCALAR_PATTERN = re.compile(r":\s*[|>][-+]?\d*\s*$")
+OPENS_BLOCK_PATTERN = re.compile(r"^-(\s+(!\S+|&\S+))*$")
+
+class RepairResult(NamedTuple):
+    policy: str
+    outcome: str            # valid, local, llm or failed
+    fixes: List[str]        # names of the fixes applied, in order
+    diagnostics: List[Diagnostic]
+
+_results = OrderedDict()
+_results_lock = threading.Lock()
+
+def _errors(diagnostics: List[Diagnostic]) -> int:
+    # A syntax error hides every other error, so it outweighs any number of them
+    return sum(1000 if diagnostic.code == "syntax" else 1
+               for diagnostic in diagnostics if diagnostic.severity == ERROR)
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip())
+
+def _content_lines(text: str) -> List[str]:
+    lines = text.splitlines()
+    while lines and not lines[0].strip():
+        lines.pop(0)
+    while lines and not lines[-1].strip():
+        lines.pop()
+    return lines
+
+def _block(lines: List[str], line: int) -> Optional[Tuple[int, int]]:
+    """
+    Return the [start, end) indexes of the lines of the list item starting at a line number
+    """
+    start = line - 1
+    if start >= len(lines) or not lines[start].lstrip().startswith("-"):
+        return None
+    indent = _indent(lines[start])
+    end = start + 1
+    while end < len(lines) and (not lines[end].strip() or _indent(lines[end]) > indent):
+        end += 1
+    # Leave the blank lines and comments after the item in place
+    while end > start + 1 and (not lines[end - 1].strip() or lines[end - 1].lstrip().startswith("#")):
+        end -= 1
+    return start, end
+
+def strip_fences(policy: str, parsed: ParsedPolicy, diagnostics: List[Diagnostic]) -> str:
+    """
+    Keep the YAML of the first code block, and drop prose lines outside the policy
+    """
+    lines = policy.splitlines()
+    fences = [i for i, line in enumerate(lines) if FENCE_PATTERN.match(line)]
+    if len(fences) >= 2:
+        lines = lines[fences[0] + 1:fences[1]]
+    else:
+        lines = [line for line in lines if not FENCE_PATTERN.match(line)]
+    # A policy is a list, so any other text at the root is prose around it
+    return "\n".join(line for line in lines if not line.strip() or _indent(line) > 0 or ROOT_LINE_PATTERN.match(line))
+
+def normalize_whitespace(policy: str, parsed: ParsedPolicy, diagnostics: List[Diagnostic]) -> str:
+    """
+    Replace tabs and non-breaking spaces, and add the missing space in '-!tag'
+    """
+    lines = []
+    for line in policy.splitlines():
+        line = line.replace("\u00a0", " ").expandtabs(2).rstrip()
+        lines.append(MISSING_SPACE_PATTERN.sub(r"\1- ", line))
+    return "\n".join(lines)
+
+def align_indentation(policy: str, parsed: ParsedPolicy, diagnostics: List[Diagnostic]) -> str:
+    """
+    Move lines indented to a level that was never opened to the nearest open level
+    of the same kind (list item or mapping key), together with the lines they contain
+    """
+    result = []
+    levels = []         # [original indent, fixed indent, kinds] of the open levels
+    opens_block = True  # whether the previous line can be followed by a deeper one
+    scalar_indent = None
+    for line in policy.splitlines():
+        stripped = line.strip()
+        indent = _indent(line)
+        if scalar_indent is not None:
+            if not stripped or indent > scalar_indent:
+                # Lines of a block scalar are kept as they are, relative to its key
+                shift = levels[-1][1] - levels[-1][0] if levels else 0
+                result.append(" " * max(indent + shift, 0) + stripped if stripped else line)
+                continue
+            scalar_indent = None
+        if not stripped or stripped.startswith("#"):
+            result.append(line)
+            continue
+
+        kind = "item" if stripped == "-" or stripped.startswith("- ") else "key"
+        if levels and indent > levels[-1][0] and not opens_block:
+            # Deeper than the previous line, which doesn't open a block
+            level = levels[-1]
+        elif any(level[0] == indent for level in levels):
+            while levels[-1][0] != indent:
+                levels.pop()
+            level = levels[-1]
+        elif not levels or indent > levels[-1][0]:
+            fixed = levels[-1][1] + indent - levels[-1][0] if levels else 0
+            level = [indent, fixed, set()]
+            levels.append(level)
+        else:
+            # Dedented to a level that was never opened
+            candidates = [i for i, level in enumerate(levels) if kind in level[2]] or list(range(len(levels)))
+            nearest = min(candidates, key=lambda i: (abs(levels[i][0] - indent), -i))
+            del levels[nearest + 1:]
+            level = levels[-1]
+        level[2].add(kind)
+
+        result.append(" " * level[1] + stripped)
+        opens_block = stripped.endswith(":") or OPENS_BLOCK_PATTERN.match(stripped) is not None
+        if BLOCK_SCALAR_PATTERN.search(stripped):
+            scalar_indent = indent
+    return "\n".join(result)
+
+def map_tag(tag: str) -> Optional[str]:
+    """
+    Return the Conjur tag closest to an unknown tag, if any
+    """
+    tag = tag.lower().replace("_", "-")
+    for candidate in (tag, TAG_ALIASES.get(tag), tag.rstrip("s"), TAG_ALIASES.get(tag.rstrip("s"))):
+        if candidate in KNOWN_TAGS:
+            return candidate
+    matches = difflib.get_close_matches(tag, KNOWN_TAGS, n=1, cutoff=0.75)
+    return matches[0] if matches else None
+
+def fix_unknown_tags(policy: str, parsed: ParsedPolicy, diagnostics: List[Diagnostic]) -> str:
+    """
+    Replace unknown tags with the closest Conjur tag, or remove their records
+    """
+    lines = policy.splitlines()
+    removed = []
+    for node in parsed.records:
+        if node.tag in RECORD_SCHEMAS:
+            continue
+        tag = map_tag(node.tag)
+        if tag is not None:
+            lines[node.line - 1] = lines[node.line - 1].replace(f"!{node.tag}", f"!{tag}", 1)
+        else:
+            block = _block(lines, node.line)
+            if block is not None:
+                removed.append(block)
+    for start, end in sorted(removed, reverse=True):
+        del lines[start:end]
+    return "\n".join(lines)
+
+def remove_duplicates(policy: str, parsed: ParsedPolicy, diagnostics: List[Diagnostic]) -> str:
+    """
+    Remove records declared again with the same id, unless they have a body
+    """
+    lines = policy.splitlines()
+    seen = set()
+    removed = []
+    for node in parsed.records:
+        if node.fqid not in seen:
+            seen.add(node.fqid)
+            continue
+        if "body" in node.fields:
+            continue
+        block = _block(lines, node.line)
+        if block is not None:
+            removed.append(block)
+    for start, end in sorted(removed, reverse=True):
+        del lines[start:end]
+    return "\n".join(lines)
+
+# Local fixes in the order they are tried
+LOCAL_FIXES: List[Tuple[str, Callable[[str, ParsedPolicy, List[Diagnostic]], str]]] = [
+    ("code_fences", strip_fences),
+    ("whitespace", normalize_whitespace),
+    ("indentation", align_indentation),
+    ("unknown_tags", fix_unknown_tags),
+    ("duplicate_ids", remove_duplicates),
+]
+
+def repair_locally(policy: str, diagnostics: Optional[List[Diagnostic]] = None) -> Tuple[str, List[str], List[Diagnostic]]:
+    """
+    Apply the local fixes that reduce the errors of a policy
+
+    Returns:
+        The policy, the names of the fixes applied and its remaining diagnostics
+    """
+    diagnostics = validate_policy(policy) if diagnostics is None else diagnostics
+    fixes = []
+    for name, fix in LOCAL_FIXES:
+        if passed(diagnostics):
+            break
+        try:
+            candidate = fix(policy, parse_policy(policy), diagnostics)
+        except Exception as e:
+            logger.warning(f"Policy fix {name} failed: {e}")
+            continue
+        if candidate == policy:
+            continue
+        candidate_diagnostics = validate_policy(candidate)
+        if _errors(candidate_diagnostics) < _errors(diagnostics):
+            policy, diagnostics = candidate, candidate_diagnostics
+            fixes.append(name)
+    return policy, fixes, diagnostics
+
+def repair_inputs(policy: str, diagnostics: List[Diagnostic]) -> Tuple[int, int, dict]:
+    """
+    Return the first and last line numbers of the region around the first error,
+    and the inputs of the repair chain for it
+    """
+    lines = policy.splitlines()
+    line = min(diagnostic.line for diagnostic in diagnostics if diagnostic.severity == ERROR)
+    start = max(1, line - POLICY_REPAIR_CONTEXT_LINES)
+    end = min(len(lines), line + POLICY_REPAIR_CONTEXT_LINES)
+    errors = "\n".join(f"- line {diagnostic.line}: {diagnostic.message}" for diagnostic in diagnostics
+                       if diagnostic.severity == ERROR and start <= diagnostic.line <= end)
+    return start, end, {"start": start, "end": end, "errors": errors, "region": "\n".join(lines[start - 1:end])}
+
+def splice(policy: str, start: int, end: int, replacement: str) -> str:
+    """
+    Replace lines start to end of a policy with the lines returned by the LLM
+    """
+    lines = policy.splitlines()
+    region = [line.rstrip() for line in _content_lines(replacement) if not FENCE_PATTERN.match(line)]
+    return "\n".join(lines[:start - 1] + region + lines[end:])
+
+def build_repair_chain():
+    """
+    Create the LangChain chain used to repair the region of a policy around its errors
+    """
+    prompt = get_prompt_template(REPAIR_TEMPLATE)
+    model = get_llm(model_name=REPAIR_MODEL, temperature=REPAIR_TEMPERATURE)
+    return prompt | model.with_config(callbacks=llm_callbacks(REPAIR_MODEL)) | text_output_parser()
+
+def _cached(policy: str) -> Optional[RepairResult]:
+    with _results_lock:
+        result = _results.get(policy)
+        if result is not None:
+            _results.move_to_end(policy)
+        return result
+
+def _finish(original: str, policy: str, fixes: List[str], diagnostics: List[Diagnostic],
+            initially_passed: bool, start: float) -> RepairResult:
+    if initially_passed:
+        outcome = "valid"
+    elif not passed(diagnostics):
+        outcome = "failed"
+    else:
+        outcome = "llm" if "llm" in fixes else "local"
+    result = RepairResult(policy, outcome, fixes, diagnostics)
+
+    elapsed = time.perf_counter() - start
+    inc("policy_repairs_total", result=outcome)
+    for fix in fixes:
+        inc("policy_repair_fixes_total", fix=fix)
+    if outcome in ("local", "llm"):
+        # Without the repair the user would have generated the policy again
+        generation_time = mean_duration("generate_policy")
+        saved = max(generation_time - elapsed, 0.0) if generation_time is not None else 0.0
+        observe("policy_repair_saved_seconds", saved)
+        logger.info(f"Repaired generated policy with {', '.join(fixes)} in {elapsed:.3f}s, saved {saved:.2f}s")
+    elif outcome == "failed":
+        errors = [diagnostic.message for diagnostic in diagnostics if diagnostic.severity == ERROR]
+        logger.warning(f"Could not repair generated policy, {len(errors)} errors left: {errors[:3]}")
+    else:
+        logger.info("Generated policy is valid")
+
+    with _results_lock:
+        _results[original] = result
+        while len(_results) > REPAIR_CACHE_SIZE:
+            _results.popitem(last=False)
+    return result
+
+def repair_policy(policy: str) -> RepairResult:
+    """
+    Validate a generated policy and repair it if it has errors: locally first, then
+    with targeted LLM requests. The repaired policy is returned even if errors remain.
+    """
+    cached = _cached(policy)
+    if cached is not None:
+        return cached
+
+    start = time.perf_counter()
+    with span("repair_policy"):
+        diagnostics = validate_policy(policy)
+        initially_passed = passed(diagnostics)
+        repaired, fixes, diagnostics = repair_locally(policy, diagnostics)
+
+        for attempt in range(POLICY_REPAIR_LLM_ATTEMPTS):
+            if passed(diagnostics):
+                break
+            first, last, inputs = repair_inputs(repaired, diagnostics)
+            try:
+                candidate = splice(repaired, first, last, build_repair_chain().invoke(inputs))
+            except Exception as e:
+                logger.warning(f"LLM policy repair failed: {e}")
+                break
+            candidate, candidate_fixes, candidate_diagnostics = repair_locally(candidate)
+            if _errors(candidate_diagnostics) < _errors(diagnostics):
+                repaired, diagnostics = candidate, candidate_diagnostics
+                fixes += ["llm"] + candidate_fixes
+
+    return _finish(policy, repaired, fixes, diagnostics, initially_passed, start)
+
+async def arepair_policy(policy: str) -> RepairResult:
+    """
+    Async version of repair_policy
+    """
+    cached = _cached(policy)
+    if cached is not None:
+        return cached
+
+    start = time.perf_counter()
+    with span("repair_policy"):
+        diagnostics = validate_policy(policy)
+        initially_passed = passed(diagnostics)
+        repaired, fixes, diagnostics = repair_locally(policy, diagnostics)
+
+        for attempt in range(POLICY_REPAIR_LLM_ATTEMPTS):
+            if passed(diagnostics):
+                break
+            first, last, inputs = repair_inputs(repaired, diagnostics)
+            try:
+                candidate = splice(repaired, first, last, await build_repair_chain().ainvoke(inputs))
+            except Exception as e:
+                logger.warning(f"LLM policy repair failed: {e}")
+                break
+            candidate, candidate_fixes, candidate_diagnostics = repair_locally(candidate)
+            if _errors(candidate_diagnostics) < _errors(diagnostics):
+                repaired, diagnostics = candidate, candidate_diagnostics
+                fixes += ["llm"] + candidate_fixes
+
+    return _finish(policy, repaired, fixes, diagnostics, initially_passed, start)
@@ -0,0 +1,353 @@
+"""
+Response cache for Policy Whisperer
+
+Generated policies and explanations are cached by a key built from the
+user prompt (with its whitespace normalized), the policy type, the model and
+the selected examples, so repeated requests don't pay for another LLM call.
+
+Near-duplicate matching, when enabled, only serves a response cached for a
+prompt whose words differ from the request's in function words ("a", "the",
+"please"...) alone. Any other word may be the name of an app, host or variable
+("app2", "payroll") or change what is granted ("only", "not"), so a prompt for
+payroll never gets the policy generated for billing.
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Optional
+
+from policy_whisperer.metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+# Cache backend: 'memory', 'sqlite', 'redis' or 'none' to disable caching
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").lower()
+
+# Maximum number of entries kept by the in-memory backend
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+
+# Seconds a cached response stays valid
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))
+
+# Location of the SQLite database used by the sqlite backend
+RESPONSE_CACHE_PATH = os.getenv(
+    "RESPONSE_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "response_cache.db")
+)
+
+# Connection URL used by the redis backend
+RESPONSE_CACHE_REDIS_URL = os.getenv("RESPONSE_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# Whether to serve cached responses for prompts that are similar but not identical
+RESPONSE_CACHE_NEAR_DUPLICATES = os.getenv("RESPONSE_CACHE_NEAR_DUPLICATES", "false").lower() == "true"
+
+# Minimum Jaccard similarity of prompt shingles for a near-duplicate match
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.9"))
+
+# A word or name in a prompt, e.g. "access", "app1", "db/password" or "ci.example.com"
+PROMPT_TOKEN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_./:@-]*")
+
+# Words that near-duplicate prompts may differ in. Words that restrict or widen what is
+# granted ("only", "not", "all", "or", "without"...) are deliberately left out.
+PROMPT_STOPWORDS = frozenset("""
+a an the this that these those some
+to for of in on at by from into via with within
+is are be been am was were will would should shall can could may might must do does did
+i me my we us our you your it its they them their
+please kindly thanks thank hi hello also just
+need needs want wants like create generate make build set up give
+policy policies conjur yaml
+""".split())
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Normalize the whitespace of a prompt. Case and punctuation are kept, as they
+    can be part of the names a policy is generated for.
+    """
+    return re.sub(r"\s+", " ", prompt).strip()
+
+def prompt_words(prompt: str) -> FrozenSet[str]:
+    """
+    Return the words and names of a prompt, with their case
+    """
+    return frozenset(token.rstrip(".:-") for token in PROMPT_TOKEN.findall(prompt))
+
+def differ_in_stopwords(words: FrozenSet[str], other: FrozenSet[str]) -> bool:
+    """
+    Whether every word that is in only one of two prompts is a function word
+    """
+    return all(word.lower() in PROMPT_STOPWORDS for word in words ^ other)
+
+def prompt_shingles(prompt: str) -> FrozenSet[str]:
+    """
+    Return the lowercased word unigrams and bigrams of a prompt
+    """
+    words = PROMPT_TOKEN.findall(prompt.lower())
+    shingles = set(words)
+    shingles.update(f"{first} {second}" for first, second in zip(words, words[1:]))
+    return frozenset(shingles)
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class ResponseCacheBackend(ABC):
+    """
+    Storage used by the response cache. Backends store strings by key.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """Return the value stored under key, or None"""
+
+    @abstractmethod
+    def set(self, key: str, value: str):
+        """Store value under key"""
+
+class MemoryCacheBackend(ResponseCacheBackend):
+    """
+    Bounded in-process LRU
+    """
+
+    def __init__(self, size: int = RESPONSE_CACHE_SIZE, ttl: int = RESPONSE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+class SQLiteCacheBackend(ResponseCacheBackend):
+    """
+    SQLite database shared by all workers on a host
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, ttl: int = RESPONSE_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " stored_at REAL NOT NULL)"
+        )
+        connection.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connection().execute(
+            "SELECT value FROM responses WHERE key = ? AND stored_at > ?",
+            (key, time.time() - self.ttl)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses (key, value, stored_at) VALUES (?, ?, ?)",
+            (key, value, time.time())
+        )
+        connection.commit()
+
+class RedisCacheBackend(ResponseCacheBackend):
+    """
+    Redis (or any Redis-compatible server) shared by all workers and hosts
+    """
+
+    def __init__(self, url: str = RESPONSE_CACHE_REDIS_URL, ttl: int = RESPONSE_CACHE_TTL):
+        # Optional dependency, only needed for this backend
+        import redis
+
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[str]:
+        value = self._client.get(f"policy-whisperer:{key}")
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key: str, value: str):
+        self._client.set(f"policy-whisperer:{key}", value, ex=self.ttl)
+
+def create_cache_backend(name: str = RESPONSE_CACHE_BACKEND) -> Optional[ResponseCacheBackend]:
+    """
+    Create the cache backend configured by name, or None if caching is disabled
+    """
+    if name in ("none", "off", "false", ""):
+        return None
+    try:
+        if name == "memory":
+            return MemoryCacheBackend()
+        if name == "sqlite":
+            return SQLiteCacheBackend()
+        if name == "redis":
+            return RedisCacheBackend()
+        logger.warning(f"Unknown response cache backend '{name}', using memory")
+        return MemoryCacheBackend()
+    except Exception as e:
+        logger.error(f"Error creating response cache backend '{name}': {e}")
+        logger.warning("Falling back to the in-memory response cache")
+        return MemoryCacheBackend()
+
+class ResponseCache:
+    """
+    Cache of LLM responses with hit/miss accounting and optional near-duplicate matching
+
+    Keys are scoped by a response kind (e.g. "policy" or "explanation") and a set of
+    key fields such as the model and the selected examples. Near-duplicate matching
+    only considers entries with the same kind and key fields whose prompt differs in
+    function words alone, and its index of prompt shingles is kept per process.
+    """
+
+    def __init__(self, backend: Optional[ResponseCacheBackend],
+                 near_duplicates: bool = RESPONSE_CACHE_NEAR_DUPLICATES,
+                 similarity: float = RESPONSE_CACHE_SIMILARITY,
+                 index_size: int = RESPONSE_CACHE_SIZE):
+        self.backend = backend
+        self.near_duplicates = near_duplicates
+        self.similarity = similarity
+        self.index_size = index_size
+        self._shingles = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def _record(self, kind: str, outcome: str):
+        with self._lock:
+            stats = self._stats.setdefault(kind, {"hits": 0, "near_hits": 0, "misses": 0, "errors": 0})
+            stats[outcome] += 1
+        record_cache(f"response_{kind}", outcome)
+
+    def _keys(self, kind: str, prompt: str, fields: Dict[str, str]):
+        scope = hash_text(json.dumps([kind, fields], sort_keys=True))
+        normalized = normalize_prompt(prompt)
+        return scope, normalized, hash_text(f"{scope}:{normalized}")
+
+    def get(self, kind: str, prompt: str, **fields: str) -> Optional[str]:
+        """
+        Return the cached response for a prompt, or None on a miss
+        """
+        if not self.enabled:
+            return None
+        scope, normalized, key = self._keys(kind, prompt, fields)
+        try:
+            value = self.backend.get(key)
+            if value is not None:
+                self._record(kind, "hits")
+                logger.info(f"Response cache hit for {kind}")
+                return value
+
+            if self.near_duplicates:
+                near_key = self._find_near_duplicate(scope, prompt_shingles(normalized),
+                                                     prompt_words(normalized))
+                value = self.backend.get(near_key) if near_key else None
+                if value is not None:
+                    self._record(kind, "near_hits")
+                    logger.info(f"Response cache near-duplicate hit for {kind}")
+                    return value
+        except Exception as e:
+            self._record(kind, "errors")
+            logger.error(f"Error reading from the response cache: {e}")
+            return None
+
+        self._record(kind, "misses")
+        return None
+
+    def set(self, kind: str, prompt: str, value: str, **fields: str):
+        """
+        Cache the response for a prompt
+        """
+        if not self.enabled:
+            return
+        scope, normalized, key = self._keys(kind, prompt, fields)
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            self._record(kind, "errors")
+            logger.error(f"Error writing to the response cache: {e}")
+            return
+
+        if self.near_duplicates:
+            with self._lock:
+                index = self._shingles.setdefault(scope, OrderedDict())
+                index[key] = (prompt_shingles(normalized), prompt_words(normalized))
+                index.move_to_end(key)
+                while len(index) > self.index_size:
+                    index.popitem(last=False)
+
+    def _find_near_duplicate(self, scope: str, shingles: FrozenSet[str],
+                             words: FrozenSet[str]) -> Optional[str]:
+        best_key = None
+        best_similarity = self.similarity
+        with self._lock:
+            candidates = list(self._shingles.get(scope, {}).items())
+        for key, (candidate, candidate_words) in candidates:
+            if not differ_in_stopwords(words, candidate_words):
+                continue
+            union = len(shingles | candidate)
+            similarity = len(shingles & candidate) / union if union else 0.0
+            if similarity >= best_similarity:
+                best_key = key
+                best_similarity = similarity
+        return best_key
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Return hit/miss counters and the hit ratio for each response kind
+        """
+        with self._lock:
+            stats = {kind: dict(counters) for kind, counters in self._stats.items()}
+        for counters in stats.values():
+            lookups = counters["hits"] + counters["near_hits"] + counters["misses"]
+            counters["hit_ratio"] = (counters["hits"] + counters["near_hits"]) / lookups if lookups else 0.0
+        return stats
+
+# Shared response cache, created on first use
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache() -> ResponseCache:
+    """
+    Return the shared response cache
+    """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(create_cache_backend())
+            logger.info(f"Response cache backend: {RESPONSE_CACHE_BACKEND}")
+        return _response_cache
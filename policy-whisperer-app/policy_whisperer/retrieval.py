@@ -0,0 +1,235 @@
+"""
+Local retrieval index for Policy Whisperer
+
+This module ranks the policy templates against a user prompt with BM25, so that
+example selection does not need an LLM round trip.
+"""
+
+import re
+import math
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from policy_whisperer.templates import (
+    PREDEFINED_TEMPLATES,
+    get_all_templates,
+    get_template_store
+)
+from policy_whisperer.snapshot import load_snapshot, templates_digest
+
+logger = logging.getLogger(__name__)
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Template names and categories are much better signals than their content,
+# so their tokens are counted this many times in a document
+NAME_WEIGHT = 3
+
+# Words that carry no meaning for template selection
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "for", "from", "i",
+    "in", "into", "is", "it", "me", "need", "of", "on", "or", "our", "please",
+    "should", "that", "the", "this", "to", "want", "we", "which", "will", "with",
+    "yml", "yaml"
+}
+
+# Map alternative spellings to the term used in the template corpus
+SYNONYMS = {
+    "k8s": "kubernetes",
+    "openid": "oidc",
+    "google": "gcp",
+    "tf": "terraform",
+    "gha": "actions",
+    "secrets": "secret",
+    "variables": "variable",
+    "hosts": "host",
+    "users": "user",
+    "groups": "group",
+    "apps": "app",
+    "application": "app",
+    "applications": "app",
+    "authenticator": "authn",
+    "authentication": "authn",
+    "authenticate": "authn",
+}
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lowercase search terms, dropping stopwords and applying synonyms
+    """
+    tokens = []
+    for token in re.findall(r"[a-z0-9]+", text.lower()):
+        if token in STOPWORDS or len(token) < 2:
+            continue
+        tokens.append(SYNONYMS.get(token, token))
+    return tokens
+
+class TemplateIndex:
+    """
+    BM25 index over the policy templates
+
+    Each document is a template from the policy structure. Its terms come from
+    the template category and file name and, when available, its YAML content.
+    """
+
+    def __init__(self, documents: List[Dict[str, str]], contents: Optional[Dict[str, str]] = None):
+        contents = contents or {}
+
+        self.documents = []
+        self.term_frequencies = []
+        self.document_lengths = []
+        document_frequencies = Counter()
+
+        for document in documents:
+            key = f"{document['category']}/{document['file_name']}"
+            terms = tokenize(f"{document['category']} {document['file_name']}") * NAME_WEIGHT
+            if key in contents:
+                terms += tokenize(contents[key])
+
+            frequencies = Counter(terms)
+            self.documents.append(document)
+            self.term_frequencies.append(frequencies)
+            self.document_lengths.append(len(terms))
+            document_frequencies.update(frequencies.keys())
+
+        count = len(self.documents)
+        self.average_length = (sum(self.document_lengths) / count) if count else 0.0
+        self.idf = {
+            term: math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequencies.items()
+        }
+
+    def to_state(self) -> Dict[str, Any]:
+        """
+        Return the index as plain data, to be restored with from_state
+        """
+        return {
+            "documents": self.documents,
+            "term_frequencies": [dict(frequencies) for frequencies in self.term_frequencies],
+            "document_lengths": self.document_lengths,
+            "average_length": self.average_length,
+            "idf": self.idf
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "TemplateIndex":
+        """
+        Restore an index from the state returned by to_state, without tokenizing anything
+        """
+        index = cls.__new__(cls)
+        index.documents = state["documents"]
+        index.term_frequencies = [Counter(frequencies) for frequencies in state["term_frequencies"]]
+        index.document_lengths = state["document_lengths"]
+        index.average_length = state["average_length"]
+        index.idf = state["idf"]
+        return index
+
+    def score(self, query_terms: List[str], index: int) -> float:
+        """
+        Compute the BM25 score of a document for the given query terms
+        """
+        frequencies = self.term_frequencies[index]
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self.document_lengths[index] / (self.average_length or 1))
+
+        score = 0.0
+        for term in query_terms:
+            tf = frequencies.get(term, 0)
+            if tf:
+                score += self.idf[term] * tf * (BM25_K1 + 1) / (tf + length_norm)
+        return score
+
+    def search(self, query: str, top_k: int = 3) -> List[Dict[str, object]]:
+        """
+        Return the top_k templates for a query
+
+        Args:
+            query: The user's policy request
+            top_k: Maximum number of results to return
+
+        Returns:
+            List of dictionaries containing category, file_name, relevance_score and reason,
+            sorted by relevance_score (highest first). relevance_score is between 0 and 100
+            and measures how much of the query is covered by the template.
+        """
+        query_terms = [term for term in dict.fromkeys(tokenize(query)) if term in self.idf]
+        if not query_terms:
+            return []
+
+        # A term can contribute at most idf * (k1 + 1), which bounds the score
+        max_score = sum(self.idf[term] * (BM25_K1 + 1) for term in query_terms)
+
+        scored = []
+        for index in range(len(self.documents)):
+            score = self.score(query_terms, index)
+            if score > 0:
+                scored.append((score, index))
+        scored.sort(key=lambda item: item[0], reverse=True)
+
+        results = []
+        for score, index in scored[:top_k]:
+            document = self.documents[index]
+            matched_terms = [term for term in query_terms if term in self.term_frequencies[index]]
+            results.append({
+                "category": document["category"],
+                "file_name": document["file_name"],
+                "relevance_score": min(100, round(100 * score / max_score)),
+                "reason": f"Matched terms: {', '.join(matched_terms)}"
+            })
+        return results
+
+def build_template_index(templates: List[Dict[str, str]], use_store: bool = True) -> Tuple[TemplateIndex, int]:
+    """
+    Build an index of the YAML templates among templates, with the content of the
+    predefined templates and, if use_store is set, of the cached ones
+
+    Returns the index and the number of cached templates it was built from.
+    """
+    contents = dict(PREDEFINED_TEMPLATES)
+    cached_count = 0
+    if use_store:
+        # Include content for every template we already have locally
+        store = get_template_store()
+        cached_count = store.count()
+        contents.update(store.contents())
+    templates = [template for template in templates if template["path"].endswith((".yml", ".yaml"))]
+    index = TemplateIndex(templates, contents)
+    logger.info(f"Built template index with {len(templates)} templates and {len(contents)} cached contents")
+    return index, cached_count
+
+def _snapshot_index() -> Tuple[Optional[TemplateIndex], int]:
+    """
+    Return the index of the startup snapshot and its number of cached templates,
+    unless the predefined templates have changed since it was built
+    """
+    snapshot = load_snapshot()
+    if not snapshot or snapshot.get("predefined_templates_digest") != templates_digest(PREDEFINED_TEMPLATES):
+        return None, -1
+    return TemplateIndex.from_state(snapshot["template_index"]), snapshot["template_index_content_count"]
+
+# Shared index, rebuilt when more template content becomes available
+_index, _index_content_count = _snapshot_index()
+_index_lock = threading.Lock()
+
+def get_template_index() -> TemplateIndex:
+    """
+    Return the shared template index, building it on first use
+    """
+    global _index, _index_content_count
+
+    store = get_template_store()
+    cached_count = store.count()
+
+    with _index_lock:
+        if _index is None or cached_count != _index_content_count:
+            _index, _index_content_count = build_template_index(get_all_templates())
+        return _index
+
+def search_templates(query: str, top_k: int = 3) -> List[Dict[str, object]]:
+    """
+    Search the policy templates for the given query using the shared index
+    """
+    return get_template_index().search(query, top_k)
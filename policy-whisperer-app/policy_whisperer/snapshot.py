@@ -0,0 +1,148 @@
+"""
+Startup snapshot for Policy Whisperer
+
+Everything a process derives from policy_structure.json before it can serve a
+request (the structure itself, the flattened template catalog and the state of
+the template retrieval index) is precomputed into one JSON file that is loaded
+with a single read at startup:
+
+    python -m policy_whisperer.snapshot -o startup_snapshot.json
+
+The snapshot records a digest of policy_structure.json and of the predefined
+templates, and is ignored when either has changed since it was built. Prompt
+templates are not part of it: loading them from disk would import langchain at
+startup, so they are parsed once per process on first use instead (see
+llm_client.get_prompt_template).
+
+The snapshot holds plain data only, and this module only uses the standard
+library, so loading it doesn't import the modules that build it.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Bumped whenever the layout of the snapshot or the way its contents are derived changes
+SNAPSHOT_VERSION = 1
+
+# Whether to load the startup snapshot instead of deriving its contents at startup
+STARTUP_SNAPSHOT = os.getenv("STARTUP_SNAPSHOT", "true").lower() == "true"
+
+# Location of the startup snapshot
+STARTUP_SNAPSHOT_PATH = os.getenv("STARTUP_SNAPSHOT_PATH", os.path.join(APP_DIR, "startup_snapshot.json"))
+
+POLICY_STRUCTURE_PATH = os.path.join(APP_DIR, "policy_structure.json")
+
+# Loaded snapshot, False when there is none or it is out of date
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+def file_digest(path: str) -> Optional[str]:
+    """
+    Return the SHA-256 digest of a file, or None if it can't be read
+    """
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def templates_digest(templates: Dict[str, str]) -> str:
+    """
+    Return a digest of a set of named templates
+    """
+    digest = hashlib.sha256()
+    for name in sorted(templates):
+        digest.update(name.encode("utf-8") + b"\0" + templates[name].encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+def load_snapshot() -> Optional[Dict[str, Any]]:
+    """
+    Return the startup snapshot, reading it on first use, or None if it is
+    disabled, missing or was built from another policy_structure.json
+    """
+    global _snapshot
+    with _snapshot_lock:
+        if _snapshot is None:
+            _snapshot = _read_snapshot() or False
+        return _snapshot or None
+
+def _read_snapshot() -> Optional[Dict[str, Any]]:
+    if not STARTUP_SNAPSHOT or not os.path.exists(STARTUP_SNAPSHOT_PATH):
+        return None
+    try:
+        with open(STARTUP_SNAPSHOT_PATH, "r") as f:
+            snapshot = json.load(f)
+    except Exception as e:
+        logger.warning(f"Could not load startup snapshot {STARTUP_SNAPSHOT_PATH}: {e}")
+        return None
+
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        logger.info(f"Ignoring startup snapshot {STARTUP_SNAPSHOT_PATH} of version {snapshot.get('version')}")
+        return None
+    if snapshot.get("policy_structure_digest") != file_digest(POLICY_STRUCTURE_PATH):
+        logger.info(f"Ignoring startup snapshot {STARTUP_SNAPSHOT_PATH}, policy_structure.json has changed")
+        return None
+    logger.info(f"Loaded startup snapshot {STARTUP_SNAPSHOT_PATH}")
+    return snapshot
+
+def build_snapshot(use_store: bool = True) -> Dict[str, Any]:
+    """
+    Derive the contents of the startup snapshot from policy_structure.json, the
+    predefined templates and, if use_store is set, the templates in the template store
+    """
+    from policy_whisperer.utils import load_policy_structure
+    from policy_whisperer.templates import PREDEFINED_TEMPLATES, catalog_templates
+    from policy_whisperer.retrieval import build_template_index
+
+    structure = load_policy_structure()
+    index, content_count = build_template_index(catalog_templates(structure), use_store)
+    return {
+        "version": SNAPSHOT_VERSION,
+        "policy_structure_digest": file_digest(POLICY_STRUCTURE_PATH),
+        "predefined_templates_digest": templates_digest(PREDEFINED_TEMPLATES),
+        "policy_structure": structure,
+        "templates": catalog_templates(structure),
+        "template_index": index.to_state(),
+        "template_index_content_count": content_count
+    }
+
+def write_snapshot(path: str = STARTUP_SNAPSHOT_PATH, use_store: bool = True) -> Dict[str, Any]:
+    """
+    Build the startup snapshot and write it to path
+    """
+    snapshot = build_snapshot(use_store)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"), sort_keys=True)
+    os.replace(tmp_path, path)
+    return snapshot
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Build the startup snapshot loaded by Policy Whisperer at startup"
+    )
+    parser.add_argument("-o", "--output", default=STARTUP_SNAPSHOT_PATH,
+                        help=f"File to write the snapshot to (default: {STARTUP_SNAPSHOT_PATH})")
+    parser.add_argument("--no-template-cache", action="store_true",
+                        help="Index only the predefined templates, not the ones in the template cache. "
+                             "Use this for a snapshot shipped to hosts with an empty cache")
+    args = parser.parse_args(argv)
+
+    snapshot = write_snapshot(args.output, use_store=not args.no_template_cache)
+    print(f"Wrote {args.output}: {len(snapshot['templates'])} templates, "
+          f"{len(snapshot['template_index']['idf'])} index terms, "
+          f"{snapshot['template_index_content_count']} cached template contents")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""
+Persistent template store for Policy Whisperer
+
+Fetched policy templates are kept in a SQLite database so they survive process
+restarts and are shared by every worker on the host. Content is stored by its
+SHA-256 digest, and a bounded in-memory LRU sits in front of the database.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Location of the SQLite database shared by all workers
+TEMPLATE_CACHE_PATH = os.getenv(
+    "TEMPLATE_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "template_cache.db")
+)
+
+# Seconds after which a cached template is revalidated against the repository
+TEMPLATE_CACHE_TTL = int(os.getenv("TEMPLATE_CACHE_TTL", "3600"))
+
+# Maximum number of templates kept in memory per process
+TEMPLATE_CACHE_MEMORY_SIZE = int(os.getenv("TEMPLATE_CACHE_MEMORY_SIZE", "256"))
+
+class TemplateEntry(NamedTuple):
+    """A cached template and the metadata needed to revalidate it"""
+    key: str
+    url: str
+    content: str
+    etag: Optional[str]
+    fetched_at: float
+
+    def is_stale(self, ttl: int = TEMPLATE_CACHE_TTL) -> bool:
+        return time.time() - self.fetched_at > ttl
+
+class TemplateStore:
+    """
+    SQLite-backed, content-addressed template cache with an in-memory LRU in front
+    """
+
+    def __init__(self, path: str = TEMPLATE_CACHE_PATH, memory_size: int = TEMPLATE_CACHE_MEMORY_SIZE):
+        self.path = path
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        self._memory_lock = threading.Lock()
+        self._local = threading.local()
+        self._disabled = False
+        self._init_schema()
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        """Return the SQLite connection of the current thread"""
+        if self._disabled:
+            return None
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            self._local.connection = connection
+        return connection
+
+    def _init_schema(self):
+        try:
+            connection = self._connection()
+            # WAL lets several worker processes read while one of them writes
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                " sha256 TEXT PRIMARY KEY,"
+                " content TEXT NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS templates ("
+                " key TEXT PRIMARY KEY,"
+                " url TEXT NOT NULL,"
+                " sha256 TEXT NOT NULL REFERENCES blobs(sha256),"
+                " etag TEXT,"
+                " fetched_at REAL NOT NULL)"
+            )
+            connection.commit()
+        except Exception as e:
+            # Keep working with the in-memory cache only
+            logger.error(f"Error opening template cache at {self.path}: {e}")
+            logger.warning("Persistent template cache disabled")
+            self._disabled = True
+
+    def _remember(self, entry: TemplateEntry):
+        with self._memory_lock:
+            self._memory[entry.key] = entry
+            self._memory.move_to_end(entry.key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[TemplateEntry]:
+        """
+        Return the cached entry for a template, or None if it has never been fetched
+        """
+        with self._memory_lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+
+        connection = self._connection()
+        if connection is None:
+            return None
+        try:
+            row = connection.execute(
+                "SELECT t.key, t.url, b.content, t.etag, t.fetched_at"
+                " FROM templates t JOIN blobs b ON b.sha256 = t.sha256"
+                " WHERE t.key = ?",
+                (key,)
+            ).fetchone()
+        except Exception as e:
+            logger.error(f"Error reading template {key} from cache: {e}")
+            return None
+
+        if row is None:
+            return None
+        entry = TemplateEntry(*row)
+        self._remember(entry)
+        return entry
+
+    def put(self, key: str, url: str, content: str, etag: Optional[str] = None) -> TemplateEntry:
+        """
+        Store a freshly fetched template
+        """
+        entry = TemplateEntry(key, url, content, etag, time.time())
+        self._remember(entry)
+
+        connection = self._connection()
+        if connection is None:
+            return entry
+        try:
+            digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+            connection.execute(
+                "INSERT OR IGNORE INTO blobs (sha256, content) VALUES (?, ?)",
+                (digest, content)
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO templates (key, url, sha256, etag, fetched_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, url, digest, etag, entry.fetched_at)
+            )
+            connection.commit()
+        except Exception as e:
+            logger.error(f"Error writing template {key} to cache: {e}")
+        return entry
+
+    def touch(self, key: str) -> Optional[TemplateEntry]:
+        """
+        Mark a cached template as fresh after a successful revalidation
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        entry = entry._replace(fetched_at=time.time())
+        self._remember(entry)
+
+        connection = self._connection()
+        if connection is None:
+            return entry
+        try:
+            connection.execute(
+                "UPDATE templates SET fetched_at = ? WHERE key = ?",
+                (entry.fetched_at, key)
+            )
+            connection.commit()
+        except Exception as e:
+            logger.error(f"Error updating template {key} in cache: {e}")
+        return entry
+
+    def contents(self) -> Dict[str, str]:
+        """
+        Return the content of every cached template keyed by template key
+        """
+        connection = self._connection()
+        if connection is None:
+            with self._memory_lock:
+                return {key: entry.content for key, entry in self._memory.items()}
+        try:
+            rows = connection.execute(
+                "SELECT t.key, b.content FROM templates t JOIN blobs b ON b.sha256 = t.sha256"
+            ).fetchall()
+            return dict(rows)
+        except Exception as e:
+            logger.error(f"Error reading template cache contents: {e}")
+            return {}
+
+    def count(self) -> int:
+        """
+        Return the number of cached templates
+        """
+        connection = self._connection()
+        if connection is None:
+            with self._memory_lock:
+                return len(self._memory)
+        try:
+            return connection.execute("SELECT COUNT(*) FROM templates").fetchone()[0]
+        except Exception as e:
+            logger.error(f"Error counting cached templates: {e}")
+            return 0
+
+    def clear_memory(self):
+        """
+        Drop the in-memory LRU; the persistent cache is left untouched
+        """
+        with self._memory_lock:
+            self._memory.clear()
@@ -3,22 +3,69 @@ Templates and examples handling for Policy Whisperer
 """
 
 import os
-import requests
+import asyncio
 import logging
-from typing import Dict, List, Optional, Any
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Dict, List, Optional, Any, Tuple
 
 from policy_whisperer.utils import load_policy_structure
+from policy_whisperer.snapshot import load_snapshot
+from policy_whisperer.template_store import TemplateStore
+from policy_whisperer.metrics import record_cache, span
+
+if TYPE_CHECKING:
+    import requests
 
 logger = logging.getLogger(__name__)
 
 # Policy templates repository URL
-POLICY_REPO_BASE_URL = "https://raw.githubusercontent.com/infamousjoeg/conjur-policies/master"
+POLICY_REPO_BASE_URL = os.getenv(
+    "POLICY_REPO_BASE_URL",
+    "https://raw.githubusercontent.com/infamousjoeg/conjur-policies/master"
+)
+
+# Maximum number of concurrent requests to the policy repository per process
+TEMPLATE_FETCH_MAX_CONCURRENCY = int(os.getenv("TEMPLATE_FETCH_MAX_CONCURRENCY", "8"))
+
+# Timeout in seconds of a single template request
+TEMPLATE_FETCH_TIMEOUT = float(os.getenv("TEMPLATE_FETCH_TIMEOUT", "5"))
+
+# Seconds a request waits for its examples before continuing with the ones it has
+TEMPLATE_FETCH_DEADLINE = float(os.getenv("TEMPLATE_FETCH_DEADLINE", "5"))
+
+# Whether to fetch every template of the policy structure at startup
+TEMPLATE_CACHE_WARMUP = os.getenv("TEMPLATE_CACHE_WARMUP", "true").lower() == "true"
+
+# Persistent cache for policy templates, created on first use
+_template_store = None
+_template_store_lock = threading.Lock()
 
-# Cache for policy templates
-policy_templates_cache = {}
+# Shared HTTP session with a keep-alive connection pool, created on first use
+_http_session = None
+_http_session_lock = threading.Lock()
 
-# Load the policy structure
-POLICY_STRUCTURE = load_policy_structure()
+# Limits the number of in-flight requests to the policy repository across all threads
+_fetch_semaphore = threading.BoundedSemaphore(TEMPLATE_FETCH_MAX_CONCURRENCY)
+
+# Pool used to fetch the examples of incoming requests concurrently
+_fetch_executor = ThreadPoolExecutor(max_workers=TEMPLATE_FETCH_MAX_CONCURRENCY, thread_name_prefix="template-fetch")
+
+# Async HTTP client and concurrency limit for each event loop, created on first use
+_async_fetch_state = weakref.WeakKeyDictionary()
+
+# Background revalidation of stale templates
+_revalidation_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="template-revalidate")
+_revalidations_in_flight = set()
+_revalidations_lock = threading.Lock()
+
+# Load the policy structure, from the startup snapshot when there is an up to date one
+_snapshot = load_snapshot()
+POLICY_STRUCTURE = _snapshot["policy_structure"] if _snapshot else load_policy_structure()
+
+# Flattened list of the templates in the policy structure, built on first use
+_template_catalog = _snapshot["templates"] if _snapshot else None
 
 # Predefined policy templates for offline use when GitHub templates are not available
 PREDEFINED_TEMPLATES = {
@@ -122,13 +169,51 @@ PREDEFINED_TEMPLATES = {
     """
 }
 
+def get_template_store() -> TemplateStore:
+    """
+    Return the shared persistent template cache
+    """
+    global _template_store
+    with _template_store_lock:
+        if _template_store is None:
+            _template_store = TemplateStore()
+        return _template_store
+
+def get_http_session() -> "requests.Session":
+    """
+    Return the shared HTTP session used to talk to the policy repository
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=TEMPLATE_FETCH_MAX_CONCURRENCY
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
 def get_template_path(policy_type: str, template_name: str) -> Optional[str]:
     """
     Get the correct path for a template based on the policy structure
     """
     try:
+        # Handle nested policy types given as category/subdirectory
+        if '/' in policy_type:
+            category, subdir = policy_type.split('/', 1)
+            value = POLICY_STRUCTURE.get(category, {})
+            files = value.get(subdir, []) if isinstance(value, dict) else []
+            for filename in files:
+                if filename.startswith(f"{template_name}.") or template_name in filename:
+                    return f"{policy_type}/{filename}"
+        
         # Handle simple policy types that are direct keys in the structure
-        if isinstance(POLICY_STRUCTURE.get(policy_type, []), list):
+        elif isinstance(POLICY_STRUCTURE.get(policy_type, []), list):
             for filename in POLICY_STRUCTURE.get(policy_type, []):
                 if filename.startswith(f"{template_name}.") or template_name in filename:
                     return f"{policy_type}/{filename}"
@@ -145,16 +230,62 @@ def get_template_path(policy_type: str, template_name: str) -> Optional[str]:
     
     return None
 
+def revalidate_policy_template(cache_key: str):
+    """
+    Revalidate a cached template with a conditional GET, updating the cache
+    """
+    store = get_template_store()
+    try:
+        entry = store.get(cache_key)
+        if entry is None:
+            return
+        
+        headers = {'If-None-Match': entry.etag} if entry.etag else {}
+        with _fetch_semaphore:
+            response = get_http_session().get(entry.url, headers=headers, timeout=TEMPLATE_FETCH_TIMEOUT)
+        
+        if response.status_code == 304:
+            logger.debug(f"Template {cache_key} not modified")
+            store.touch(cache_key)
+        elif response.status_code == 200:
+            logger.info(f"Template {cache_key} changed upstream, updating cache")
+            store.put(cache_key, entry.url, response.text, response.headers.get('ETag'))
+        else:
+            logger.warning(f"Failed to revalidate template {entry.url}: {response.status_code}")
+    except Exception as e:
+        logger.error(f"Error revalidating template {cache_key}: {e}")
+    finally:
+        with _revalidations_lock:
+            _revalidations_in_flight.discard(cache_key)
+
+def schedule_revalidation(cache_key: str):
+    """
+    Revalidate a stale template in the background unless it is already being revalidated
+    """
+    with _revalidations_lock:
+        if cache_key in _revalidations_in_flight:
+            return
+        _revalidations_in_flight.add(cache_key)
+    _revalidation_executor.submit(revalidate_policy_template, cache_key)
+
 def fetch_policy_template(policy_type: str, template_name: str) -> Optional[str]:
     """
     Fetch a policy template from the repository or cache
+    
+    Stale cached templates are returned immediately and revalidated in the background.
     """
     cache_key = f"{policy_type}/{template_name}"
+    store = get_template_store()
     
     # Check if we have this template in cache
-    if cache_key in policy_templates_cache:
+    entry = store.get(cache_key)
+    if entry is not None:
         logger.info(f"Using cached template for {cache_key}")
-        return policy_templates_cache[cache_key]
+        record_cache("template", "hits")
+        if entry.is_stale():
+            schedule_revalidation(cache_key)
+        return entry.content
+    record_cache("template", "misses")
     
     try:
         # Get the template path
@@ -168,12 +299,105 @@ def fetch_policy_template(policy_type: str, template_name: str) -> Optional[str]
         url = f"{POLICY_REPO_BASE_URL}/{template_path}"
         
         logger.info(f"Fetching template from {url}")
-        response = requests.get(url, timeout=5)
+        with _fetch_semaphore:
+            response = get_http_session().get(url, timeout=TEMPLATE_FETCH_TIMEOUT)
         
         if response.status_code == 200:
             template_content = response.text
             # Cache the template
-            policy_templates_cache[cache_key] = template_content
+            store.put(cache_key, url, template_content, response.headers.get('ETag'))
+            return template_content
+        else:
+            logger.warning(f"Failed to fetch template {url}: {response.status_code}")
+            return None
+    
+    except Exception as e:
+        logger.error(f"Error fetching template {policy_type}/{template_name}: {e}")
+        return None
+
+def fetch_policy_templates(templates: List[Tuple[str, str]], deadline: Optional[float] = TEMPLATE_FETCH_DEADLINE,
+                           executor: Optional[ThreadPoolExecutor] = None) -> Dict[str, str]:
+    """
+    Fetch several policy templates concurrently
+    
+    Args:
+        templates: List of (policy_type, template_name) pairs
+        deadline: Seconds to wait for all templates, or None to wait for all of them
+        executor: Thread pool to fetch with (default: the shared request pool)
+        
+    Returns:
+        Dictionary mapping "policy_type/template_name" to the template content. Templates
+        that failed or did not arrive before the deadline are left out.
+    """
+    executor = executor or _fetch_executor
+    with span("fetch_templates"):
+        futures = {
+            executor.submit(fetch_policy_template, policy_type, template_name): f"{policy_type}/{template_name}"
+            for policy_type, template_name in dict.fromkeys(templates)
+        }
+        done, not_done = wait(futures, timeout=deadline)
+    
+    if not_done:
+        logger.warning(f"Template fetch deadline of {deadline}s exceeded, continuing without: "
+                       f"{sorted(futures[future] for future in not_done)}")
+    
+    results = {}
+    for future in done:
+        content = future.result()
+        if content:
+            results[futures[future]] = content
+    return results
+
+def _get_async_fetch_state():
+    """
+    Return the async HTTP client and semaphore of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    state = _async_fetch_state.get(loop)
+    if state is None:
+        import httpx
+        client = httpx.AsyncClient(
+            timeout=TEMPLATE_FETCH_TIMEOUT,
+            limits=httpx.Limits(max_connections=TEMPLATE_FETCH_MAX_CONCURRENCY)
+        )
+        state = (client, asyncio.Semaphore(TEMPLATE_FETCH_MAX_CONCURRENCY))
+        _async_fetch_state[loop] = state
+    return state
+
+async def afetch_policy_template(policy_type: str, template_name: str) -> Optional[str]:
+    """
+    Async version of fetch_policy_template
+    """
+    cache_key = f"{policy_type}/{template_name}"
+    store = get_template_store()
+    
+    # Check if we have this template in cache
+    entry = store.get(cache_key)
+    if entry is not None:
+        logger.info(f"Using cached template for {cache_key}")
+        record_cache("template", "hits")
+        if entry.is_stale():
+            schedule_revalidation(cache_key)
+        return entry.content
+    record_cache("template", "misses")
+    
+    try:
+        template_path = get_template_path(policy_type, template_name)
+        
+        if not template_path:
+            logger.warning(f"Template path not found for {policy_type}/{template_name}")
+            return None
+        
+        url = f"{POLICY_REPO_BASE_URL}/{template_path}"
+        
+        logger.info(f"Fetching template from {url}")
+        client, semaphore = _get_async_fetch_state()
+        async with semaphore:
+            response = await client.get(url)
+        
+        if response.status_code == 200:
+            template_content = response.text
+            store.put(cache_key, url, template_content, response.headers.get('ETag'))
             return template_content
         else:
             logger.warning(f"Failed to fetch template {url}: {response.status_code}")
@@ -183,6 +407,101 @@ def fetch_policy_template(policy_type: str, template_name: str) -> Optional[str]
         logger.error(f"Error fetching template {policy_type}/{template_name}: {e}")
         return None
 
+async def afetch_policy_templates(templates: List[Tuple[str, str]], deadline: Optional[float] = TEMPLATE_FETCH_DEADLINE) -> Dict[str, str]:
+    """
+    Async version of fetch_policy_templates
+    """
+    tasks = {
+        asyncio.ensure_future(afetch_policy_template(policy_type, template_name)): f"{policy_type}/{template_name}"
+        for policy_type, template_name in dict.fromkeys(templates)
+    }
+    if not tasks:
+        return {}
+    with span("fetch_templates"):
+        done, not_done = await asyncio.wait(tasks, timeout=deadline)
+    
+    if not_done:
+        logger.warning(f"Template fetch deadline of {deadline}s exceeded, continuing without: "
+                       f"{sorted(tasks[task] for task in not_done)}")
+        for task in not_done:
+            task.cancel()
+    
+    results = {}
+    for task in done:
+        content = task.result()
+        if content:
+            results[tasks[task]] = content
+    return results
+
+def warm_template_cache() -> int:
+    """
+    Fetch every template of the policy structure into the cache
+    
+    Returns:
+        Number of templates available in the cache afterwards
+    """
+    logger.info("Warming up the template cache")
+    
+    # Use a small dedicated pool so warmup doesn't hold up the examples of incoming requests
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="template-warmup") as executor:
+        available = fetch_policy_templates([
+            (template["category"], template["file_name"])
+            for template in get_all_templates()
+            if template["path"].endswith((".yml", ".yaml"))
+        ], deadline=None, executor=executor)
+    logger.info(f"Template cache warmup complete: {len(available)} templates available")
+    return len(available)
+
+def start_template_cache_warmup() -> Optional[threading.Thread]:
+    """
+    Warm up the template cache in a background thread if enabled
+    """
+    if not TEMPLATE_CACHE_WARMUP:
+        return None
+    thread = threading.Thread(target=warm_template_cache, name="template-warmup", daemon=True)
+    thread.start()
+    return thread
+
+def catalog_templates(structure: Dict) -> List[Dict[str, str]]:
+    """
+    Returns a flattened list of all templates in a policy structure
+    
+    Each entry contains the category (e.g. "ci/github"), the file name without
+    extension and the path of the file in the policy repository.
+    """
+    all_templates = []
+    
+    for category, value in structure.items():
+        if isinstance(value, list):
+            # Simple category with list of files
+            for file_name in value:
+                all_templates.append({
+                    "category": category,
+                    "file_name": file_name.replace(".yml", ""),
+                    "path": f"{category}/{file_name}"
+                })
+        elif isinstance(value, dict):
+            # Nested category
+            for subcategory, files in value.items():
+                for file_name in files:
+                    all_templates.append({
+                        "category": f"{category}/{subcategory}",
+                        "file_name": file_name.replace(".yml", ""),
+                        "path": f"{category}/{subcategory}/{file_name}"
+                    })
+    
+    return all_templates
+
+def get_all_templates() -> List[Dict[str, str]]:
+    """
+    Returns a flattened list of all templates in the policy structure
+    (see catalog_templates)
+    """
+    global _template_catalog
+    if _template_catalog is None:
+        _template_catalog = catalog_templates(POLICY_STRUCTURE)
+    return [dict(template) for template in _template_catalog]
+
 def get_policy_types() -> List[str]:
     """
     Returns a list of available policy types
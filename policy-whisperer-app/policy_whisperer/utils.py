@@ -6,24 +6,10 @@ import os
 import yaml
 import json
 import logging
-import requests
 from typing import Dict, List, Optional, Any, Union
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,  # Set to DEBUG for more verbose logging
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('policy_generator.log')
-    ]
-)
 logger = logging.getLogger(__name__)
 
-# Enable detailed debug logging for LangChain
-logging.getLogger('langchain').setLevel(logging.DEBUG)
-logging.getLogger('langchain_openai').setLevel(logging.DEBUG)
-
 # Create a custom YAML loader that ignores Conjur-specific tags
 class ConjurPolicyLoader(yaml.SafeLoader):
     pass
@@ -38,7 +24,8 @@ def conjur_tag_constructor(loader, node):
         return loader.construct_mapping(node)
 
 # Register all common Conjur policy tags
-for tag in ['policy', 'user', 'host', 'group', 'variable', 'grant', 'permit', 'webservice']:
+for tag in ['policy', 'user', 'host', 'group', 'layer', 'variable', 'webservice', 'host-factory',
+            'grant', 'revoke', 'permit', 'deny', 'delete', 'member']:
     yaml.add_constructor(f'!{tag}', conjur_tag_constructor, ConjurPolicyLoader)
 
 def load_policy_structure() -> Dict:
@@ -66,29 +53,23 @@ def load_policy_structure() -> Dict:
             "web": ["conjur-oidc-demo.yml"]
         }
 
-def analyze_policy_resources(policy: str) -> Dict[str, int]:
+def suggest_policy_path(user_prompt: str, target_path: str = '') -> str:
     """
-    Analyze a policy to count the different types of resources it contains
+    Suggest a file path for the policy if the user did not provide one
     """
-    resource_counts = {
-        "policy": 0,
-        "user": 0,
-        "host": 0,
-        "group": 0,
-        "variable": 0,
-        "grant": 0,
-        "permit": 0,
-        "webservice": 0
-    }
-    
-    try:
-        lines = policy.split('\n')
-        for line in lines:
-            line = line.strip()
-            for resource_type in resource_counts.keys():
-                if f"!{resource_type}" in line:
-                    resource_counts[resource_type] += 1
-    except Exception as e:
-        logger.error(f"Error analyzing policy resources: {e}")
+    if target_path:
+        return target_path
     
-    return resource_counts
+    # Determine a suitable path based on policy content and type
+    user_prompt_lower = user_prompt.lower()
+    if 'github' in user_prompt_lower or 'actions' in user_prompt_lower:
+        return 'policies/ci/github-actions.yml'
+    elif 'aws' in user_prompt_lower:
+        return 'policies/cloud/aws.yml'
+    elif 'azure' in user_prompt_lower:
+        return 'policies/cloud/azure.yml'
+    elif 'authn' in user_prompt_lower or 'authentication' in user_prompt_lower:
+        return 'policies/authn/authn.yml'
+    elif 'jwt' in user_prompt_lower:
+        return 'policies/authn/authn-jwt.yml'
+    return 'policies/general/policy.yml'
@@ -0,0 +1,298 @@
+"""
+Offline static validator for Conjur policies
+
+Checks policy files without a Conjur server: YAML syntax, known tags, required
+and allowed attributes, duplicate ids, references to records the file doesn't
+declare (warnings only), !permit privilege names and the layout of authenticator
+policies. Files are validated in parallel across CPU cores, and only the files that pass
+need the (much slower) dry-run against a live Conjur.
+
+Usage:
+    python -m policy_whisperer.validator [--format text|json|github] [--passed-output FILE] FILE...
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+
+from policy_whisperer.policy_parser import ParsedPolicy, parse_policy
+
+logger = logging.getLogger(__name__)
+
+# Validating a handful of files is faster than starting worker processes
+VALIDATOR_PARALLEL_THRESHOLD = int(os.getenv("VALIDATOR_PARALLEL_THRESHOLD", "8"))
+
+ERROR = "error"
+WARNING = "warning"
+
+# Required and allowed attributes of each tag. Required attributes listed as a
+# tuple need one of the alternatives.
+RECORD_SCHEMAS = {
+    "policy": {"required": ["id"], "allowed": {"id", "owner", "body", "annotations"}},
+    "user": {"required": ["id"], "allowed": {"id", "owner", "annotations", "restricted_to", "public_keys", "uidnumber"}},
+    "host": {"required": ["id"], "allowed": {"id", "owner", "annotations", "restricted_to", "layers"}},
+    "group": {"required": [], "allowed": {"id", "owner", "annotations", "gidnumber"}},
+    "layer": {"required": [], "allowed": {"id", "owner", "annotations"}},
+    "variable": {"required": ["id"], "allowed": {"id", "owner", "annotations", "kind", "mime_type"}},
+    "webservice": {"required": [], "allowed": {"id", "owner", "annotations"}},
+    "host-factory": {"required": ["id", "layers"], "allowed": {"id", "owner", "annotations", "layers"}},
+}
+
+STATEMENT_SCHEMAS = {
+    "grant": {"required": ["role", ("member", "members")], "allowed": {"role", "member", "members"}},
+    "revoke": {"required": ["role", "member"], "allowed": {"role", "member"}},
+    "permit": {"required": ["role", ("privilege", "privileges"), ("resource", "resources")],
+               "allowed": {"role", "privilege", "privileges", "resource", "resources"}},
+    "deny": {"required": ["role", ("privilege", "privileges"), ("resource", "resources")],
+             "allowed": {"role", "privilege", "privileges", "resource", "resources"}},
+    "delete": {"required": ["record"], "allowed": {"record"}},
+}
+
+# Privileges Conjur knows about
+VALID_PRIVILEGES = {"read", "execute", "update", "create", "authenticate"}
+
+# Authenticator types, whether they take a service id, and the configuration
+# variables they need (a tuple needs one of the alternatives)
+AUTHENTICATORS = {
+    "authn-jwt": {"service_id": True, "variables": [("jwks-uri", "public-keys", "provider-uri")]},
+    "authn-oidc": {"service_id": True, "variables": ["provider-uri"]},
+    "authn-azure": {"service_id": True, "variables": ["provider-uri"]},
+    "authn-k8s": {"service_id": True, "variables": []},
+    "authn-iam": {"service_id": True, "variables": []},
+    "authn-ldap": {"service_id": True, "variables": []},
+    "authn-gcp": {"service_id": False, "variables": []},
+}
+
+class Diagnostic(NamedTuple):
+    file: str
+    line: int
+    severity: str
+    code: str
+    message: str
+
+def _required(fields, schema) -> List[str]:
+    missing = []
+    for required in schema["required"]:
+        alternatives = required if isinstance(required, tuple) else (required,)
+        if not any(field in fields for field in alternatives):
+            missing.append(" or ".join(alternatives))
+    return missing
+
+def _full_id(fqid: str) -> str:
+    return fqid.split(":", 1)[1]
+
+def check_schemas(parsed: ParsedPolicy, report):
+    for node in parsed.records:
+        schema = RECORD_SCHEMAS.get(node.tag)
+        if schema is None:
+            report(node.line, ERROR, "unknown-tag", f"Unknown tag !{node.tag}")
+            continue
+        # Records may be written as '- !host id' instead of a mapping
+        fields = set(node.fields) | ({"id"} if node.id and not node.fields else set())
+        for missing in _required(fields, schema):
+            report(node.line, ERROR, "missing-field", f"!{node.tag} requires '{missing}'")
+        for unknown in sorted(set(node.fields) - schema["allowed"]):
+            report(node.line, ERROR, "unknown-field", f"!{node.tag} does not take '{unknown}'")
+
+    for node in parsed.statements:
+        schema = STATEMENT_SCHEMAS[node.tag]
+        for missing in _required(node.fields, schema):
+            report(node.line, ERROR, "missing-field", f"!{node.tag} requires '{missing}'")
+        for unknown in sorted(set(node.fields) - schema["allowed"]):
+            report(node.line, ERROR, "unknown-field", f"!{node.tag} does not take '{unknown}'")
+
+def check_duplicates(parsed: ParsedPolicy, report):
+    seen = {}
+    for node in parsed.records:
+        if node.fqid in seen:
+            report(node.line, ERROR, "duplicate-id",
+                   f"{node.fqid} is already declared at line {seen[node.fqid]}")
+        else:
+            seen[node.fqid] = node.line
+
+def check_references(parsed: ParsedPolicy, report):
+    # References to records that aren't declared are legal in Conjur: the record may
+    # exist on the server or come from another policy file, so only warn and leave it
+    # to the dry-run. A relative id inside a policy of this file is more likely a typo.
+    policies = {_full_id(node.fqid) for node in parsed.records if node.tag == "policy"}
+    declared = parsed.declared()
+
+    def in_scope(fqid: str) -> bool:
+        full_id = _full_id(fqid)
+        return any(full_id == policy or full_id.startswith(f"{policy}/") for policy in policies)
+
+    for reference in parsed.references:
+        if reference.relation == "delete":
+            continue
+        for fqid in (reference.source, reference.target):
+            if fqid in declared:
+                continue
+            if in_scope(fqid):
+                report(reference.line, WARNING, "undeclared-reference",
+                       f"{fqid} is not declared in its policy (use a leading '/' for an absolute id)")
+            else:
+                report(reference.line, WARNING, "external-reference",
+                       f"{fqid} is not declared in this file")
+
+def check_privileges(parsed: ParsedPolicy, report):
+    for reference in parsed.references:
+        if reference.relation not in ("permit", "deny"):
+            continue
+        for privilege in reference.privileges:
+            if privilege not in VALID_PRIVILEGES:
+                report(reference.line, ERROR, "unknown-privilege",
+                       f"Unknown privilege '{privilege}', expected one of {', '.join(sorted(VALID_PRIVILEGES))}")
+            elif privilege == "authenticate" and not reference.target.startswith("webservice:"):
+                report(reference.line, WARNING, "privilege-target",
+                       f"'authenticate' only applies to webservices, not {reference.target}")
+
+def check_authenticators(parsed: ParsedPolicy, report):
+    declared = parsed.declared()
+    for node in parsed.records:
+        if node.tag != "policy":
+            continue
+        full_id = _full_id(node.fqid)
+        parts = full_id.split("/")
+
+        # Authenticator policies live under conjur/authn-<type>/<service-id>
+        if parts[0] != "conjur" and any(part in AUTHENTICATORS for part in parts):
+            report(node.line, WARNING, "authenticator-path",
+                   f"Authenticator policy {full_id} should be at conjur/authn-<type>/<service-id>")
+            continue
+        if len(parts) < 2 or parts[0] != "conjur" or parts[1] not in AUTHENTICATORS:
+            continue
+        authenticator = AUTHENTICATORS[parts[1]]
+        if len(parts) == 2 and authenticator["service_id"]:
+            # conjur/authn-jwt itself is a container for service policies
+            if not any(record.path == full_id and record.tag == "policy" for record in parsed.records):
+                report(node.line, ERROR, "authenticator-path",
+                       f"{parts[1]} needs a service id: conjur/{parts[1]}/<service-id>")
+            continue
+        if len(parts) != (3 if authenticator["service_id"] else 2):
+            continue
+
+        webservice = f"webservice:{full_id}"
+        if webservice not in declared:
+            report(node.line, ERROR, "authenticator-webservice",
+                   f"Authenticator {full_id} must declare a '- !webservice' in its body")
+        for required in authenticator["variables"]:
+            alternatives = required if isinstance(required, tuple) else (required,)
+            if not any(f"variable:{full_id}/{variable}" in declared for variable in alternatives):
+                report(node.line, ERROR, "authenticator-variable",
+                       f"Authenticator {full_id} must declare the variable {' or '.join(alternatives)}")
+        if not any(reference.relation == "permit" and reference.target == webservice
+                   and "authenticate" in reference.privileges for reference in parsed.references):
+            report(node.line, WARNING, "authenticator-permit",
+                   f"No role is permitted to authenticate with {full_id}")
+
+CHECKS = [check_schemas, check_duplicates, check_references, check_privileges, check_authenticators]
+
+def validate_policy(policy: str, file: str = "<policy>") -> List[Diagnostic]:
+    """
+    Validate a policy and return its diagnostics, sorted by line
+    """
+    diagnostics = []
+
+    def report(line: int, severity: str, code: str, message: str):
+        diagnostics.append(Diagnostic(file, line, severity, code, message))
+
+    parsed = parse_policy(policy)
+    if not parsed.valid:
+        report(parsed.error_line or 1, ERROR, "syntax", parsed.error.splitlines()[0] if parsed.error else "Invalid YAML")
+        return diagnostics
+
+    for line, message in parsed.problems:
+        report(line, ERROR, "structure", message)
+    for check in CHECKS:
+        check(parsed, report)
+
+    # The same reference can appear in several statements, report it once per line
+    return sorted(set(diagnostics), key=lambda diagnostic: (diagnostic.line, diagnostic.code, diagnostic.message))
+
+def validate_policy_file(path: str) -> List[Diagnostic]:
+    """
+    Validate a policy file
+    """
+    try:
+        with open(path, "r") as f:
+            return validate_policy(f.read(), path)
+    except OSError as e:
+        return [Diagnostic(path, 1, ERROR, "io", f"Could not read file: {e.strerror}")]
+
+def validate_policy_files(paths: List[str], workers: Optional[int] = None) -> Dict[str, List[Diagnostic]]:
+    """
+    Validate policy files in parallel across CPU cores
+
+    Returns:
+        Dictionary mapping each path to its diagnostics
+    """
+    paths = list(dict.fromkeys(paths))
+    if len(paths) < VALIDATOR_PARALLEL_THRESHOLD:
+        return {path: validate_policy_file(path) for path in paths}
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        chunksize = max(1, len(paths) // (workers * 4))
+        return dict(zip(paths, executor.map(validate_policy_file, paths, chunksize=chunksize)))
+
+def passed(diagnostics: List[Diagnostic]) -> bool:
+    return not any(diagnostic.severity == ERROR for diagnostic in diagnostics)
+
+def format_markdown(results: Dict[str, List[Diagnostic]]) -> str:
+    """
+    Format the results for the PR comment
+    """
+    lines = []
+    for path, diagnostics in results.items():
+        icon = "✅" if passed(diagnostics) else "❌"
+        lines.append(f"## {icon} Static validation of: {path}")
+        for diagnostic in diagnostics:
+            lines.append(f"- **{diagnostic.severity}** line {diagnostic.line} `{diagnostic.code}`: {diagnostic.message}")
+        lines.append("")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Validate Conjur policy files without a Conjur server")
+    parser.add_argument("files", nargs="*", help="Policy files (comma or whitespace separated lists are accepted)")
+    parser.add_argument("--format", choices=["text", "json", "github"], default="text", help="Output format")
+    parser.add_argument("--passed-output", help="Write the files without errors to this file, one per line")
+    parser.add_argument("--markdown-output", help="Write a markdown summary to this file")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+
+    paths = [path for arg in args.files for path in re.split(r"[,\s]+", arg) if path]
+    results = validate_policy_files(paths, workers=args.workers)
+
+    if args.format == "json":
+        print(json.dumps([
+            {"file": path, "passed": passed(diagnostics), "diagnostics": [diagnostic._asdict() for diagnostic in diagnostics]}
+            for path, diagnostics in results.items()
+        ], indent=2))
+    else:
+        for diagnostics in results.values():
+            for diagnostic in diagnostics:
+                if args.format == "github":
+                    # Workflow commands show up as annotations on the PR diff
+                    print(f"::{diagnostic.severity} file={diagnostic.file},line={diagnostic.line},"
+                          f"title={diagnostic.code}::{diagnostic.message}")
+                else:
+                    print(f"{diagnostic.file}:{diagnostic.line}: {diagnostic.severity}: {diagnostic.message} [{diagnostic.code}]")
+
+    passed_paths = [path for path, diagnostics in results.items() if passed(diagnostics)]
+    if args.passed_output:
+        with open(args.passed_output, "w") as f:
+            f.write("".join(f"{path}\n" for path in passed_paths))
+    if args.markdown_output:
+        with open(args.markdown_output, "w") as f:
+            f.write(format_markdown(results))
+
+    print(f"{len(passed_paths)}/{len(results)} policy files passed static validation", file=sys.stderr)
+    return 0 if len(passed_paths) == len(results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
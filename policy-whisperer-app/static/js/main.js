@@ -217,11 +217,70 @@ document.addEventListener('DOMContentLoaded', function() {
         copyBtn.disabled = true;
         createPrBtn.disabled = true;
         
-        // Send API request
-        fetch('/api/generate-policy', {
+        // Send API request and render the policy as it streams in
+        let streamedPolicy = '';
+        let policyResources = null;
+        let streamFailed = false;
+        
+        const handleEvent = (event, data) => {
+            switch (event) {
+                case 'policy_chunk':
+                    // Show partial output as soon as the first chunk arrives
+                    loadingIndicator.classList.add('d-none');
+                    streamedPolicy += data.text;
+                    policyOutput.textContent = streamedPolicy;
+                    break;
+                case 'policy': {
+                    // Display the cleaned up policy
+                    loadingIndicator.classList.add('d-none');
+                    policyOutput.textContent = data.policy;
+                    hljs.highlightElement(policyOutput);
+                    
+                    // Enable buttons
+                    copyBtn.disabled = false;
+                    createPrBtn.disabled = false;
+                    editPolicyBtn.classList.remove('d-none');
+                    
+                    // Show file path
+                    const suggestedPath = data.suggested_path || targetPath || 'policy.yml';
+                    targetFilePath.textContent = suggestedPath;
+                    filePathDisplay.classList.remove('d-none');
+                    
+                    // Clear any previous PR notifications
+                    const existingNotification = document.getElementById('prNotificationArea');
+                    if (existingNotification) {
+                        existingNotification.remove();
+                    }
+                    
+                    policyExplanation.innerHTML = '<p class="text-muted">Generating explanation...</p>';
+                    break;
+                }
+                case 'resources':
+                    policyResources = data;
+                    break;
+                case 'explanation':
+                    // Display the explanation from the API
+                    if (data.explanation) {
+                        displayExplanation(data.explanation, policyResources);
+                    } else {
+                        // Fallback to client-side explanation if server didn't provide one
+                        generateExplanation(policyOutput.textContent);
+                    }
+                    break;
+                case 'error':
+                    streamFailed = true;
+                    loadingIndicator.classList.add('d-none');
+                    policyOutput.textContent = `Error: ${data.error}`;
+                    policyExplanation.innerHTML = '<p class="text-danger">Failed to generate policy recommendation.</p>';
+                    break;
+            }
+        };
+        
+        fetch('/api/generate-policy/stream', {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
+                'Content-Type': 'application/json',
+                'Accept': 'text/event-stream'
             },
             body: JSON.stringify({
                 prompt: prompt,
@@ -230,51 +289,17 @@ document.addEventListener('DOMContentLoaded', function() {
                 repository: `${connectedRepo.owner}/${connectedRepo.name}`
             })
         })
-        .then(response => response.json())
-        .then(data => {
-            // Hide loading indicator
-            loadingIndicator.classList.add('d-none');
+        .then(response => {
+            if (!response.ok || !response.body) {
+                throw new Error(`Server responded with status ${response.status}`);
+            }
+            return readEventStream(response.body, handleEvent);
+        })
+        .then(() => {
             generateBtn.disabled = false;
-            
-            if (data.success) {
-                // Display the generated policy
-                policyOutput.textContent = data.policy;
-                hljs.highlightElement(policyOutput);
-                
-                // Enable buttons
-                copyBtn.disabled = false;
-                createPrBtn.disabled = false;
-                editPolicyBtn.classList.remove('d-none');
-                
-                // Show file path
-                const suggestedPath = data.suggested_path || targetPath || 'policy.yml';
-                targetFilePath.textContent = suggestedPath;
-                filePathDisplay.classList.remove('d-none');
-                
-                // Clear any previous PR notifications
-                const existingNotification = document.getElementById('prNotificationArea');
-                if (existingNotification) {
-                    existingNotification.remove();
-                }
-                
-                // Display the explanation from the API
-                if (data.explanation) {
-                    displayExplanation(data.explanation, data.resources);
-                    
-                    // Add repository context to explanation
-                    // policyExplanation.innerHTML += `
-                    // <div class="mt-3">
-                    //     <h6>Repository Context</h6>
-                    //     <p>This policy is recommended for your repository <strong>${connectedRepo.owner}/${connectedRepo.name}</strong>.</p>
-                    //     <p>To apply this policy, click the <strong>Create PR</strong> button above.</p>
-                    // </div>`;
-                } else {
-                    // Fallback to client-side explanation if server didn't provide one
-                    generateExplanation(data.policy);
-                }
-            } else {
-                policyOutput.textContent = `Error: ${data.error}`;
-                policyExplanation.innerHTML = '<p class="text-danger">Failed to generate policy recommendation.</p>';
+            loadingIndicator.classList.add('d-none');
+            if (!streamFailed && !policyOutput.textContent) {
+                policyOutput.textContent = 'Error: No policy was generated';
             }
         })
         .catch(error => {
@@ -288,6 +313,50 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
     
+    // Read a server-sent event stream from a fetch response body.
+    // EventSource only supports GET, so the stream is parsed by hand.
+    function readEventStream(body, onEvent) {
+        const reader = body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        const dispatch = (rawEvent) => {
+            let event = 'message';
+            const dataLines = [];
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event:')) {
+                    event = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    dataLines.push(line.slice(5).trim());
+                }
+            });
+            if (dataLines.length > 0) {
+                onEvent(event, JSON.parse(dataLines.join('\n')));
+            }
+        };
+        
+        const pump = () => reader.read().then(({ done, value }) => {
+            if (done) {
+                if (buffer.trim()) {
+                    dispatch(buffer);
+                }
+                return;
+            }
+            buffer += decoder.decode(value, { stream: true });
+            
+            // Events are separated by a blank line
+            let boundary = buffer.indexOf('\n\n');
+            while (boundary !== -1) {
+                dispatch(buffer.slice(0, boundary));
+                buffer = buffer.slice(boundary + 2);
+                boundary = buffer.indexOf('\n\n');
+            }
+            return pump();
+        });
+        
+        return pump();
+    }
+    
     // Example buttons
     const exampleButtons = document.querySelectorAll('.use-example');
     exampleButtons.forEach(button => {
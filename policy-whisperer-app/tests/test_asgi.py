@@ -0,0 +1,31 @@
+"""
+Tests of the request bodies rejected by the async serving mode
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from policy_whisperer import llm_client, templates
+
+@pytest.fixture
+def app(monkeypatch):
+    # Importing the app would otherwise start fetching templates and creating LLM clients
+    monkeypatch.setattr(templates, "TEMPLATE_CACHE_WARMUP", False)
+    monkeypatch.setattr(llm_client, "LLM_CLIENT_WARMUP", False)
+    import asgi
+    return asgi.app
+
+def post(app, path: str, body: bytes) -> httpx.Response:
+    async def send():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.post(path, content=body, headers={"Content-Type": "application/json"})
+    return asyncio.run(send())
+
+@pytest.mark.parametrize("path", ["/api/generate-policy", "/api/generate-policy/stream"])
+@pytest.mark.parametrize("body", [b"{\"prompt\": ", b"[\"GitHub Actions\"]", b"\xff"])
+def test_invalid_bodies_are_rejected_as_json(app, path, body):
+    response = post(app, path, body)
+    assert response.status_code == 400
+    assert response.json()["success"] is False
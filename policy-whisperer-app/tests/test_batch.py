@@ -0,0 +1,36 @@
+"""
+Tests of batch input parsing: invalid lines fail on their own without stopping the batch
+"""
+
+import json
+
+import pytest
+
+from policy_whisperer import batch
+from policy_whisperer.batch import parse_batch_item, read_batch_items, run_batch
+
+@pytest.mark.parametrize("record", [
+    {"prompt": 123},
+    {"prompt": ["GitHub Actions for acme/web"]},
+    {"title": "GitHub Actions", "body": {"repository": "acme/web"}},
+    {"prompt": "GitHub Actions for acme/web", "repository": 5},
+    {"prompt": "GitHub Actions for acme/web", "target_path": ["ci"]},
+])
+def test_non_string_fields_are_rejected(record):
+    with pytest.raises(ValueError):
+        parse_batch_item(record, 0)
+
+def test_invalid_items_fail_without_stopping_the_batch(monkeypatch):
+    # The fast path answers the valid item, so only the example prefetch needs the network
+    monkeypatch.setattr(batch, "prefetch_batch_examples",
+                        lambda items, concurrency: {item["index"]: {} for item in items})
+    lines = [
+        json.dumps({"id": "number", "prompt": 123}),
+        json.dumps({"id": "valid", "prompt": "GitHub Actions for acme/web and acme/api"}),
+        json.dumps({"id": "list", "prompt": ["a"]}),
+        "[1]",
+    ]
+    results = {result["index"]: result for result in run_batch(read_batch_items(lines))}
+    assert [results[index]["status"] for index in range(4)] == ["failed", "succeeded", "failed", "failed"]
+    assert "'prompt' must be a string" in results[0]["error"]
+    assert results[1]["result"]["generation_path"] == "fast"
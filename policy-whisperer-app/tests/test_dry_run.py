@@ -0,0 +1,64 @@
+"""
+Tests of the Conjur dry-run client against the Conjur stub
+"""
+
+import time
+
+import pytest
+
+from benchmarks.stubs import ConjurHandler, FAKE_POLICY, start_stub_server
+from policy_whisperer.dry_run import ConjurClient, dry_run_policy_files
+
+@pytest.fixture
+def conjur(monkeypatch):
+    """Start a Conjur stub whose tokens expire after 0.5s and return its URL"""
+    monkeypatch.setenv("JWT_TOKEN", "test")
+    ConjurHandler.calls.clear()
+    ConjurHandler.tokens.clear()
+    server, url = start_stub_server(ConjurHandler, token_ttl=0.5)
+    yield url
+    server.shutdown()
+
+def write_policies(tmp_path, count: int, content: str = FAKE_POLICY):
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"policy-{i}.yml"
+        path.write_text(content)
+        paths.append(str(path))
+    return paths
+
+def test_authenticates_once_for_all_files(conjur, tmp_path):
+    client = ConjurClient(conjur, "test", "github", concurrency=4)
+    results = dry_run_policy_files(client, write_policies(tmp_path, 12), concurrency=4)
+    assert [result["success"] for result in results] == [True] * 12
+    assert client.authentications == 1
+    assert ConjurHandler.calls["authenticate"] == 1
+    assert ConjurHandler.calls["dry-run"] == 12
+
+def test_reauthenticates_when_the_token_expires(conjur, tmp_path):
+    client = ConjurClient(conjur, "test", "github")
+    (path,) = write_policies(tmp_path, 1)
+    assert client.dry_run(FAKE_POLICY).status_code == 200
+
+    # The client still considers the token valid, the server rejects it
+    time.sleep(0.6)
+    results = dry_run_policy_files(client, [path])
+    assert results[0]["success"], results[0]["output"]
+    assert client.authentications == 2
+    assert ConjurHandler.calls["dry-run rejected"] == 1
+
+def test_failing_file_does_not_stop_the_others(conjur, tmp_path):
+    client = ConjurClient(conjur, "test", "github", concurrency=4)
+    paths = write_policies(tmp_path, 3)
+    invalid = tmp_path / "invalid.yml"
+    invalid.write_text("name: not a policy\n")
+    results = dry_run_policy_files(client, [paths[0], str(invalid), *paths[1:]], concurrency=4)
+    assert [result["success"] for result in results] == [True, False, True, True]
+    assert results[1]["status"] == 422
+
+def test_every_file_fails_without_a_jwt(conjur, tmp_path, monkeypatch):
+    monkeypatch.delenv("JWT_TOKEN")
+    client = ConjurClient(conjur, "test", "github")
+    results = dry_run_policy_files(client, write_policies(tmp_path, 2))
+    assert [result["success"] for result in results] == [False, False]
+    assert "JWT" in results[0]["output"]
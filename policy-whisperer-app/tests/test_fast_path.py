@@ -0,0 +1,59 @@
+"""
+Tests of the rule-based fast path: prompts it answers and prompts it leaves to the LLM
+"""
+
+import pytest
+
+from policy_whisperer.fast_path import extract_parameters, generate_fast_path_policy
+from policy_whisperer.policy_parser import parse_policy
+
+ANSWERED = [
+    ("GitHub Actions for acme/web and acme/api", "github-actions"),
+    ("GitLab JWT authentication", "jwt-authenticator"),
+    ("AWS credentials for hosts app-1 and app-2", "aws"),
+    ("Kubernetes workload in the payments namespace", "kubernetes"),
+    ("Kubernetes app in namespace prod with service account billing-sa that reads variables "
+     "prod/db/password and prod/api-key", "kubernetes"),
+    ("Terraform access to secrets prod/db-password and prod/api-token", "terraform"),
+]
+
+LEFT_TO_LLM = [
+    # Restricted privileges, the rules always grant read and execute
+    "Kubernetes service account in namespace prod should be able to read variable app/db but only read, not execute",
+    "Kubernetes app in namespace prod with read-only access to variable app/db",
+    "Terraform needs write access to secrets prod/db-password",
+    # Secrets without variable names
+    "k8s app in namespace prod that needs the database password and the api key",
+    "Give the kubernetes namespace access to the database password",
+    "AWS credentials and the api key for host app-1",
+    "GitHub Actions for acme/web that needs the deploy token",
+]
+
+@pytest.mark.parametrize("prompt, rule", ANSWERED)
+def test_answers_matching_prompts(prompt, rule):
+    result = generate_fast_path_policy(prompt)
+    assert result is not None
+    assert result["rule"] == rule
+    assert parse_policy(result["policy"]).valid
+
+@pytest.mark.parametrize("prompt", LEFT_TO_LLM)
+def test_leaves_unsupported_prompts_to_the_llm(prompt):
+    assert generate_fast_path_policy(prompt) is None
+
+def test_kubernetes_variables_are_rendered():
+    result = generate_fast_path_policy(ANSWERED[4][0])
+    assert "- !variable prod/db/password" in result["policy"]
+    assert "- !variable prod/api-key" in result["policy"]
+    assert "authn-k8s/service-account: billing-sa" in result["policy"]
+
+@pytest.mark.parametrize("prompt", [
+    "Give the kubernetes namespace access to variable app/db",
+    "The kubernetes namespace should fetch variable app/db",
+])
+def test_words_next_to_namespace_are_not_names(prompt):
+    params = extract_parameters(prompt)
+    assert params["namespace"] is None
+    assert params["service_account"] is None
+
+def test_app_name_is_not_taken_from_host_ids():
+    assert "app_name" not in generate_fast_path_policy("AWS credentials for hosts app-1 and app-2")["parameters"]
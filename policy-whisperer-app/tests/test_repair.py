@@ -0,0 +1,80 @@
+"""
+Tests of the local policy fixes against the example policies
+"""
+
+import os
+
+import pytest
+
+from policy_whisperer.policy_parser import parse_policy
+from policy_whisperer.repair import LOCAL_FIXES, repair_locally, repair_policy
+from policy_whisperer.validator import ERROR, passed, validate_policy
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "examples")
+EXAMPLES = ["sample-policy.yml", "jwt-authenticator-setup.yml"]
+
+def read_example(name: str) -> str:
+    with open(os.path.join(EXAMPLES_DIR, name), "r") as f:
+        return f.read()
+
+def semantics(policy: str):
+    """The records a policy declares and its references, regardless of layout"""
+    parsed = parse_policy(policy)
+    assert parsed.valid, parsed.error
+    references = {(reference.source, reference.relation, reference.target, reference.privileges)
+                  for reference in parsed.references}
+    return parsed.declared(), references
+
+@pytest.mark.parametrize("name", EXAMPLES)
+def test_examples_pass_validation(name):
+    assert passed(validate_policy(read_example(name)))
+
+@pytest.mark.parametrize("name", EXAMPLES)
+def test_repair_leaves_examples_unchanged(name):
+    policy = read_example(name)
+    result = repair_policy(policy)
+    assert result.outcome == "valid"
+    assert result.fixes == []
+    assert result.policy.strip() == policy.strip()
+
+@pytest.mark.parametrize("name", EXAMPLES)
+@pytest.mark.parametrize("fix_name,fix", LOCAL_FIXES, ids=[name for name, _ in LOCAL_FIXES])
+def test_fix_keeps_example_semantics(name, fix_name, fix):
+    policy = read_example(name)
+    fixed = fix(policy, parse_policy(policy), validate_policy(policy))
+    assert semantics(fixed) == semantics(policy)
+
+BROKEN_SAMPLES = {
+    "code_fences": lambda policy: f"Here is the policy:\n```yaml\n{policy}\n```\nLoad it with the Conjur CLI.",
+    "whitespace": lambda policy: policy.replace("    - !group readers", "    -!group readers", 1),
+    "indentation": lambda policy: policy.replace("      role: !group readers", "     role: !group readers", 1),
+    "unknown_tags": lambda policy: policy.replace("\n    - !variable api/key", "\n    - !secret api/key", 1),
+    "duplicate_ids": lambda policy: policy.replace("    - !group readers\n", "    - !group readers\n    - !group admins\n", 1),
+}
+
+@pytest.mark.parametrize("fix_name", sorted(BROKEN_SAMPLES))
+def test_fix_repairs_broken_sample(fix_name):
+    policy = read_example("sample-policy.yml")
+    broken = BROKEN_SAMPLES[fix_name](policy)
+    assert broken != policy
+    assert not passed(validate_policy(broken))
+
+    repaired, fixes, diagnostics = repair_locally(broken)
+    assert fix_name in fixes
+    assert passed(diagnostics)
+    assert semantics(repaired) == semantics(policy)
+
+@pytest.mark.parametrize("name", EXAMPLES)
+def test_undeclared_references_are_left_alone(name):
+    policy = read_example(name)
+    diagnostics = validate_policy(policy)
+    references = [diagnostic for diagnostic in diagnostics if diagnostic.code == "undeclared-reference"]
+    assert references and all(diagnostic.severity != ERROR for diagnostic in references)
+
+    # Repairing another error doesn't touch them
+    broken = BROKEN_SAMPLES["code_fences"](policy)
+    repaired, fixes, diagnostics = repair_locally(broken)
+    assert passed(diagnostics)
+    assert semantics(repaired) == semantics(policy)
+    assert [(d.line, d.message) for d in diagnostics if d.code == "undeclared-reference"] == \
+        [(d.line, d.message) for d in references]
@@ -0,0 +1,33 @@
+"""
+Tests of near-duplicate matching in the response cache
+"""
+
+import pytest
+
+from policy_whisperer.response_cache import MemoryCacheBackend, ResponseCache
+
+CACHED = "Create a policy for the payroll app with read access to its database password"
+
+@pytest.fixture
+def cache():
+    cache = ResponseCache(MemoryCacheBackend(), near_duplicates=True, similarity=0.5)
+    cache.set("policy", CACHED, "payroll policy")
+    return cache
+
+@pytest.mark.parametrize("prompt", [
+    "Please create a policy for the payroll app with read access to its database password",
+    "Create policy for payroll app with read access to the database password",
+])
+def test_serves_prompts_differing_in_function_words(cache, prompt):
+    assert cache.get("policy", prompt) == "payroll policy"
+
+@pytest.mark.parametrize("prompt", [
+    # Another app, named with a plain word
+    "Create a policy for the billing app with read access to its database password",
+    "Create a policy for the Payroll app with read access to its database password",
+    # Restricted privileges
+    "Create a policy for the payroll app with only read access to its database password",
+    "Create a policy for the payroll app without read access to its database password",
+])
+def test_rejects_prompts_differing_in_other_words(cache, prompt):
+    assert cache.get("policy", prompt) is None
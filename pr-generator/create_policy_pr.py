@@ -4,17 +4,32 @@ Conjur Policy PR Creator
 
 This script takes a Conjur policy YAML content and creates a Pull Request
 to add it to a GitHub repository.
+
+In bulk mode (--dir or --manifest) all the policies of a directory or manifest
+are landed in a single commit and PR: their blobs are uploaded in parallel,
+then one tree, one commit, one branch and one PR are created.
 """
 
 import argparse
+import hashlib
 import os
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import yaml
-from github import Github, GithubException
+from github import Github, GithubException, InputGitTreeElement
+
+# File extensions picked up from a --dir
+POLICY_EXTENSIONS = (".yml", ".yaml")
+
+# Rate-limited requests are retried this many times, if the limit resets within MAX_RATE_LIMIT_WAIT seconds
+RATE_LIMIT_RETRIES = 5
+MAX_RATE_LIMIT_WAIT = 900
 
 
 def create_github_pr(repo_owner, repo_name, policy_content, file_path, branch_name, commit_message, pr_title, pr_description, github_token):
@@ -86,14 +101,239 @@ def create_github_pr(repo_owner, repo_name, policy_content, file_path, branch_na
         raise
 
 
+def git_blob_sha(content):
+    """Return the SHA git gives a blob with this content"""
+    data = content.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def collect_policy_files(directory, dest_prefix):
+    """Return (dest_path, local_path) pairs for the policy files under a directory"""
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs.sort()
+        for name in sorted(names):
+            if name.endswith(POLICY_EXTENSIONS):
+                local_path = os.path.join(root, name)
+                relative = os.path.relpath(local_path, directory).replace(os.sep, "/")
+                files.append((f"{dest_prefix.strip('/')}/{relative}".lstrip("/"), local_path))
+    return files
+
+
+def read_manifest(path, dest_prefix):
+    """
+    Return (dest_path, local_path) pairs from a manifest: a YAML list of
+    {file: local path, dest: path in the repo} entries. Local paths are relative
+    to the manifest, and dest defaults to the file name under --dest-path.
+    """
+    with open(path, "r") as f:
+        entries = yaml.safe_load(f) or []
+    base = os.path.dirname(os.path.abspath(path))
+    files = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"file": entry}
+        local_path = os.path.join(base, entry["file"])
+        dest = entry.get("dest") or f"{dest_prefix.strip('/')}/{os.path.basename(local_path)}".lstrip("/")
+        files.append((dest, local_path))
+    return files
+
+
+def rate_limit_wait(exception, attempt):
+    """Return how long to wait before retrying a rate-limited request, or None if it wasn't rate limited"""
+    if not isinstance(exception, GithubException) or exception.status not in (403, 429):
+        return None
+    headers = {key.lower(): value for key, value in (exception.headers or {}).items()}
+    if "retry-after" in headers:
+        return float(headers["retry-after"])
+    if headers.get("x-ratelimit-remaining") == "0":
+        return max(float(headers.get("x-ratelimit-reset", 0)) - time.time(), 0) + 1
+    if "secondary rate limit" in str(exception.data).lower():
+        # GitHub asks to wait at least a minute without a Retry-After
+        return 60 * 2 ** attempt
+    return None
+
+
+def with_rate_limit_retry(function, *args, **kwargs):
+    """Call a PyGithub function, waiting out primary and secondary rate limits"""
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        try:
+            return function(*args, **kwargs)
+        except GithubException as e:
+            wait = rate_limit_wait(e, attempt)
+            if wait is None or wait > MAX_RATE_LIMIT_WAIT or attempt == RATE_LIMIT_RETRIES:
+                raise
+            print(f"Rate limited, retrying in {wait:.0f}s")
+            time.sleep(wait)
+
+
+class Progress:
+    """Prints blob upload progress with throughput and the remaining rate-limit budget"""
+
+    def __init__(self, g, total):
+        self.g = g
+        self.total = total
+        self.done = 0
+        self.start = time.perf_counter()
+        self.step = max(1, total // 20)
+        self.lock = threading.Lock()
+
+    def advance(self):
+        with self.lock:
+            self.done += 1
+            if self.done % self.step and self.done != self.total:
+                return
+            elapsed = time.perf_counter() - self.start
+            # rate_limiting is read from the headers of the last response, it costs no request
+            remaining, limit = self.g.rate_limiting
+            print(f"[{self.done:>{len(str(self.total))}}/{self.total}] "
+                  f"{self.done / elapsed if elapsed else 0:.1f} blobs/s, "
+                  f"rate limit {remaining}/{limit} remaining")
+
+
+def create_bulk_github_pr(repo_owner, repo_name, files, branch_name, commit_message, pr_title, pr_description,
+                          github_token, workers=8):
+    """
+    Create a single commit and PR adding or updating many policy files
+
+    Args:
+        files: list of (dest_path, policy_content) pairs
+        workers: number of blobs uploaded in parallel
+    """
+    g = Github(github_token, pool_size=workers)
+    repo = with_rate_limit_retry(g.get_repo, f"{repo_owner}/{repo_name}")
+
+    # Get default branch
+    default_branch = repo.default_branch
+    base_commit = with_rate_limit_retry(repo.get_git_commit,
+                                        with_rate_limit_retry(repo.get_git_ref, f"heads/{default_branch}").object.sha)
+
+    # Files whose content is already in the default branch don't need a blob
+    existing = {element.path: element.sha
+                for element in with_rate_limit_retry(repo.get_git_tree, base_commit.tree.sha, recursive=True).tree
+                if element.type == "blob"}
+    changed = [(path, content) for path, content in files if existing.get(path) != git_blob_sha(content)]
+    print(f"{len(changed)} of {len(files)} policies are new or changed")
+    if not changed:
+        print("Nothing to commit")
+        return None
+
+    # Upload the blobs in parallel
+    progress = Progress(g, len(changed))
+
+    def upload(item):
+        path, content = item
+        blob = with_rate_limit_retry(repo.create_git_blob, content, "utf-8")
+        progress.advance()
+        return InputGitTreeElement(path, "100644", "blob", sha=blob.sha)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        elements = list(executor.map(upload, changed))
+
+    def commit_on(parent):
+        tree = with_rate_limit_retry(repo.create_git_tree, elements, parent.tree)
+        return with_rate_limit_retry(repo.create_git_commit, commit_message, tree, [parent])
+
+    # Create the branch at the new commit, or add the commit to an existing branch
+    commit = commit_on(base_commit)
+    try:
+        with_rate_limit_retry(repo.create_git_ref, f"refs/heads/{branch_name}", commit.sha)
+        print(f"Created new branch: {branch_name}")
+        branch_exists = False
+    except GithubException as e:
+        if e.status != 422:  # Branch already exists
+            raise
+        print(f"Branch {branch_name} already exists. Will update it.")
+        branch_ref = with_rate_limit_retry(repo.get_git_ref, f"heads/{branch_name}")
+        commit = commit_on(with_rate_limit_retry(repo.get_git_commit, branch_ref.object.sha))
+        with_rate_limit_retry(branch_ref.edit, commit.sha)
+        branch_exists = True
+    print(f"Committed {len(changed)} policies: {commit.sha}")
+
+    # Create PR if it doesn't exist
+    if branch_exists:
+        existing_prs = repo.get_pulls(state="open", head=f"{repo_owner}:{branch_name}", base=default_branch)
+        if existing_prs.totalCount > 0:
+            pr = existing_prs[0]
+            print(f"Using existing PR #{pr.number}: {pr.html_url}")
+            return pr.html_url
+
+    pr = with_rate_limit_retry(repo.create_pull, title=pr_title, body=pr_description,
+                               head=branch_name, base=default_branch)
+    print(f"Created new PR #{pr.number}: {pr.html_url}")
+    remaining, limit = g.rate_limiting
+    print(f"Rate limit: {remaining}/{limit} remaining")
+    return pr.html_url
+
+
+def bulk_main(parser, args):
+    """Create a single PR with all the policies of --dir or --manifest"""
+    dest_prefix = args.dest_path or ""
+    try:
+        if args.dir:
+            sources = collect_policy_files(args.dir, dest_prefix)
+        else:
+            sources = read_manifest(args.manifest, dest_prefix)
+        files = []
+        for dest_path, local_path in sources:
+            with open(local_path, "r") as f:
+                files.append((dest_path, f.read()))
+    except Exception as e:
+        print(f"Error reading policy files: {str(e)}")
+        return 1
+    if not files:
+        print("Error: No policy files found")
+        return 1
+    print(f"Read {len(files)} policy files")
+    
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    branch_name = args.branch or f"policy-update-bulk-{timestamp}"
+    commit_message = args.commit_msg or f"Add/Update {len(files)} Conjur policies"
+    pr_title = args.pr_title or f"Add/Update {len(files)} Conjur policies"
+    pr_description = args.pr_description or (
+        f"This PR adds or updates {len(files)} Conjur policy files:\n\n"
+        + "\n".join(f"- `{dest_path}`" for dest_path, _ in files)
+        + f"\n\nGenerated by the Conjur Policy PR Creator script at {datetime.now().isoformat()}"
+    )
+    
+    github_token = args.token or os.environ.get("GITHUB_TOKEN")
+    if not github_token:
+        print("Error: No GitHub token provided. Use --token or set GITHUB_TOKEN environment variable.")
+        return 1
+    
+    try:
+        start = time.perf_counter()
+        pr_url = create_bulk_github_pr(
+            args.repo_owner,
+            args.repo_name,
+            files,
+            branch_name,
+            commit_message,
+            pr_title,
+            pr_description,
+            github_token,
+            workers=args.workers
+        )
+        if pr_url:
+            print(f"Successfully created PR: {pr_url} ({time.perf_counter() - start:.1f}s)")
+        return 0
+    except Exception as e:
+        print(f"Failed to create PR: {str(e)}")
+        return 1
+
+
 def main():
     parser = argparse.ArgumentParser(description="Create a GitHub PR for a Conjur policy")
     parser.add_argument("--content", help="The policy content as a string")
     parser.add_argument("--file", help="Path to a policy file to read")
+    parser.add_argument("--dir", help="Bulk mode: directory of policy files (*.yml, *.yaml) to add in one commit")
+    parser.add_argument("--manifest", help="Bulk mode: YAML list of {file, dest} entries to add in one commit")
+    parser.add_argument("--workers", type=int, default=8, help="Bulk mode: blobs uploaded in parallel (default: 8)")
     parser.add_argument("--output", help="Path to save the policy content to before creating PR")
     parser.add_argument("--repo-owner", required=True, help="GitHub repository owner")
     parser.add_argument("--repo-name", required=True, help="GitHub repository name")
-    parser.add_argument("--dest-path", required=True, help="Destination path in the repo (e.g., 'policies/app1.yml')")
+    parser.add_argument("--dest-path", help="Destination path in the repo (e.g., 'policies/app1.yml'), "
+                                            "or in bulk mode the directory the policies are added to")
     parser.add_argument("--branch", help="Branch name to create (default: policy-update-TIMESTAMP)")
     parser.add_argument("--commit-msg", help="Commit message")
     parser.add_argument("--pr-title", help="PR title")
@@ -102,6 +342,11 @@ def main():
     
     args = parser.parse_args()
     
+    if args.dir or args.manifest:
+        return bulk_main(parser, args)
+    if not args.dest_path:
+        parser.error("--dest-path is required")
+    
     # Get the policy content
     if args.content:
         policy_content = args.content
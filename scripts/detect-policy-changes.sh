@@ -1,8 +1,11 @@
 #!/bin/bash
 set -ex
+# Fail when policy_whisperer.impact fails, not only when the last command of a pipe does
+set -o pipefail
 
 # Default policy directory
 POLICY_DIR=${POLICY_DIR:-.}
+POLICY_INDEX_PATH=${POLICY_INDEX_PATH:-.policy-index.json}
 
 # Get the base commit for comparison
 if [ -n "$GITHUB_BASE_REF" ]; then
@@ -13,8 +16,13 @@ else
   BASE_COMMIT=$(git rev-parse HEAD^)
 fi
 
-# Find all changed .yml or .yaml files in the policy directory
-CHANGED_POLICIES=$(git diff --name-only --diff-filter=ACMRT "$BASE_COMMIT" HEAD -- "$POLICY_DIR" | grep -E '\.ya?ml$' || true)
+pip install --quiet pyyaml requests
+
+# Changed policy files plus the unchanged ones that reference records the
+# change declares or removes. The reference graph is cached by blob SHA in
+# POLICY_INDEX_PATH, so only new file contents are parsed.
+CHANGED_POLICIES=$(PYTHONPATH="$GITHUB_ACTION_PATH/policy-whisperer-app" python3 -m policy_whisperer.impact \
+  --base "$BASE_COMMIT" --policy-dir "$POLICY_DIR" --index "$POLICY_INDEX_PATH" | paste -sd, -)
 
 # Set output whether we have policy changes
 if [ -z "$CHANGED_POLICIES" ]; then
@@ -23,6 +31,6 @@ if [ -z "$CHANGED_POLICIES" ]; then
 else
   echo "::set-output name=has_policy_changes::true"
   echo "::set-output name=changed_policies::$CHANGED_POLICIES"
-  echo "Changed policy files:"
-  echo "$CHANGED_POLICIES"
+  echo "Policy files to validate:"
+  echo "$CHANGED_POLICIES" | tr ',' '\n'
 fi
@@ -0,0 +1,26 @@
+#!/bin/bash
+set -e
+
+# Validate the changed policy files offline, so only the files that pass are
+# sent to Conjur for the dry-run
+PASSED_FILE="/tmp/conjur_static_passed.txt"
+OUTPUT_FILE="/tmp/conjur_static_output.txt"
+: > "$PASSED_FILE"
+: > "$OUTPUT_FILE"
+
+pip install --quiet pyyaml
+
+if PYTHONPATH="$GITHUB_ACTION_PATH/policy-whisperer-app" python3 -m policy_whisperer.validator \
+    --format github --passed-output "$PASSED_FILE" --markdown-output "$OUTPUT_FILE" "$CHANGED_POLICIES"
+then
+  echo "::set-output name=static_success::true"
+else
+  echo "::set-output name=static_success::false"
+  echo "Static validation found errors. Only the files that passed will be validated against Conjur."
+fi
+
+# validate-policies.sh expects a comma separated list
+PASSED_POLICIES=$(paste -sd, "$PASSED_FILE")
+echo "::set-output name=passed_policies::$PASSED_POLICIES"
+ESCAPED_OUTPUT=$(cat "$OUTPUT_FILE" | awk '{printf "%s\\n", $0}')
+echo "::set-output name=static_output::$ESCAPED_OUTPUT"